@@ -0,0 +1,75 @@
+#
+# Copyright 2015-2024, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Response-time benchmarks, run by hand from a Django shell against a copy of the database, eg.:
+#
+#   from cohorts.benchmarks import benchmark_cohort_list
+#   benchmark_cohort_list(User.objects.get(email=...))
+#
+# Anything a benchmark creates is rolled back when it finishes.
+
+import time
+import logging
+
+from django.db import transaction
+from cohorts.models import Cohort, Cohort_Perms, Filter_Group, Filter
+from cohorts.utils import get_cohort_list
+from idc_collections.models import ImagingDataCommonsVersion, Attribute
+
+logger = logging.getLogger(__name__)
+
+
+# Time paging through a user's whole cohort list, with the default and a minimal field set, after growing it to each
+# of sizes cohorts. Returns {(<size>, <fields>): <seconds>}.
+def benchmark_cohort_list(user, sizes=(10, 1000, 10000), page_size=1000):
+    timings = {}
+    with transaction.atomic():
+        version = ImagingDataCommonsVersion.objects.get(active=True)
+        attr = Attribute.objects.get(name='collection_id')
+        total = 0
+        for size in sizes:
+            cohorts = Cohort.objects.bulk_create([
+                Cohort(name='benchmark_{}_{}'.format(size, i), case_count=i) for i in range(size-total)
+            ])
+            cohorts = Cohort.objects.filter(name__startswith='benchmark_')
+            Cohort_Perms.objects.bulk_create([
+                Cohort_Perms(cohort=x, user=user, perm=Cohort_Perms.OWNER)
+                for x in cohorts.exclude(cohort_perms__user=user)
+            ])
+            Filter_Group.objects.bulk_create([
+                Filter_Group(resulting_cohort=x, data_version=version)
+                for x in cohorts.exclude(filter_group__isnull=False)
+            ])
+            Filter.objects.bulk_create([
+                Filter(resulting_cohort_id=x.resulting_cohort_id, filter_group=x, attribute=attr, value='4d_lung')
+                for x in Filter_Group.objects.filter(resulting_cohort__in=cohorts, filter__isnull=True)
+            ])
+            total = size
+
+            for fields in [None, ['cohort_id', 'name', 'counts']]:
+                start = time.time()
+                cursor = None
+                while True:
+                    page = get_cohort_list(user, fields=fields, cursor=cursor, page_size=page_size)
+                    cursor = page['next_cursor']
+                    if not cursor:
+                        break
+                stop = time.time()
+                timings[(size, tuple(fields) if fields else None)] = stop-start
+                logger.info("[BENCHMARKING] Cohort list of {} cohorts, fields {}: {}s".format(
+                    size, fields, str(stop-start)))
+        transaction.set_rollback(True)
+    return timings
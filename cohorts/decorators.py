@@ -19,11 +19,81 @@ from django.contrib.auth.models import User
 from rest_framework.authtoken.models import Token
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
+from django.db.models.signals import post_save, post_delete
 from django.http import JsonResponse
+from django.core.cache import caches
+from metrics_helpers import histogram, counter
 
+import time
+import hashlib
 import logging
 logger = logging.getLogger(__name__)
 
+# Defaults for the token cache, overridable with the setting of the same name: valid tokens are cached for
+# API_TOKEN_CACHE_TTL seconds and invalid ones for API_TOKEN_NEGATIVE_CACHE_TTL, in the Django cache named by
+# API_TOKEN_CACHE, so every process shares the same entries. A TTL of 0 disables that kind of caching.
+API_TOKEN_CACHE = 'default'
+API_TOKEN_CACHE_TTL = 60
+API_TOKEN_NEGATIVE_CACHE_TTL = 10
+
+API_TOKEN_LOOKUPS = counter(
+    'idc_api_token_lookups_total', "API token validations, by result (hit, negative_hit, or miss)", ['result'])
+API_TOKEN_LOOKUP_SECONDS = histogram(
+    'idc_api_token_lookup_seconds', "Time to validate an API token, by where the answer came from", ['source'],
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0))
+
+
+def _token_cache():
+    return caches[getattr(settings, 'API_TOKEN_CACHE', API_TOKEN_CACHE)]
+
+
+# Cache keys for a token's entry and its generation, keyed on the token's hash. The generation is bumped on every
+# invalidation, and an entry is only used if it was cached under the current one, so a lookup which raced with an
+# invalidation can't leave a stale answer behind.
+def _api_token_keys(token):
+    token_hash = hashlib.sha256(token.encode('utf-8')).hexdigest()
+    return "api_token:{}".format(token_hash), "api_token_generation:{}".format(token_hash)
+
+
+# The ID of the user an API token belongs to, or None if the token isn't valid. Answers are cached (see above), and
+# a token's entry is dropped as soon as it's saved or deleted.
+def get_api_token_user_id(token):
+    start = time.time()
+    token_cache = _token_cache()
+    entry_key, generation_key = _api_token_keys(token)
+    cached = token_cache.get_many([entry_key, generation_key])
+    generation = cached.get(generation_key, 0)
+    entry = cached.get(entry_key, None)
+    if entry and entry['generation'] == generation:
+        API_TOKEN_LOOKUPS.inc(result='hit' if entry['user_id'] else 'negative_hit')
+        API_TOKEN_LOOKUP_SECONDS.observe(time.time() - start, source='cache')
+        return entry['user_id']
+
+    user_id = Token.objects.filter(key=token).values_list('user_id', flat=True).first()
+    ttl = getattr(settings, 'API_TOKEN_CACHE_TTL', API_TOKEN_CACHE_TTL) if user_id else \
+        getattr(settings, 'API_TOKEN_NEGATIVE_CACHE_TTL', API_TOKEN_NEGATIVE_CACHE_TTL)
+    if ttl > 0:
+        token_cache.set(entry_key, {'user_id': user_id, 'generation': generation}, ttl)
+    API_TOKEN_LOOKUPS.inc(result='miss')
+    API_TOKEN_LOOKUP_SECONDS.observe(time.time() - start, source='db')
+    return user_id
+
+
+# Drop a token from the cache when it's created (clearing any negative entry), rotated, or revoked
+def invalidate_api_token(sender, instance, **kwargs):
+    token_cache = _token_cache()
+    entry_key, generation_key = _api_token_keys(instance.key)
+    try:
+        token_cache.incr(generation_key)
+    except ValueError:
+        # No invalidations yet; the generation is kept for as long as the cache will hold it
+        token_cache.add(generation_key, 1, None)
+    token_cache.delete(entry_key)
+
+
+post_save.connect(invalidate_api_token, sender=Token)
+post_delete.connect(invalidate_api_token, sender=Token)
+
 
 # Adapted from the Django REST Framework's TokenAuthentization class
 # https://github.com/encode/django-rest-framework/blob/master/rest_framework/authentication.py
@@ -54,7 +124,8 @@ def api_auth(function):
 
             # Now actually validate with the token
             token = auth_header[1]
-            Token.objects.select_related('user').get(key=token)
+            if not get_api_token_user_id(token):
+                return JsonResponse({'message': 'Invalid API auth token supplied.'}, status=403)
 
             # If a user was found, we've received a valid API call, and can proceed.
             return function(request, *args, **kwargs)
@@ -0,0 +1,173 @@
+#
+# Copyright 2015-2024, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import logging
+import time
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from django.conf import settings
+from idc_collections.models import ImagingDataCommonsVersion, DataSetType, DataSource
+from idc_collections.collex_metadata_utils import get_collex_metadata, get_bq_metadata
+from google_helpers.bigquery.bq_support import BigQuerySupport
+from metrics_helpers import histogram
+
+logger = logging.getLogger(__name__)
+
+COHORT_DIFF_SECONDS = histogram(
+    'idc_cohort_diff_seconds', "Time to compute a cohort's diff summary between two versions",
+    ['from_version', 'to_version'])
+
+DIFF_FIELDS = ["SeriesInstanceUID", "crdc_series_uuid"]
+
+# A series is 'changed' between versions if its UID is in both but its contents (and so its crdc_series_uuid) differ
+ADDED = 'added'
+REMOVED = 'removed'
+CHANGED = 'changed'
+UNCHANGED = 'unchanged'
+
+# Diff summaries, keyed on a hash of (filters, from version, to version). Released versions don't change, so neither
+# does the diff between them. At most MAX_COHORT_DIFF_SUMMARIES are held, least recently used dropped first.
+COHORT_DIFF_SUMMARIES = OrderedDict()
+MAX_COHORT_DIFF_SUMMARIES = 1024
+COHORT_DIFF_LOCK = threading.Lock()
+
+
+def _field_val(row, field):
+    val = row[field]
+    return val[0] if isinstance(val, list) else val
+
+
+# Yield (SeriesInstanceUID, crdc_series_uuid) for the series matching filters in one IDC version, in ascending UID
+# order. The active version is streamed from Solr's /export handler, archived versions from BigQuery.
+def _version_series(filters, version):
+    versions = ImagingDataCommonsVersion.objects.filter(id=version.id)
+    if version.active:
+        data_sets = DataSetType.objects.filter(
+            data_type__in=[DataSetType.IMAGE_DATA, DataSetType.ANCILLARY_DATA, DataSetType.DERIVED_DATA])
+        sources = data_sets.get_data_sources().filter(
+            source_type=DataSource.SOLR,
+            aggregate_level__in=["SeriesInstanceUID"],
+            id__in=versions.get_data_sources().filter(source_type=DataSource.SOLR).values_list("id", flat=True)
+        ).distinct()
+        result = get_collex_metadata(
+            filters, DIFF_FIELDS, max(version.series_count, settings.MAX_FILE_LIST_REQUEST), sources=sources,
+            versions=versions, counts_only=False, collapse_on="SeriesInstanceUID", records_only=True,
+            sort="SeriesInstanceUID asc", filtered_needed=False, default_facets=False,
+            search_child_records_by={x: "StudyInstanceUID" for x in filters}, stream_records=True
+        )
+        rows = result.get('docs', None)
+    else:
+        bq_query = get_bq_metadata(
+            filters, DIFF_FIELDS, versions, None, DIFF_FIELDS, no_submit=True,
+            search_child_records_by="StudyInstanceUID"
+        )
+        # The metadata query may be a UNION, which doesn't preserve order, so the ordering is applied outside of it
+        rows = BigQuerySupport.stream_query_results("SELECT {fields} FROM ({query}) ORDER BY SeriesInstanceUID ASC".format(
+            fields=", ".join(DIFF_FIELDS), query=bq_query['sql_string']
+        ), bq_query['params'])
+
+    if rows is None:
+        raise Exception("Failed to retrieve series for version {}.".format(version.version_number))
+
+    for row in rows:
+        yield _field_val(row, "SeriesInstanceUID"), _field_val(row, "crdc_series_uuid")
+
+
+# Merge-join two streams of (UID, content ID) pairs, each in ascending UID order, yielding
+# (status, UID, old content ID, new content ID). Neither stream is held in memory.
+def merge_series_diff(old_series, new_series, with_unchanged=False):
+    old_series = iter(old_series)
+    new_series = iter(new_series)
+    old = next(old_series, None)
+    new = next(new_series, None)
+    last_old = last_new = None
+
+    while old is not None or new is not None:
+        if old is not None and last_old is not None and old[0] < last_old:
+            raise Exception("Series for the older version aren't in UID order ({} after {}).".format(old[0], last_old))
+        if new is not None and last_new is not None and new[0] < last_new:
+            raise Exception("Series for the newer version aren't in UID order ({} after {}).".format(new[0], last_new))
+
+        if new is None or (old is not None and old[0] < new[0]):
+            yield REMOVED, old[0], old[1], None
+            last_old = old[0]
+            old = next(old_series, None)
+        elif old is None or new[0] < old[0]:
+            yield ADDED, new[0], None, new[1]
+            last_new = new[0]
+            new = next(new_series, None)
+        else:
+            if old[1] != new[1]:
+                yield CHANGED, old[0], old[1], new[1]
+            elif with_unchanged:
+                yield UNCHANGED, old[0], old[1], new[1]
+            last_old = old[0]
+            last_new = new[0]
+            old = next(old_series, None)
+            new = next(new_series, None)
+
+
+def _cohort_diff_filters(cohort):
+    return {x['name']: x['values'] for x in cohort.get_filters_as_dict()[0]['filters']}
+
+
+def _cohort_diff_versions(cohort, from_version=None, to_version=None):
+    from_version = from_version or cohort.get_data_versions().first()
+    to_version = to_version or ImagingDataCommonsVersion.objects.get(active=True)
+    return from_version, to_version
+
+
+# Stream the detailed diff of a cohort's filters between two versions (default: the cohort's version and the active
+# version), as (status, SeriesInstanceUID, old crdc_series_uuid, new crdc_series_uuid)
+def cohort_diff(cohort, from_version=None, to_version=None):
+    from_version, to_version = _cohort_diff_versions(cohort, from_version, to_version)
+    filters = _cohort_diff_filters(cohort)
+    return merge_series_diff(_version_series(filters, from_version), _version_series(filters, to_version))
+
+
+# Counts of added, removed, changed, and unchanged series for a cohort's filters between two versions
+def cohort_diff_summary(cohort, from_version=None, to_version=None):
+    from_version, to_version = _cohort_diff_versions(cohort, from_version, to_version)
+    filters = _cohort_diff_filters(cohort)
+    summary_key = hashlib.sha256(json.dumps({
+        'filters': filters, 'from': from_version.version_number, 'to': to_version.version_number
+    }, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    with COHORT_DIFF_LOCK:
+        summary = COHORT_DIFF_SUMMARIES.get(summary_key, None)
+        if summary is not None:
+            COHORT_DIFF_SUMMARIES.move_to_end(summary_key)
+            return summary
+
+    start = time.time()
+    summary = {ADDED: 0, REMOVED: 0, CHANGED: 0, UNCHANGED: 0}
+    for status, uid, old_uuid, new_uuid in merge_series_diff(
+            _version_series(filters, from_version), _version_series(filters, to_version), with_unchanged=True):
+        summary[status] += 1
+    summary.update({'from_version': from_version.version_number, 'to_version': to_version.version_number})
+    stop = time.time()
+    COHORT_DIFF_SECONDS.observe(stop - start, from_version=from_version.version_number,
+                                to_version=to_version.version_number)
+
+    with COHORT_DIFF_LOCK:
+        COHORT_DIFF_SUMMARIES[summary_key] = summary
+        COHORT_DIFF_SUMMARIES.move_to_end(summary_key)
+        while len(COHORT_DIFF_SUMMARIES) > getattr(settings, 'MAX_COHORT_DIFF_SUMMARIES', MAX_COHORT_DIFF_SUMMARIES):
+            COHORT_DIFF_SUMMARIES.popitem(last=False)
+
+    return summary
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.20 on 2026-10-19 00:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cohorts', '0009_alter_filter_operator'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cohort',
+            name='stats_status',
+            field=models.CharField(choices=[('P', 'Pending'), ('R', 'Ready'), ('F', 'Failed')], default='R', max_length=1),
+        ),
+    ]
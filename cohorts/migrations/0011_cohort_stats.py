@@ -0,0 +1,28 @@
+# Generated by Django 3.2.20 on 2026-10-19 00:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cohorts', '0010_cohort_stats_status'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Cohort_Stats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('filters_hash', models.CharField(max_length=64, unique=True)),
+                ('version', models.CharField(max_length=256)),
+                ('case_count', models.IntegerField(default=0)),
+                ('series_count', models.IntegerField(default=0)),
+                ('study_count', models.IntegerField(default=0)),
+                ('total_disk_size', models.PositiveBigIntegerField(default=0)),
+                ('collections', models.TextField(blank=True, default='')),
+                ('hits', models.PositiveIntegerField(default=0)),
+                ('date_created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
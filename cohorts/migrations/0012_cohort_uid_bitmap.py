@@ -0,0 +1,25 @@
+# Generated by Django 3.2.20 on 2026-10-19 00:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cohorts', '0011_cohort_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Cohort_UID_Bitmap',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('level', models.CharField(default='SeriesInstanceUID', max_length=64)),
+                ('index_key', models.CharField(max_length=256)),
+                ('bitmap', models.BinaryField()),
+                ('date_created', models.DateTimeField(auto_now_add=True)),
+                ('cohort', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='cohorts.Cohort')),
+            ],
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.20 on 2026-10-19 00:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cohorts', '0012_cohort_uid_bitmap'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cohort',
+            name='stats_attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='cohort',
+            name='stats_retry_after',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -48,6 +48,86 @@ class CohortQuerySet(models.QuerySet):
             "hashes": []
         } for cohort in self.all()]
 
+    # Bulk-load the filters for every cohort in this QuerySet. This takes the same number of queries no matter how
+    # many cohorts, groups, or filters are involved, so list pages should use it rather than the per-cohort methods.
+    #
+    # Returns {<cohort ID>: [{'id': <group ID>, 'data_version': <String>, 'filters': [<flat filter dict>, ...]}, ...]}
+    def get_filters_as_dict(self, active_only=False):
+        cohort_ids = list(self.values_list('id', flat=True))
+        result = {cohort_id: [] for cohort_id in cohort_ids}
+        groups = {}
+
+        for fg in Filter_Group.objects.select_related('data_version').filter(
+                resulting_cohort__in=cohort_ids).order_by('id'):
+            groups[fg.id] = {
+                'id': fg.id,
+                'data_version': fg.data_version.get_display() if fg.data_version else None,
+                'filters': []
+            }
+            result[fg.resulting_cohort_id].append(groups[fg.id])
+
+        q_objs = Q(filter_group__in=list(groups.keys()))
+        if active_only:
+            q_objs &= Q(attribute__active=True)
+        for fltr in Filter.objects.select_related('attribute').filter(q_objs).order_by('id'):
+            flat_dict = fltr.get_filter_flat()
+            flat_dict.update({
+                'id': fltr.attribute.id,
+                'display_name': fltr.attribute.display_name
+            })
+            groups[fltr.filter_group_id]['filters'].append(flat_dict)
+
+        return result
+
+    # Returns {<cohort ID>: <BigQuery-style display string of that cohort's filters>}
+    def get_filter_display_strings(self, prefix=None):
+        cohort_filters = self.get_filters_as_dict()
+        attr_ids = set(
+            x['id'] for groups in cohort_filters.values() for group in groups for x in group['filters']
+        )
+        attr_dvals = Attribute_Display_Values.objects.filter(attribute__id__in=attr_ids).to_dict()
+        ranged_numerics = Attribute.get_ranged_attrs()
+
+        result = {}
+        for cohort_id, groups in cohort_filters.items():
+            filter_sets = []
+            for group in groups:
+                group_filters = {x['name']: {
+                    'values': [attr_dvals.get(x['id'], {}).get(y, y) for y in x['values']], 'op': x['op']
+                } for x in group['filters']}
+                filter_sets.append(BigQuerySupport.build_bq_where_clause(
+                    group_filters, join_with_space=True, field_prefix=prefix, encapsulated=False,
+                    continuous_numerics=ranged_numerics
+                ))
+            result[cohort_id] = " AND ".join(filter_sets).replace("AnatomicRegionSequence", "AnatomicRegion")
+
+        return result
+
+    # Returns {<cohort ID>: <filter groups, per get_filters_as_dict>}, optionally with each value paired with its
+    # display value
+    def get_filters_for_ui(self, with_display_vals=False):
+        cohort_filters = self.get_filters_as_dict()
+
+        if with_display_vals:
+            attr_ids = set(
+                x['id'] for groups in cohort_filters.values() for group in groups for x in group['filters']
+            )
+            attr_dvals = Attribute_Display_Values.objects.filter(attribute__id__in=attr_ids).to_dict()
+            for groups in cohort_filters.values():
+                for group in groups:
+                    for fltr in group['filters']:
+                        fltr['values'] = [{
+                            'value': val, 'display_val': attr_dvals.get(fltr['id'], {}).get(val, val)
+                        } for val in fltr['values']]
+
+        return cohort_filters
+
+    # Returns the IDs of cohorts in this QuerySet which filter on an inactive attribute
+    def with_inactive_attrs(self):
+        return set(Filter.objects.filter(
+            resulting_cohort__in=list(self.values_list('id', flat=True)), attribute__active=False
+        ).values_list('resulting_cohort_id', flat=True))
+
 
 class CohortManager(models.Manager):
     def get_queryset(self):
@@ -67,6 +147,19 @@ class CohortManager(models.Manager):
 
 
 class Cohort(models.Model):
+    STATS_PENDING = 'P'
+    STATS_READY = 'R'
+    STATS_FAILED = 'F'
+    STATS_STATUSES = (
+        (STATS_PENDING, 'Pending'),
+        (STATS_READY, 'Ready'),
+        (STATS_FAILED, 'Failed')
+    )
+    STATS_STATUS_TO_STR = {
+        STATS_PENDING: 'pending',
+        STATS_READY: 'ready',
+        STATS_FAILED: 'failed'
+    }
     id = models.AutoField(primary_key=True)
     name = models.CharField(max_length=255, null=False, blank=True)
     description = models.TextField(null=True, blank=True)
@@ -80,6 +173,15 @@ class Cohort(models.Model):
     study_count = models.IntegerField(blank=False, null=False, default=0)
     total_disk_size = models.PositiveBigIntegerField(blank=False, null=False, default=0)
     collections = models.TextField(blank=False, null=False, default="")
+    stats_status = models.CharField(max_length=1, blank=False, null=False, choices=STATS_STATUSES, default=STATS_READY)
+    stats_attempts = models.PositiveSmallIntegerField(blank=False, null=False, default=0)
+    stats_retry_after = models.DateTimeField(null=True, blank=True)
+
+    def get_stats_status(self):
+        return self.STATS_STATUS_TO_STR[self.stats_status]
+
+    def stats_ready(self):
+        return self.stats_status == self.STATS_READY
 
     # Returns the names only of the collections found in this Cohort
     # Return value is an array of strings
@@ -184,38 +286,10 @@ class Cohort(models.Model):
 
     # Returns a dict of the filters defining this cohort organized by filter group
     def get_filters_as_dict(self, active_only=False):
-        result = []
-
-        filter_groups = self.filter_group_set.all()
-
-        for fg in filter_groups:
-            result.append({
-                'id': fg.id,
-                'data_version': fg.data_version.get_display(),
-                'filters': fg.filter_set.all().get_filter_set_array(active_only)
-            })
-        return result
+        return Cohort.objects.filter(id=self.id).get_filters_as_dict(active_only)[self.id]
 
     def get_filter_display_string(self, prefix=None):
-        filter_groups = self.filter_group_set.all()
-        filter_sets = []
-
-        attr_dvals = Attribute_Display_Values.objects.select_related('attribute').filter(
-            attribute__id__in=Attribute.objects.filter(id__in=self.get_attr_list())
-        ).to_dict()
-
-        ranged_numerics = Attribute.get_ranged_attrs()
-
-        for fg in filter_groups:
-            filters = fg.filter_set.all().get_filter_set_array()
-            group_filters = {x['name']: {'values': [attr_dvals.get(x['id'], {}).get(y, y) for y in x['values']], 'op': x['op']} for x in filters}
-
-            filter_sets.append(BigQuerySupport.build_bq_where_clause(
-                group_filters, join_with_space=True, field_prefix=prefix, encapsulated=False,
-                continuous_numerics=ranged_numerics
-            ))
-
-        return " AND ".join(filter_sets).replace("AnatomicRegionSequence", "AnatomicRegion")
+        return Cohort.objects.filter(id=self.id).get_filter_display_strings(prefix)[self.id]
 
     def get_attrs(self):
         return Attribute.objects.filter(pk__in=self.filter_set.select_related('attribute').all().values_list('attribute'))
@@ -262,21 +336,7 @@ class Cohort(models.Model):
 
     # Returns the set of filters used to create this cohort as a JSON-compatible dict, for use in UI display
     def get_filters_for_ui(self, with_display_vals=False):
-        cohort_filters = self.get_filters_as_dict()
-
-        if with_display_vals:
-            attribute_display_vals = {}
-            for fg in cohort_filters:
-                for filter in fg['filters']:
-                    attr = Attribute.objects.get(filter['id'])
-                    if attr.id not in attribute_display_vals:
-                        attribute_display_vals[attr.id] = attr.get_display_values()
-                    values = filter['values']
-                    filter['values'] = []
-                    for val in values:
-                        filter['values'].append({'value': val, 'display_val': attribute_display_vals[attr.id][val]})
-
-        return cohort_filters
+        return Cohort.objects.filter(id=self.id).get_filters_for_ui(with_display_vals)[self.id]
 
 
 # A 'source' Cohort is a cohort which was used to produce a subsequent cohort, either via cloning or set operations
@@ -306,6 +366,40 @@ class Cohort_Perms(models.Model):
     perm = models.CharField(max_length=10, choices=PERMISSIONS, default=READER)
 
 
+# Stats for a set of filters against a set of data sources. A cohort's filters and data version never change once it's
+# been saved, so these are shared by every cohort (and user) with the same filters and version; see
+# cohorts.utils._get_cohort_stats for how the hash is built.
+class Cohort_Stats(models.Model):
+    filters_hash = models.CharField(max_length=64, null=False, blank=False, unique=True)
+    version = models.CharField(max_length=256, null=False, blank=False)
+    case_count = models.IntegerField(blank=False, null=False, default=0)
+    series_count = models.IntegerField(blank=False, null=False, default=0)
+    study_count = models.IntegerField(blank=False, null=False, default=0)
+    total_disk_size = models.PositiveBigIntegerField(blank=False, null=False, default=0)
+    collections = models.TextField(blank=True, null=False, default="")
+    hits = models.PositiveIntegerField(blank=False, null=False, default=0)
+    date_created = models.DateTimeField(auto_now_add=True)
+
+    def get_stats(self):
+        return {
+            'PatientID': self.case_count,
+            'StudyInstanceUID': self.study_count,
+            'SeriesInstanceUID': self.series_count,
+            'total_instance_size': self.total_disk_size,
+            'collections': self.collections.split("; ") if len(self.collections) else []
+        }
+
+
+# A cohort's membership at one level (series or study) as a compressed UIDBitmap against the UID index of its data
+# version (see idc_collections.uid_index), so set operations on saved cohorts don't need to go back to Solr
+class Cohort_UID_Bitmap(models.Model):
+    cohort = models.ForeignKey(Cohort, null=False, blank=False, on_delete=models.CASCADE)
+    level = models.CharField(max_length=64, null=False, blank=False, default="SeriesInstanceUID")
+    index_key = models.CharField(max_length=256, null=False, blank=False)
+    bitmap = models.BinaryField(null=False, blank=False)
+    date_created = models.DateTimeField(auto_now_add=True)
+
+
 class Filter_Group(models.Model):
     AND = 'A'
     OR = 'O'
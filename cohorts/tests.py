@@ -14,12 +14,22 @@
 # limitations under the License.
 #
 
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase, override_settings, RequestFactory
 from django.contrib.auth.models import AnonymousUser, User
 
-from cohorts.models import Cohort
+from cohorts.models import Cohort, Cohort_Stats
+import os
+import tempfile
+from unittest import mock
+from cohorts.views.views import fetch_user_manifest
+from cohorts.utils_api_v2 import _bulk_cohorts_api, MAX_BULK_COHORTS
+from cohorts.diff_utils import merge_series_diff, ADDED, REMOVED, CHANGED, UNCHANGED
 from idc_collections.models import ImagingDataCommonsVersion, DataSetType,DataSource, DataVersion
-from cohorts.utils import _save_cohort, _delete_cohort, _get_cohort_stats
+from cohorts.utils import _save_cohort, _delete_cohort, _get_cohort_stats, queue_cohort_stats, \
+    process_pending_cohort_stats, get_cohort_stats_cache_counts, get_cohort_list
+from cohorts.decorators import get_api_token_user_id
+from django.core.cache import cache
+from rest_framework.authtoken.models import Token
 
 class ModelTest(TestCase):
     fixtures = ["db.json"]
@@ -81,9 +91,223 @@ class ModelTest(TestCase):
         self.assertEqual(cohortExists, True)
         self.assertEqual(cohort.active, False)
 
+    @override_settings(COHORT_STATS_ASYNC=False)
+    def test_cohort_stats_queue(self):
+        print("Make a cohort with stats computed by the local worker")
+        cohort_info = _save_cohort(self.test_cohort_owner, filters=self.filters4d, name='testd4', desc='Create 4d')
+        self.assertEqual(cohort_info['stats_status'], 'ready')
+        cohort = Cohort.objects.get(id=cohort_info['cohort_id'])
+        self.assertEqual(cohort.stats_status, Cohort.STATS_READY)
+        self.assertEqual(cohort.case_count, 20)
+        self.assertEqual(cohort.series_count, 6690)
 
+        print("Pick up a cohort left pending")
+        Cohort.objects.filter(id=cohort.id).update(stats_status=Cohort.STATS_PENDING, case_count=0)
+        self.assertEqual(process_pending_cohort_stats(), 1)
+        cohort.refresh_from_db()
+        self.assertEqual(cohort.stats_status, Cohort.STATS_READY)
+        self.assertEqual(cohort.case_count, 20)
 
+    @override_settings(COHORT_STATS_ASYNC=False, COHORT_STATS_MAX_ATTEMPTS=2, COHORT_STATS_RETRY_DELAY=60)
+    def test_cohort_stats_retry(self):
+        print("A failed stats computation is retried after a delay, then marked failed")
+        with mock.patch('cohorts.utils._get_cohort_stats', side_effect=Exception("Solr is down")):
+            cohort_info = _save_cohort(self.test_cohort_owner, filters=self.filters4d, name='testd7')
+            cohort = Cohort.objects.get(id=cohort_info['cohort_id'])
+            self.assertEqual(cohort.stats_status, Cohort.STATS_PENDING)
+            self.assertEqual(cohort.stats_attempts, 1)
+            self.assertIsNotNone(cohort.stats_retry_after)
+            # Not due yet
+            self.assertEqual(process_pending_cohort_stats(), 0)
+            Cohort.objects.filter(id=cohort.id).update(stats_retry_after=None)
+            self.assertEqual(process_pending_cohort_stats(), 1)
+            cohort.refresh_from_db()
+            self.assertEqual(cohort.stats_status, Cohort.STATS_FAILED)
+            self.assertEqual(cohort.stats_attempts, 2)
 
+        print("Requeueing starts the attempts over")
+        queue_cohort_stats(cohort.id)
+        cohort.refresh_from_db()
+        self.assertEqual(cohort.stats_status, Cohort.STATS_READY)
+        self.assertEqual(cohort.stats_attempts, 0)
+        self.assertEqual(cohort.case_count, 20)
 
+    def test_cohort_stats_cache(self):
+        print("Two cohorts with the same filters and version share one stats entry")
+        first = _save_cohort(self.test_cohort_owner, filters=self.filters4d, name='testd5', no_stats=True)
+        second = _save_cohort(self.test_cohort_owner, filters=self.filters4d, name='testd6', no_stats=True)
+        before = get_cohort_stats_cache_counts()
+        stats = _get_cohort_stats(cohort_id=first['cohort_id'])
+        self.assertEqual(stats['PatientID'], 20)
+        self.assertEqual(Cohort_Stats.objects.count(), 1)
+        self.assertEqual(_get_cohort_stats(cohort_id=second['cohort_id']), stats)
+        after = get_cohort_stats_cache_counts()
+        self.assertEqual(after['misses'] - before['misses'], 1)
+        self.assertEqual(after['hits'] - before['hits'], 1)
+        self.assertEqual(after['stored_hits'], 1)
+
+    def test_bulk_cohort_filters(self):
+        print("Cohort filters load in a fixed number of queries, however many cohorts there are")
+        cohort_ids = [
+            _save_cohort(self.test_cohort_owner, filters=self.filters4d, name='bulk{}'.format(i), no_stats=True)['cohort_id']
+            for i in range(5)
+        ]
+        cohorts = Cohort.objects.filter(id__in=cohort_ids)
+        # Cohort IDs, filter groups, filters, display values, ranged attributes
+        with self.assertNumQueries(5):
+            display_strings = cohorts.get_filter_display_strings()
+        with self.assertNumQueries(4):
+            ui_filters = cohorts.get_filters_for_ui(with_display_vals=True)
+        self.assertEqual(len(display_strings), 5)
+        cohort = Cohort.objects.get(id=cohort_ids[0])
+        self.assertEqual(display_strings[cohort.id], cohort.get_filter_display_string())
+        self.assertEqual(ui_filters[cohort.id][0]['filters'][0]['values'][0]['value'], '4d_lung')
+
+    def test_merge_series_diff(self):
+        old = [('1.1', 'a'), ('1.2', 'b'), ('1.4', 'd'), ('1.5', 'e')]
+        new = [('1.2', 'b'), ('1.3', 'c'), ('1.4', 'x'), ('1.6', 'f')]
+        self.assertEqual(list(merge_series_diff(iter(old), iter(new))), [
+            (REMOVED, '1.1', 'a', None), (ADDED, '1.3', None, 'c'), (CHANGED, '1.4', 'd', 'x'),
+            (REMOVED, '1.5', 'e', None), (ADDED, '1.6', None, 'f')
+        ])
+        self.assertIn((UNCHANGED, '1.2', 'b', 'b'), list(merge_series_diff(old, new, with_unchanged=True)))
+        with self.assertRaises(Exception):
+            list(merge_series_diff([('1.2', 'b'), ('1.1', 'a')], []))
+
+    @override_settings(BULK_COHORT_WORKERS=1)
+    def test_bulk_cohorts(self):
+        print("Save a batch of cohorts, with a duplicate and an invalid definition")
+        result = _bulk_cohorts_api(self.test_cohort_owner, [
+            {'name': 'bulk_a', 'description': 'a', 'filters': {'collection_id': ['4d_lung']}},
+            {'name': 'bulk_b', 'description': 'b', 'filters': {'collection_id': ['4d_lung']}},
+            {'name': 'bulk_c', 'description': 'c', 'filters': {'not_an_attribute': ['x']}}
+        ])
+        self.assertEqual(result['failed'], 1)
+        self.assertEqual(result['cohorts'][1]['duplicate_of'], 0)
+        self.assertEqual(result['cohorts'][0]['counts']['case_count'], 20)
+        self.assertEqual(result['cohorts'][2]['code'], 400)
+        cohort = Cohort.objects.get(id=result['cohorts'][1]['cohort_id'])
+        self.assertEqual(cohort.case_count, 20)
+        self.assertFalse(Cohort.objects.filter(name='bulk_c').exists())
+
+        print("An oversized batch is rejected outright")
+        result = _bulk_cohorts_api(self.test_cohort_owner, [
+            {'name': 'bulk_{}'.format(i), 'filters': {'collection_id': ['4d_lung']}} for i in range(MAX_BULK_COHORTS+1)
+        ])
+        self.assertEqual(result['code'], 400)
+        self.assertFalse(Cohort.objects.filter(name='bulk_0').exists())
+
+    def test_cohort_list_pages(self):
+        print("Page through a user's cohorts with a cursor")
+        cohort_ids = [
+            _save_cohort(self.test_cohort_owner, filters=self.filters4d, name='list{}'.format(i), no_stats=True)['cohort_id']
+            for i in range(12)
+        ]
+        Cohort.objects.filter(id=cohort_ids[3]).update(active=False)
+        expected = [x for x in cohort_ids if x != cohort_ids[3]]
+
+        page = get_cohort_list(self.test_cohort_owner, fields=['cohort_id', 'counts'], page_size=5)
+        self.assertEqual([x['cohort_id'] for x in page['cohorts']], expected[:5])
+        self.assertEqual(list(page['cohorts'][0].keys()), ['cohort_id', 'counts'])
+        # Page, owners, permissions, cohort IDs, filter groups, filters, data versions
+        with self.assertNumQueries(7):
+            page = get_cohort_list(self.test_cohort_owner, cursor=page['next_cursor'], page_size=5)
+        self.assertEqual([x['cohort_id'] for x in page['cohorts']], expected[5:10])
+        self.assertEqual(page['cohorts'][0]['name'], 'list5')
+        self.assertEqual(page['cohorts'][0]['filterSet']['filters'], {'collection_id': ['4d_lung']})
+        page = get_cohort_list(self.test_cohort_owner, cursor=page['next_cursor'], page_size=5)
+        self.assertEqual([x['cohort_id'] for x in page['cohorts']], expected[10:])
+        self.assertIsNone(page['next_cursor'])
+
+        self.assertEqual([x['cohort_id'] for x in get_cohort_list(self.test_cohort_owner)['cohorts']], expected)
+        with self.assertRaises(Exception):
+            get_cohort_list(self.test_cohort_owner, cursor="not-a-cursor", page_size=5)
+
+    def test_api_token_cache(self):
+        cache.clear()
+        token = Token.objects.create(user=self.test_cohort_owner)
+        with self.assertNumQueries(1):
+            self.assertEqual(get_api_token_user_id(token.key), self.test_cohort_owner.id)
+            self.assertEqual(get_api_token_user_id(token.key), self.test_cohort_owner.id)
+        # Invalid tokens are cached too
+        with self.assertNumQueries(1):
+            self.assertIsNone(get_api_token_user_id("not-a-token"))
+            self.assertIsNone(get_api_token_user_id("not-a-token"))
+        # Revoking a token takes effect immediately
+        token.delete()
+        self.assertIsNone(get_api_token_user_id(token.key))
+        with override_settings(API_TOKEN_CACHE_TTL=0):
+            token = Token.objects.create(user=self.test_cohort_owner)
+            with self.assertNumQueries(2):
+                get_api_token_user_id(token.key)
+                get_api_token_user_id(token.key)
+
+    # Chunked, ranged manifest fetches against the local storage stand-in
+    def test_fetch_user_manifest_ranges(self):
+        manifest_dir = tempfile.mkdtemp()
+        file_name = "test-job/manifest_20240101_120000_aws.s5cmd"
+        content = "".join("cp s3://idc-open-data/{}/* .\n".format(i) for i in range(5000)).encode('utf-8')
+        os.makedirs(os.path.join(manifest_dir, "test-job"))
+        with open(os.path.join(manifest_dir, file_name), "wb") as f:
+            f.write(content)
+
+        factory = RequestFactory()
+        with override_settings(MANIFEST_STORAGE='local', MANIFEST_LOCAL_DIR=manifest_dir, MANIFEST_CHUNK_SIZE=4096):
+            response = fetch_user_manifest(factory.get('/'), file_name)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(b"".join(response.streaming_content), content)
+            etag = response['ETag']
+
+            response = fetch_user_manifest(factory.get('/', HTTP_RANGE='bytes=100-10099'), file_name)
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response['Content-Range'], "bytes 100-10099/{}".format(len(content)))
+            self.assertEqual(b"".join(response.streaming_content), content[100:10100])
+
+            response = fetch_user_manifest(factory.get('/', HTTP_RANGE='bytes=-10'), file_name)
+            self.assertEqual(b"".join(response.streaming_content), content[-10:])
+
+            # With no stored compressed copy, a ranged request is served from the uncompressed file
+            response = fetch_user_manifest(factory.get('/', HTTP_ACCEPT_ENCODING='gzip'), file_name)
+            self.assertEqual((response['Content-Encoding'], response['Accept-Ranges']), ('gzip', 'bytes'))
+            response = fetch_user_manifest(factory.get('/', HTTP_RANGE='bytes=100-199', HTTP_ACCEPT_ENCODING='gzip'),
+                                           file_name)
+            self.assertEqual(response.status_code, 206)
+            self.assertFalse(response.has_header('Content-Encoding'))
+            self.assertEqual(b"".join(response.streaming_content), content[100:200])
+
+            response = fetch_user_manifest(factory.get('/', HTTP_RANGE='bytes=100-', HTTP_IF_RANGE='"stale"'), file_name)
+            self.assertEqual(response.status_code, 200)
+
+            response = fetch_user_manifest(factory.get('/', HTTP_RANGE='bytes={}-'.format(len(content))), file_name)
+            self.assertEqual(response.status_code, 416)
+
+            response = fetch_user_manifest(factory.get('/', HTTP_IF_NONE_MATCH=etag), file_name)
+            self.assertEqual(response.status_code, 304)
+
+            response = fetch_user_manifest(factory.get('/'), "test-job/manifest_20240101_130000_aws.s5cmd")
+            self.assertEqual(response.status_code, 404)
+
+
+# Bulk counts run on worker threads with their own database connections, which can't see data inside a TestCase's
+# transaction
+class BulkCohortWorkersTest(TransactionTestCase):
+    fixtures = ["db.json"]
 
+    def setUp(self):
+        self.test_cohort_owner = User.objects.create_user(username='test_user45', email='test_user_email45@isb-cgc.org',
+                                                          password='itsasecrettoeveryone')
 
+    @override_settings(BULK_COHORT_WORKERS=2)
+    def test_bulk_cohorts_threaded(self):
+        print("Count a batch of cohorts on the worker pool")
+        result = _bulk_cohorts_api(self.test_cohort_owner, [
+            {'name': 'threaded_a', 'filters': {'collection_id': ['4d_lung']}},
+            {'name': 'threaded_b', 'filters': {'collection_id': ['4d_lung', 'not_a_collection']}},
+            {'name': 'threaded_c', 'filters': {'collection_id': ['not_a_collection', '4d_lung']}}
+        ], save=False)
+        self.assertEqual(result['failed'], 0)
+        # Value order doesn't make for a different filter set
+        self.assertEqual(result['cohorts'][2]['duplicate_of'], 1)
+        for cohort in result['cohorts']:
+            self.assertEqual(cohort['counts']['case_count'], 20)
+        self.assertFalse(Cohort.objects.filter(name__startswith='threaded_').exists())
@@ -21,10 +21,13 @@ from . import views
 
 urlpatterns = [
     re_path(r'^$', views.cohorts_list, name='cohort_list'),
-    re_path(r'^manifests/fetch/(?P<file_name>[A-Za-z\-0-9]+\/manifest_(cohort_)?[0-9_]+(aws|gcs|gcp)?\.(s5cmd|json|csv|tsv))', views.fetch_user_manifest, name='fetch_user_manifest'),
-    re_path(r'^manifests/check/(?P<file_name>[A-Za-z\-0-9]+\/manifest_(cohort_)?[0-9_]+(aws|gcs|gcp)?\.(s5cmd|json|csv|tsv))', views.check_manifest_ready, name='check_user_manifest'),
+    re_path(r'^manifests/fetch/(?P<file_name>[A-Za-z\-0-9]+\/(manifest_(cohort_)?[0-9_]+(aws|gcs|gcp)?\.(s5cmd|json|csv|tsv|parquet)|index\.json))', views.fetch_user_manifest, name='fetch_user_manifest'),
+    re_path(r'^manifests/check/(?P<file_name>[A-Za-z\-0-9]+\/(manifest_(cohort_)?[0-9_]+(aws|gcs|gcp)?\.(s5cmd|json|csv|tsv|parquet)|index\.json))', views.check_manifest_ready, name='check_user_manifest'),
     re_path(r'^manifests/fetch/$', views.fetch_user_manifest, name='fetch_user_manifest_base'),
     re_path(r'^manifests/check/$', views.check_manifest_ready, name='check_user_manifest_base'),
+    re_path(r'^manifests/wait/(?P<job_id>[A-Za-z\-0-9]+)/$', views.wait_for_manifest, name='wait_for_manifest'),
+    re_path(r'^manifests/notify/$', views.manifest_file_notification, name='manifest_file_notification'),
+    re_path(r'^manifests/progress/(?P<job_id>[A-Za-z\-0-9]+)/$', views.check_manifest_progress, name='manifest_progress'),
     re_path(r'^api/$', views.views_api_v1.cohort_list_api, name='cohort_list_api'),
     re_path(r'^api/v1/$', views.views_api_v1.cohort_list_api, name='cohort_list_api'),
     re_path(r'^api/v2/$', views.views_api_v2.cohort_list_api, name='cohort_list_api'),
@@ -38,6 +41,7 @@ urlpatterns = [
     re_path(r'^(?P<cohort_id>\d+)/$', views.cohort_detail, name='cohort_details'),
 #    re_path(r'^api/(?P<cohort_id>\d+)/$', views.cohort_detail_api, name='cohort_detail_api'),
     re_path(r'^(?P<cohort_id>\d+)/stats/$', views.get_cohort_stats, name='cohort_stats'),
+    re_path(r'^(?P<cohort_id>\d+)/diff/$', views.get_cohort_diff, name='cohort_diff'),
 
 #    re_path(r'^api/(?P<cohort_id>\d+)/$', views.cohort_detail_api, name='cohort_detail_api'),
     re_path(r'^api/(?P<cohort_id>\d+)/manifest/$', views.views_api_v1.cohort_manifest_api, name='cohort_manifest_api'),
@@ -50,6 +54,8 @@ urlpatterns = [
     re_path(r'^api/save_cohort/', views.views_api_v1.save_cohort_api, name='save_cohort_api'),
     re_path(r'^api/v1/save_cohort/', views.views_api_v1.save_cohort_api, name='save_cohort_api'),
     re_path(r'^api/v2/save_cohort/', views.views_api_v2.save_cohort_api, name='save_cohort_api'),
+    re_path(r'^api/v2/bulk/save_cohort/', views.views_api_v2.bulk_save_cohort_api, name='bulk_save_cohort_api'),
+    re_path(r'^api/v2/bulk/preview/', views.views_api_v2.bulk_preview_cohort_api, name='bulk_preview_cohort_api'),
     re_path(r'^delete_cohort/', views.delete_cohort, name='delete_cohort'),
     re_path(r'^api/delete_cohort/', views.views_api_v1.delete_cohort_api, name='delete_cohort_api'),
     re_path(r'^api/v1/delete_cohort/', views.views_api_v1.delete_cohort_api, name='delete_cohort_api'),
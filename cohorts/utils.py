@@ -23,24 +23,103 @@ from builtins import object
 
 import re
 import time
+import json
+import hashlib
+import operator
+import base64
+from functools import reduce
 from time import sleep
 import logging
 import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
-from .models import Cohort, Cohort_Perms, Filter, Filter_Group
-from idc_collections.models import Program, Attribute, ImagingDataCommonsVersion, DataSourceJoin
+from django.db import connection, transaction
+from django.db.models import F, Q, Sum
+from django.utils import timezone
+from .models import Cohort, Cohort_Perms, Cohort_Stats, Cohort_UID_Bitmap, Filter, Filter_Group
+from idc_collections.models import Program, Attribute, ImagingDataCommonsVersion
 from google_helpers.bigquery.cohort_support import BigQueryCohortSupport
 from google_helpers.bigquery.bq_support import BigQuerySupport
-from idc_collections.collex_metadata_utils import get_collex_metadata, filter_manifest
+from idc_collections.collex_metadata_utils import get_collex_metadata, filter_manifest, build_solr_join_query
+from idc_collections.uid_index import UIDBitmap, get_uid_index, filters_bitmap, cart_bitmap
 from idc_collections.models import DataSetType,DataSource
+from metrics_helpers import histogram
 
 logger = logging.getLogger(__name__)
+
+COHORT_STATS_SECONDS = histogram('idc_cohort_stats_seconds', "Time to compute and store a cohort's stats")
+COHORT_BITMAP_SECONDS = histogram(
+    'idc_cohort_bitmap_seconds', "Time to build and store a cohort's membership bitmap, by level", ['level'])
 DENYLIST_RE = settings.DENYLIST_RE
 
+# Cohort stats are computed off of the request thread by a small pool of workers: cohorts are saved with a pending
+# stats status, and updated once their stats are in. Anything left pending (eg. by an instance restart) can be
+# picked up with process_pending_cohort_stats.
+#
+# A failed computation is retried up to COHORT_STATS_MAX_ATTEMPTS times in all, waiting COHORT_STATS_RETRY_DELAY
+# seconds before the first retry and doubling the wait each time after. The cohort stays pending until it's out of
+# attempts, and is then marked failed.
+COHORT_STATS_MAX_ATTEMPTS = 3
+COHORT_STATS_RETRY_DELAY = 30
+COHORT_STATS_WORKERS = None
+COHORT_STATS_WORKERS_LOCK = threading.Lock()
+
+# Hits and misses on the Cohort_Stats cache by this process
+COHORT_STATS_CACHE_COUNTS = {'hits': 0, 'misses': 0}
+COHORT_STATS_CACHE_LOCK = threading.Lock()
+
+
+# Filters which take a range or comparison, keyed on their attribute name's suffix; their values are order-sensitive
+RANGE_FILTER_RE = re.compile(r'_(ebtwe|ebtw|btwe|btw|gte|gt|lte|lt|eq)$')
+
+
+def _canonical_value_list(attr, values):
+    if RANGE_FILTER_RE.search(str(attr)):
+        return [str(x) for x in values]
+    return sorted(str(x) for x in values)
+
+
+def _canonical_stats_filters(filters):
+    canonical = {}
+    for attr, values in filters.items():
+        if isinstance(values, dict):
+            canonical[str(attr)] = dict(values, values=_canonical_value_list(attr, values.get('values', [])))
+        else:
+            canonical[str(attr)] = _canonical_value_list(attr, values if isinstance(values, list) else [values])
+    return canonical
+
+
+# Canonical hash of a set of filters against a set of data sources and IDC versions. Neither attribute order nor the
+# order of a categorical filter's values matter, as with manifest cache keys; range and comparison values keep their
+# order.
+def _cohort_stats_hash(filters, sources, versions):
+    key = json.dumps({
+        'filters': _canonical_stats_filters(filters),
+        'sources': sorted(sources.values_list('id', flat=True)),
+        'versions': sorted(versions)
+    }, sort_keys=True, default=str)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
 
-def _get_cohort_stats(cohort_id=0, filters=None, sources=None):
+
+def _count_cohort_stats_cache(hit):
+    with COHORT_STATS_CACHE_LOCK:
+        COHORT_STATS_CACHE_COUNTS['hits' if hit else 'misses'] += 1
+
+
+# Hit/miss counts for the cohort stats cache, for this process and across all processes (stored_hits)
+def get_cohort_stats_cache_counts():
+    counts = dict(COHORT_STATS_CACHE_COUNTS)
+    lookups = counts['hits'] + counts['misses']
+    counts['hit_rate'] = (counts['hits'] / lookups) if lookups else 0.0
+    counts['entries'] = Cohort_Stats.objects.count()
+    counts['stored_hits'] = Cohort_Stats.objects.aggregate(Sum('hits'))['hits__sum'] or 0
+    return counts
+
+
+def _get_cohort_stats(cohort_id=0, filters=None, sources=None, raise_errors=False, use_cache=True):
     stats = {
         'PatientID': 0,
         'StudyInstanceUID': 0,
@@ -68,6 +147,17 @@ def _get_cohort_stats(cohort_id=0, filters=None, sources=None):
                 source_type=DataSource.SOLR, aggregate_level="StudyInstanceUID"
             ))
 
+        stats_hash = None
+        if use_cache:
+            versions = (cohort.get_data_versions() if cohort_id else ImagingDataCommonsVersion.objects.filter(
+                active=True)).values_list('version_number', flat=True)
+            stats_hash = _cohort_stats_hash(filters, sources, versions)
+            cached = Cohort_Stats.objects.filter(filters_hash=stats_hash).first()
+            _count_cohort_stats_cache(cached is not None)
+            if cached:
+                Cohort_Stats.objects.filter(id=cached.id).update(hits=F('hits')+1)
+                return cached.get_stats()
+
         totals = ["PatientID", "StudyInstanceUID", "SeriesInstanceUID"]
         custom_facets = {
             'instance_size': 'sum(instance_size)'
@@ -87,13 +177,118 @@ def _get_cohort_stats(cohort_id=0, filters=None, sources=None):
             for total in totals:
                 stats[total] = 0
 
+        # Only store a result Solr actually returned; an error leaves no total behind
+        if stats_hash and 'total' in result:
+            Cohort_Stats.objects.get_or_create(filters_hash=stats_hash, defaults={
+                'version': "; ".join(sorted(versions)),
+                'case_count': stats['PatientID'],
+                'study_count': stats['StudyInstanceUID'],
+                'series_count': stats['SeriesInstanceUID'],
+                'total_disk_size': stats['total_instance_size'],
+                'collections': "; ".join(stats['collections'])
+            })
+
     except Exception as e:
+        if raise_errors:
+            raise
         logger.error("[ERROR] While fetching cohort stats:")
         logger.exception(e)
 
     return stats
 
 
+def _get_stats_workers():
+    global COHORT_STATS_WORKERS
+    with COHORT_STATS_WORKERS_LOCK:
+        if COHORT_STATS_WORKERS is None:
+            COHORT_STATS_WORKERS = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'COHORT_STATS_WORKERS', 2), thread_name_prefix="cohort_stats"
+            )
+    return COHORT_STATS_WORKERS
+
+
+# Compute and store the stats for a single cohort, marking it ready, or failed once it's out of attempts. Returns
+# the number of seconds to wait before retrying, or None if there's nothing to retry.
+def _update_cohort_stats(cohort_id):
+    try:
+        start = time.time()
+        cohort_stats = _get_cohort_stats(cohort_id, raise_errors=True)
+        Cohort.objects.filter(id=cohort_id).update(
+            case_count=cohort_stats['PatientID'],
+            series_count=cohort_stats['SeriesInstanceUID'],
+            study_count=cohort_stats['StudyInstanceUID'],
+            total_disk_size=cohort_stats['total_instance_size'],
+            collections="; ".join(cohort_stats['collections']),
+            stats_status=Cohort.STATS_READY,
+            stats_attempts=0,
+            stats_retry_after=None
+        )
+        stop = time.time()
+        COHORT_STATS_SECONDS.observe(stop-start)
+    except Exception as e:
+        logger.error("[ERROR] While computing stats for cohort {}:".format(cohort_id))
+        logger.exception(e)
+        return _fail_cohort_stats(cohort_id)
+    return None
+
+
+# Record a failed attempt at a cohort's stats, scheduling a retry if it has attempts left
+def _fail_cohort_stats(cohort_id):
+    attempts = (Cohort.objects.filter(id=cohort_id).values_list('stats_attempts', flat=True).first() or 0) + 1
+    if attempts >= getattr(settings, 'COHORT_STATS_MAX_ATTEMPTS', COHORT_STATS_MAX_ATTEMPTS):
+        logger.warning("[WARNING] Stats for cohort {} failed after {} attempt(s); giving up.".format(cohort_id, attempts))
+        Cohort.objects.filter(id=cohort_id).update(
+            stats_status=Cohort.STATS_FAILED, stats_attempts=attempts, stats_retry_after=None
+        )
+        return None
+    delay = getattr(settings, 'COHORT_STATS_RETRY_DELAY', COHORT_STATS_RETRY_DELAY) * (2 ** (attempts - 1))
+    Cohort.objects.filter(id=cohort_id).update(
+        stats_status=Cohort.STATS_PENDING, stats_attempts=attempts,
+        stats_retry_after=timezone.now() + datetime.timedelta(seconds=delay)
+    )
+    return delay
+
+
+def _run_cohort_stats_job(cohort_id):
+    try:
+        retry_delay = _update_cohort_stats(cohort_id)
+    finally:
+        # Worker threads hold their own database connection; don't leave it open between jobs
+        connection.close()
+    if retry_delay is not None:
+        timer = threading.Timer(retry_delay, lambda: _get_stats_workers().submit(_run_cohort_stats_job, cohort_id))
+        timer.daemon = True
+        timer.start()
+
+
+# Queue a cohort's stats for computation. If COHORT_STATS_ASYNC is False (eg. for testing) the stats are computed
+# immediately, on the calling thread.
+def queue_cohort_stats(cohort_id):
+    Cohort.objects.filter(id=cohort_id).update(
+        stats_status=Cohort.STATS_PENDING, stats_attempts=0, stats_retry_after=None
+    )
+    if not getattr(settings, 'COHORT_STATS_ASYNC', True):
+        _update_cohort_stats(cohort_id)
+        return
+    # The worker can't see the cohort or its filters until they've been committed, so hold the job until then
+    transaction.on_commit(lambda: _get_stats_workers().submit(_run_cohort_stats_job, cohort_id))
+
+
+# Compute stats for any cohorts which are still pending and not waiting out a retry delay, oldest first; returns the
+# number of cohorts processed
+def process_pending_cohort_stats(limit=None):
+    pending = Cohort.objects.filter(
+        Q(stats_retry_after__isnull=True) | Q(stats_retry_after__lte=timezone.now()),
+        active=True, stats_status=Cohort.STATS_PENDING
+    ).order_by('id').values_list('id', flat=True)
+    if limit:
+        pending = pending[:limit]
+    pending = list(pending)
+    for cohort_id in pending:
+        _update_cohort_stats(cohort_id)
+    return len(pending)
+
+
 def _delete_cohort(user, cohort_id):
     cohort_info = None
     cohort = None
@@ -232,13 +427,8 @@ def _save_cohort(user, filters=None, name=None, cohort_id=None, version=None, de
 
         # For backwards compatibility with v1 cohorts
         if not no_stats:
-            cohort_stats = _get_cohort_stats(cohort.id)
-            cohort.case_count = cohort_stats['PatientID']
-            cohort.series_count = cohort_stats['SeriesInstanceUID']
-            cohort.study_count = cohort_stats['StudyInstanceUID']
-            cohort.total_disk_size = cohort_stats['total_instance_size']
-            cohort.collections = "; ".join(cohort_stats['collections'])
-            cohort.save()
+            queue_cohort_stats(cohort.id)
+            cohort.refresh_from_db(fields=['stats_status'])
 
         cohort_info = {
             'cohort_id': cohort.id,
@@ -246,6 +436,8 @@ def _save_cohort(user, filters=None, name=None, cohort_id=None, version=None, de
             "description": cohort.description,
             "filters": grouping.get_filter_set()
         }
+        if not no_stats:
+            cohort_info['stats_status'] = cohort.get_stats_status()
     except Exception as e:
         logger.error("[ERROR] While saving a cohort: ")
         logger.exception(e)
@@ -257,6 +449,156 @@ def _save_cohort(user, filters=None, name=None, cohort_id=None, version=None, de
     return cohort_info
 
 
+# Fields which can be requested from the cohort list APIs, and those returned if none are specified
+COHORT_LIST_FIELDS = ["cohort_id", "name", "description", "owner", "permission", "filterSet", "counts"]
+DEFAULT_COHORT_LIST_FIELDS = ["cohort_id", "name", "description", "owner", "permission", "filterSet"]
+MAX_COHORT_LIST_PAGE = 1000
+
+
+def _encode_cohort_cursor(last_id):
+    return base64.urlsafe_b64encode(json.dumps({'id': last_id}).encode('utf-8')).decode('utf-8')
+
+
+def _decode_cohort_cursor(cursor):
+    try:
+        return int(json.loads(base64.urlsafe_b64decode(cursor.encode('utf-8')).decode('utf-8'))['id'])
+    except Exception:
+        raise Exception("Invalid cursor: {}".format(cursor))
+
+
+# Fetch one page of the active cohorts a user has access to, in ascending ID order, for the cohort list APIs.
+#
+# fields: the subset of COHORT_LIST_FIELDS to return for each cohort (default: DEFAULT_COHORT_LIST_FIELDS)
+# cursor: the next_cursor of the previous page
+# page_size: cohorts per page, up to MAX_COHORT_LIST_PAGE; if not provided, all cohorts are returned in one page
+#
+# Owners, permissions, and filters are each loaded in a single query for the whole page.
+# Returns {'cohorts': [{<field>: <value>, ...}, ...], 'next_cursor': <String, or None if this is the last page>}
+def get_cohort_list(user, fields=None, cursor=None, page_size=None):
+    fields = fields or DEFAULT_COHORT_LIST_FIELDS
+    unknown = [x for x in fields if x not in COHORT_LIST_FIELDS]
+    if len(unknown):
+        raise Exception("Unrecognized cohort list fields: {}".format(", ".join(unknown)))
+
+    cohorts = Cohort.objects.filter(active=True, cohort_perms__user=user).distinct().order_by('id').only(
+        'id', 'name', 'description', 'case_count', 'study_count', 'series_count'
+    )
+    if cursor:
+        cohorts = cohorts.filter(id__gt=_decode_cohort_cursor(cursor))
+    next_cursor = None
+    if page_size:
+        page_size = min(int(page_size), MAX_COHORT_LIST_PAGE)
+        page = list(cohorts[:page_size+1])
+        if len(page) > page_size:
+            page = page[:page_size]
+            next_cursor = _encode_cohort_cursor(page[-1].id)
+    else:
+        page = list(cohorts)
+    cohort_ids = [x.id for x in page]
+
+    owners = {}
+    if 'owner' in fields:
+        owners = {x.cohort_id: x.user for x in Cohort_Perms.objects.select_related('user').filter(
+            cohort_id__in=cohort_ids, perm=Cohort_Perms.OWNER)}
+    perms = {}
+    if 'permission' in fields:
+        # Ordered so that the highest permission a user holds is the one kept
+        for cohort_id, perm in Cohort_Perms.objects.filter(cohort_id__in=cohort_ids, user=user).order_by(
+                '-perm').values_list('cohort_id', 'perm'):
+            perms[cohort_id] = perm
+    filters = {}
+    versions = {}
+    if 'filterSet' in fields:
+        filters = Cohort.objects.filter(id__in=cohort_ids).get_filters_as_dict()
+        for cohort_id, version_number in Filter_Group.objects.filter(resulting_cohort_id__in=cohort_ids).order_by(
+                '-id').values_list('resulting_cohort_id', 'data_version__version_number'):
+            versions[cohort_id] = version_number
+
+    cohort_list = []
+    for cohort in page:
+        cohort_info = {}
+        for field in fields:
+            if field == 'cohort_id':
+                cohort_info['cohort_id'] = cohort.id
+            elif field == 'name':
+                cohort_info['name'] = cohort.name
+            elif field == 'description':
+                cohort_info['description'] = cohort.description
+            elif field == 'owner':
+                owner = owners.get(cohort.id, None)
+                cohort_info['owner'] = "{} {}".format(owner.first_name, owner.last_name) if owner else None
+            elif field == 'permission':
+                cohort_info['permission'] = perms.get(cohort.id, None)
+            elif field == 'filterSet':
+                groups = filters.get(cohort.id, [])
+                cohort_info['filterSet'] = {
+                    'idc_data_version': versions.get(cohort.id, None),
+                    'filters': {x['name']: x['values'] for x in groups[0]['filters']} if len(groups) else {}
+                }
+            elif field == 'counts':
+                cohort_info['counts'] = {
+                    'case_count': cohort.case_count,
+                    'study_count': cohort.study_count,
+                    'series_count': cohort.series_count
+                }
+        cohort_list.append(cohort_info)
+
+    return {'cohorts': cohort_list, 'next_cursor': next_cursor}
+
+
+COHORT_SET_OPS = {
+    'union': operator.or_,
+    'intersect': operator.and_,
+    'difference': operator.sub
+}
+
+
+# Fetch a cohort's membership at the given level as a UIDBitmap. The first request for a cohort queries Solr; the
+# result is stored with the cohort, and later requests are served from the stored bitmap.
+def get_cohort_bitmap(cohort, level="SeriesInstanceUID"):
+    versions = cohort.get_data_versions()
+    index = get_uid_index(versions, level)
+
+    stored = Cohort_UID_Bitmap.objects.filter(cohort=cohort, level=level, index_key=index.key).first()
+    if stored:
+        return UIDBitmap.from_bytes(bytes(stored.bitmap), index.key)
+
+    start = time.time()
+    sources = cohort.get_data_sources(aggregate_level=level)
+    filters = {x['name']: x['values'] for x in cohort.get_filters_as_dict()[0]['filters']}
+    bitmap = filters_bitmap(filters, sources, versions, level)
+    Cohort_UID_Bitmap.objects.get_or_create(cohort=cohort, level=level, index_key=index.key, defaults={
+        'bitmap': bitmap.to_bytes()
+    })
+    stop = time.time()
+    COHORT_BITMAP_SECONDS.observe(stop-start, level=level)
+    return bitmap
+
+
+# Combine the memberships of two or more cohorts, in order, with 'union', 'intersect', or 'difference'.
+# Returns a UIDBitmap; use the UID index to resolve it back to UIDs.
+def cohort_set_operation(op, cohorts, level="SeriesInstanceUID"):
+    if op not in COHORT_SET_OPS:
+        raise Exception("Unrecognized cohort set operation: {}".format(op))
+    if len(cohorts) < 2:
+        raise Exception("A set operation requires at least two cohorts.")
+    # Bitmaps from different data versions can't be combined; UIDBitmap raises a ValueError if that's attempted
+    return reduce(COHORT_SET_OPS[op], [get_cohort_bitmap(cohort, level) for cohort in cohorts])
+
+
+# Series counts for a cohort compared to a cart (as described by its filter groups and partitions)
+def compare_cohort_to_cart(cohort, filtergrp_list, partitions):
+    cohort_series = get_cohort_bitmap(cohort)
+    cart_series = cart_bitmap(filtergrp_list, partitions)
+    return {
+        'cohort': len(cohort_series),
+        'cart': len(cart_series),
+        'both': len(cohort_series & cart_series),
+        'cohort_only': len(cohort_series - cart_series),
+        'cart_only': len(cart_series - cohort_series)
+    }
+
+
 # Get the various UUIDs for a given cohort
 def get_cohort_uuids(cohort_id):
     result = {}
@@ -330,14 +672,8 @@ def get_uuids_solr(filters_by_collex=None, fields_by_collex=None, comb_mut_filte
             filters_by_collex[solr_collex]['joins'] = {}
             for other_collex in filters_by_collex:
                 if other_collex != solr_collex:
-                    source_join = DataSourceJoin.objects.get(
-                        from_src__in=[filters_by_collex[other_collex]['source'].id, filters_by_collex[solr_collex]['source'].id],
-                        to_src__in=[filters_by_collex[other_collex]['source'].id, filters_by_collex[solr_collex]['source'].id]
-                    )
-                    filters_by_collex[other_collex]['joins'][solr_collex] = "{!join %s}" % "from={} fromIndex={} to={}".format(
-                        source_join.get_col(filters_by_collex[other_collex]['source'].name),
-                        filters_by_collex[other_collex]['source'].name,
-                        source_join.get_col(filters_by_collex[solr_collex]['source'].name)
+                    filters_by_collex[other_collex]['joins'][solr_collex] = build_solr_join_query(
+                        filters_by_collex[other_collex]['source'], filters_by_collex[solr_collex]['source'], ""
                     )
 
         solr_result = {}
@@ -17,16 +17,25 @@ from __future__ import absolute_import
 
 import logging
 import copy
+import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 
 from django.conf import settings
-from idc_collections.models import ImagingDataCommonsVersion
+from django.db import connection
+from idc_collections.models import ImagingDataCommonsVersion, Attribute, DataSource
 from idc_collections.collex_metadata_utils import get_bq_metadata, get_bq_string
+from cohorts.models import Cohort, Filter
+from cohorts.utils import _save_cohort, _get_cohort_stats, _canonical_stats_filters
 
 logger = logging.getLogger(__name__)
 DENYLIST_RE = settings.DENYLIST_RE
 
 NUMERIC_OPS = ('_btw', '_ebtw', '_btwe', '_ebtwe', '_gte', '_lte', '_gt', '_lt', '_eq')
 
+# Most cohort definitions accepted by a single bulk request
+MAX_BULK_COHORTS = 500
+
 # All the filter values in the filterSet of a cohort are saved as strings. Particularly, a
 # filter value like [[35,45], [65,75]] is returned as ["[35,45]","[65,75]"] when you get
 # the filterSet. This script converts it back to numeric.
@@ -121,8 +130,158 @@ def get_query_query(filters, fields, data_version, info, sql):
     return info
 
 
+# Convert a v2 API filter set into the attribute ID-keyed form _save_cohort takes
+# attr_ids: {<attribute name>: <attribute ID>} for the active attributes
+# Returns the converted filters and a list of any filter names which didn't match an active attribute
+def _api_filters_by_id(filters, attr_ids):
+    filters_by_id = {}
+    unknown = []
+    for filter, value in filters.items():
+        attr_name = filter.rsplit('_', 1)[0] if filter.endswith(NUMERIC_OPS) else filter
+        if attr_name not in attr_ids:
+            unknown.append(filter)
+            continue
+        if filter.endswith(NUMERIC_OPS):
+            value = {'op': filter.rsplit('_', 1)[-1].upper(), 'values': value}
+        filters_by_id[str(attr_ids[attr_name])] = value
+    return filters_by_id, unknown
+
+
+# The name-keyed filter set a cohort saved with filters_by_id will report (see Filter.get_filter), so a count made
+# from it matches the stats computed later from the saved cohort
+# attrs: {<attribute ID>: {'name': <attribute name>, 'data_type': <attribute data type>}}
+def _saved_filter_set(filters_by_id, attrs):
+    filters = {}
+    for attr_id, value in filters_by_id.items():
+        attr = attrs[int(attr_id)]
+        op = Filter.OR if attr['data_type'] != Attribute.CONTINUOUS_NUMERIC else Filter.BTW
+        if type(value) is dict:
+            op = Filter.STR_TO_OP.get(value['op'], op)
+            value = value['values']
+        filters["{}{}".format(attr['name'], Filter.OP_TO_SUFFIX[op] if op in Filter.NUMERIC_OPS else "")] = value
+    return filters
+
 
+def _bulk_cohort_count(filters):
+    sources = Attribute.objects.filter(
+        name__in=[x.rsplit('_', 1)[0] if x.endswith(NUMERIC_OPS) else x for x in filters]
+    ).get_data_sources(
+        ImagingDataCommonsVersion.objects.filter(active=True), source_type=DataSource.SOLR, active=True,
+        aggregate_level=["case_barcode", "StudyInstanceUID", "sample_barcode"]
+    )
+    return _get_cohort_stats(0, filters, sources, raise_errors=True)
 
 
+def _bulk_cohort_count_job(filters):
+    try:
+        return _bulk_cohort_count(filters)
+    finally:
+        # Worker threads hold their own database connection; don't leave it open
+        connection.close()
 
 
+# Validate, count, and optionally save a batch of v2 API cohort definitions
+# ([{'name': <String>, 'description': <String>, 'filters': {...}}, ...]). Identical filter sets are counted once, and
+# counts are run in parallel, up to BULK_COHORT_WORKERS at a time. A definition which fails doesn't stop the others;
+# each gets its own result, with a 'message' and 'code' if it failed.
+def _bulk_cohorts_api(user, cohort_defs, save=True):
+    if len(cohort_defs) > MAX_BULK_COHORTS:
+        return {
+            'message': "A maximum of {} cohorts can be submitted at once; {} were received.".format(
+                MAX_BULK_COHORTS, len(cohort_defs)),
+            'code': 400
+        }
+
+    version = get_idc_data_version()
+    results = []
+
+    # Validate every definition against the attribute registry with a single lookup
+    attr_names = set()
+    for cohort_def in cohort_defs:
+        for filter in (cohort_def.get('filters', None) or {}):
+            attr_names.add(filter.rsplit('_', 1)[0] if filter.endswith(NUMERIC_OPS) else filter)
+    attrs = {x['id']: x for x in Attribute.objects.filter(
+        name__in=list(attr_names), active=True).values('id', 'name', 'data_type')}
+    attr_ids = {x['name']: x['id'] for x in attrs.values()}
+
+    filter_sets = {}
+    for i, cohort_def in enumerate(cohort_defs):
+        result = {'index': i, 'name': cohort_def.get('name', None), 'description': cohort_def.get('description', None)}
+        results.append(result)
+        filters = copy.deepcopy(cohort_def.get('filters', None) or {})
+        if not len(filters):
+            result.update({'message': "No filters were provided for this cohort.", 'code': 400})
+            continue
+        if 'collection_id' in filters:
+            filters['collection_id'] = [
+                collection.lower().replace('-', '_').replace(' ', '_') for collection in filters['collection_id']
+            ]
+        filters_by_id, unknown = _api_filters_by_id(filters, attr_ids)
+        if len(unknown):
+            result.update({'message': "Unrecognized filters: {}".format(", ".join(unknown)), 'code': 400})
+            continue
+        result['filterSet'] = {'idc_data_version': version.version_number, 'filters': cohort_def['filters']}
+        result['_filters_by_id'] = filters_by_id
+        saved_filters = _saved_filter_set(filters_by_id, attrs)
+        # Definitions with identical filters share one count, whatever order their values were given in
+        filter_hash = hashlib.sha256(json.dumps(
+            _canonical_stats_filters(saved_filters), sort_keys=True, default=str).encode('utf-8')).hexdigest()
+        if filter_hash in filter_sets:
+            result['duplicate_of'] = filter_sets[filter_hash]['index']
+        else:
+            filter_sets[filter_hash] = {'index': i, 'filters': saved_filters}
+        result['_hash'] = filter_hash
+
+    counts = {}
+    workers = getattr(settings, 'BULK_COHORT_WORKERS', 4)
+    if workers > 1 and len(filter_sets) > 1:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bulk_cohort") as pool:
+            futures = {x: pool.submit(_bulk_cohort_count_job, y['filters']) for x, y in filter_sets.items()}
+        for filter_hash, future in futures.items():
+            try:
+                counts[filter_hash] = future.result()
+            except Exception as e:
+                logger.error("[ERROR] While counting bulk cohort filters:")
+                logger.exception(e)
+                counts[filter_hash] = None
+    else:
+        for filter_hash, filter_set in filter_sets.items():
+            try:
+                counts[filter_hash] = _bulk_cohort_count(filter_set['filters'])
+            except Exception as e:
+                logger.error("[ERROR] While counting bulk cohort filters:")
+                logger.exception(e)
+                counts[filter_hash] = None
+
+    for result in results:
+        if 'code' in result:
+            continue
+        filters_by_id = result.pop('_filters_by_id')
+        stats = counts[result.pop('_hash')]
+        if stats is None:
+            result.update({'message': "There was an error while counting this cohort.", 'code': 500})
+            continue
+        result['counts'] = {
+            'case_count': stats['PatientID'],
+            'study_count': stats['StudyInstanceUID'],
+            'series_count': stats['SeriesInstanceUID'],
+            'total_disk_size': stats['total_instance_size']
+        }
+        if save:
+            saved = _save_cohort(user, filters=filters_by_id, name=result['name'], desc=result['description'],
+                                 version=version, no_stats=True)
+            if 'message' in saved:
+                result.update({'message': saved['message'], 'code': 400})
+                continue
+            # The counts were just computed from the filters as saved, so there's nothing left for the stats job to do
+            Cohort.objects.filter(id=saved['cohort_id']).update(
+                case_count=stats['PatientID'], study_count=stats['StudyInstanceUID'],
+                series_count=stats['SeriesInstanceUID'], total_disk_size=stats['total_instance_size'],
+                collections="; ".join(stats['collections']), stats_status=Cohort.STATS_READY
+            )
+            result['cohort_id'] = saved['cohort_id']
+
+    return {
+        'cohorts': results,
+        'failed': len([x for x in results if 'code' in x])
+    }
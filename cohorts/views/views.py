@@ -34,6 +34,7 @@ import datetime
 import time
 import logging
 import math
+import hmac
 
 import django
 from request_logging.decorators import no_logging
@@ -41,7 +42,6 @@ from google_helpers.bigquery.cohort_support import BigQuerySupport
 from google_helpers.bigquery.cohort_support import BigQueryCohortSupport
 from google_helpers.bigquery.export_support import BigQueryExportFileList, FILE_LIST_EXPORT_SCHEMA
 from google_helpers.stackdriver import StackDriverLogger
-from google.cloud import storage
 from google.auth import jwt
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
@@ -57,15 +57,21 @@ from django.http import StreamingHttpResponse
 from django.shortcuts import render, redirect
 from django.template.loader import get_template
 from django.views.decorators.cache import never_cache, cache_page
+from django.utils.cache import add_never_cache_headers
 from django.utils import formats
 from django.views.decorators.csrf import csrf_protect, csrf_exempt
 from django.utils.html import escape
 
 from cohorts.models import Cohort, Cohort_Perms, Source, Filter, Cohort_Comments
 from cohorts.utils import _save_cohort, _delete_cohort, _get_cohort_stats
+from cohorts.diff_utils import cohort_diff, cohort_diff_summary
+from idc_collections.manifest_jobs import manifest_progress, get_manifest_job_status, wait_for_manifest_job, \
+    mark_manifest_file_ready, get_manifest_storage, get_manifest_chunk_size, parse_range_header, \
+    MANIFEST_WAIT_TIMEOUT
+from idc_collections.compression import negotiate_encoding, compress_response, COMPRESSION_EXTENSIONS
 from idc_collections.models import Program, Collection, DataSource, DataVersion, ImagingDataCommonsVersion, Attribute
 from idc_collections.collex_metadata_utils import build_explorer_context, get_bq_metadata, get_bq_string, \
-    create_file_manifest, build_static_map, STATIC_EXPORT_FIELDS
+    create_file_manifest, build_static_map, STATIC_EXPORT_FIELDS, Echo
 
 MAX_FILE_LIST_ENTRIES = settings.MAX_FILE_LIST_REQUEST
 COHORT_CREATION_LOG_NAME = settings.COHORT_CREATION_LOG_NAME
@@ -102,30 +108,131 @@ def convert(data):
 def check_manifest_ready(request, file_name=None):
     if not file_name:
         return JsonResponse({"manifest_ready": False, "message": "invalid request"},status=400)
-    # WJRL 4/25/25: use default app credentials:
-    client = storage.Client()
-    ##client = storage.Client.from_service_account_json(settings.GOOGLE_APPLICATION_CREDENTIALS)
-    bucket = client.get_bucket(settings.RESULT_BUCKET)
-    blob = bucket.blob("{}/{}".format(settings.USER_MANIFESTS_FOLDER, file_name))
+    # Registered jobs are answered from the job registry; only jobs which predate it need a bucket lookup
+    status = get_manifest_job_status(file_name.split("/")[0])
+    if status:
+        return JsonResponse({"manifest_ready": status['manifest_ready'], "status": status['status']}, status=200)
+    return JsonResponse({"manifest_ready": bool(get_manifest_storage().stat(file_name))}, status=200)
 
-    return JsonResponse({"manifest_ready": blob.exists()}, status=200)
+
+# Long-poll for a manifest job: responds as soon as the job is ready (or fails), or once the requested timeout (capped
+# at MANIFEST_WAIT_TIMEOUT seconds) passes, after which the client simply asks again
+@never_cache
+def wait_for_manifest(request, job_id=None):
+    try:
+        timeout = float(request.GET.get('timeout', MANIFEST_WAIT_TIMEOUT))
+        status = wait_for_manifest_job(job_id, timeout)
+        if not status:
+            return JsonResponse({"manifest_ready": False, "message": "No manifest job found with ID {}.".format(job_id)},
+                                status=404)
+        return JsonResponse(status, status=200)
+    except Exception as e:
+        logger.error("[ERROR] While waiting on manifest job {}:".format(job_id))
+        logger.exception(e)
+        return JsonResponse({"manifest_ready": False, "message": "There was an error checking this manifest's status."},
+                            status=500)
+
+
+# Receives Pub/Sub push notifications of manifest files being written to the results bucket (from the bucket's
+# OBJECT_FINALIZE notifications), and marks them ready in the job registry. The push subscription's endpoint must
+# include MANIFEST_NOTIFY_TOKEN as its 'token' parameter.
+@csrf_exempt
+def manifest_file_notification(request):
+    token = getattr(settings, 'MANIFEST_NOTIFY_TOKEN', None)
+    if request.method != 'POST' or not token or not hmac.compare_digest(request.GET.get('token', ''), token):
+        return JsonResponse({"message": "Not authorized."}, status=403)
+    try:
+        attributes = json.loads(request.body).get('message', {}).get('attributes', {})
+        prefix = "{}/".format(settings.USER_MANIFESTS_FOLDER)
+        object_id = attributes.get('objectId', '')
+        if attributes.get('eventType', None) == 'OBJECT_FINALIZE' and object_id.startswith(prefix):
+            mark_manifest_file_ready(object_id[len(prefix):])
+    except Exception as e:
+        logger.error("[ERROR] While handling a manifest file notification:")
+        logger.exception(e)
+    # Always acknowledge, so Pub/Sub doesn't redeliver a notification we can't use
+    return HttpResponse(status=204)
+
+
+# Per-shard progress of a sharded manifest job; the manifest is ready once every shard's file is
+def check_manifest_progress(request, job_id=None):
+    try:
+        progress = manifest_progress(job_id)
+        if not progress:
+            return JsonResponse({"manifest_ready": False, "message": "No sharded manifest job found with ID {}.".format(
+                job_id)}, status=404)
+        return JsonResponse(progress, status=200)
+    except Exception as e:
+        logger.error("[ERROR] While checking the progress of manifest job {}:".format(job_id))
+        logger.exception(e)
+        return JsonResponse({"manifest_ready": False, "message": "There was an error checking this manifest's progress."},
+                            status=500)
 
 
+# Stream a manifest file in fixed-size chunks. Supports single HTTP Range requests (so interrupted downloads can
+# resume) and If-None-Match/If-Range against the file's ETag. On-the-fly compression produces a different body each
+# time, so a Range request is served from the file itself, or a stored compressed copy, rather than compressed.
 def fetch_user_manifest(request, file_name=None):
     if not file_name:
         return JsonResponse({"message": "invalid request"},status=400)
-    # WJRL 4/25/25: use default app credentials:
-    client = storage.Client()
-    ##client = storage.Client.from_service_account_json(settings.GOOGLE_APPLICATION_CREDENTIALS)
-    bucket = client.get_bucket(settings.RESULT_BUCKET)
-    blob = bucket.blob("{}/{}".format(settings.USER_MANIFESTS_FOLDER, file_name))
+    manifest_storage = get_manifest_storage()
+
+    compression = request.GET.get('compression', None)
+    # Parquet files are already compressed, so they're only compressed again if that's explicitly asked for
+    encoding = negotiate_encoding(request, compression) if compression or not file_name.endswith(".parquet") else None
+    range_header = request.META.get('HTTP_RANGE', None)
+    # Serve a stored compressed copy of the manifest if one was made, and otherwise compress it as it's sent
+    stored_name = "{}.{}".format(file_name, COMPRESSION_EXTENSIONS[encoding]) if encoding else None
+    stored_info = manifest_storage.stat(stored_name) if stored_name else None
+    precompressed = bool(stored_info)
+    name = stored_name if precompressed else file_name
+    if range_header and encoding and not precompressed and not compression:
+        # A resumed download is sent as is; only an explicitly requested compressed file has no ranges to offer
+        encoding = None
+    info = stored_info or manifest_storage.stat(file_name)
+    if not info:
+        return JsonResponse({"message": "Manifest {} not found.".format(file_name)}, status=404)
+
+    ranges_allowed = precompressed or not encoding
+    etag = '"{}"'.format(info['etag']) if ranges_allowed else 'W/"{}-{}"'.format(info['etag'], encoding)
+
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH', None)
+    if if_none_match and (if_none_match.strip() == '*' or etag in [x.strip() for x in if_none_match.split(",")]):
+        response = HttpResponse(status=304)
+        response['ETag'] = etag
+        return response
+
+    start, end = 0, info['size'] - 1
+    status = 200
+    if_range = request.META.get('HTTP_IF_RANGE', None)
+    if ranges_allowed and range_header and (not if_range or if_range.strip() == etag):
+        byte_range = parse_range_header(range_header, info['size'])
+        if not byte_range:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = "bytes */{}".format(info['size'])
+            return response
+        start, end = byte_range
+        status = 206
 
-    response = StreamingHttpResponse(io.BytesIO(blob.download_as_bytes()))
+    response = StreamingHttpResponse(
+        manifest_storage.iter_chunks(name, start, end, get_manifest_chunk_size(), info.get('generation', None))
+        if info['size'] else iter(()),
+        status=status
+    )
 
     response['Content-Disposition'] = 'attachment; filename="{}"'.format(file_name.split("/")[-1])
     response['Content-Type'] = 'application/octet-stream'
+    response['ETag'] = etag
+    if ranges_allowed or not compression:
+        # Compressed on the fly, but a Range request would be served from the file itself
+        response['Accept-Ranges'] = 'bytes'
+    if ranges_allowed:
+        response['Content-Length'] = str(end - start + 1) if info['size'] else "0"
+        if status == 206:
+            response['Content-Range'] = "bytes {}-{}/{}".format(start, end, info['size'])
 
-    return response
+    return compress_response(response, encoding, file_name.split("/")[-1], as_file=bool(compression),
+                             precompressed=precompressed)
 
 
 # Given a cohort ID, fetch out the unique set of case IDs associated with those samples
@@ -185,8 +292,14 @@ def get_cohort_stats(request, cohort_id, as_json=True):
                     sources
                 ))
             else:
-                cohort_stats.update({'PatientID': old_cohort.case_count, 'StudyInstanceUID': old_cohort.study_count,
-                                'SeriesInstanceUID': old_cohort.series_count})
+                # Stats for a newly saved cohort are computed in the background; until they're in, report the
+                # status so the caller can poll again
+                cohort_stats['stats_status'] = old_cohort.get_stats_status()
+                if old_cohort.stats_status == Cohort.STATS_PENDING:
+                    status = 202
+                else:
+                    cohort_stats.update({'PatientID': old_cohort.case_count, 'StudyInstanceUID': old_cohort.study_count,
+                                         'SeriesInstanceUID': old_cohort.series_count})
 
     except ObjectDoesNotExist as e:
         logger.exception(e)
@@ -204,6 +317,46 @@ def get_cohort_stats(request, cohort_id, as_json=True):
     return JsonResponse(cohort_stats, status=status)
 
 
+# Compare a cohort's series between two IDC versions (from_version defaults to the cohort's own, to_version to the
+# active version). With summary=true the counts of added/removed/changed/unchanged series are returned as JSON;
+# otherwise the detailed diff is streamed as a CSV manifest.
+@login_required
+def get_cohort_diff(request, cohort_id):
+    try:
+        req = request.GET if request.method == 'GET' else request.POST
+        cohort = Cohort.objects.get(id=cohort_id, active=True)
+        if not cohort.get_perm(request):
+            return JsonResponse({'message': "You don't have permission to view that cohort."}, status=403)
+
+        from_version = req.get('from_version', None)
+        to_version = req.get('to_version', None)
+        from_version = ImagingDataCommonsVersion.objects.get(version_number=from_version) if from_version else None
+        to_version = ImagingDataCommonsVersion.objects.get(version_number=to_version) if to_version else None
+
+        if req.get('summary', "False").lower() == "true":
+            return JsonResponse(cohort_diff_summary(cohort, from_version, to_version), status=200)
+
+        pseudo_buffer = Echo()
+        writer = csv.writer(pseudo_buffer)
+
+        def diff_rows():
+            yield writer.writerow(["status", "SeriesInstanceUID", "old_crdc_series_uuid", "new_crdc_series_uuid"])
+            for row in cohort_diff(cohort, from_version, to_version):
+                yield writer.writerow(row)
+
+        response = StreamingHttpResponse(diff_rows(), content_type="text/csv")
+        response['Content-Disposition'] = 'attachment; filename=cohort_{}_diff.csv'.format(cohort.id)
+        return response
+
+    except ObjectDoesNotExist as e:
+        logger.exception(e)
+        return JsonResponse({'message': "That cohort or version wasn't found."}, status=404)
+    except Exception as e:
+        logger.error("[ERROR] While diffing cohort {}:".format(cohort_id))
+        logger.exception(e)
+        return JsonResponse({'message': "There was an error while comparing this cohort's versions."}, status=500)
+
+
 @login_required
 def cohorts_list(request, is_public=False):
     if debug: logger.debug('Called '+sys._getframe().f_code.co_name)
@@ -216,11 +369,17 @@ def cohorts_list(request, is_public=False):
     cohorts.has_private_cohorts = True if len(cohorts) else False
     #shared_users = {}
 
+    inactive_attr_cohorts = cohorts.with_inactive_attrs()
+
     for item in cohorts:
-        file_parts_count = math.ceil(item.series_count / (MAX_FILE_LIST_ENTRIES if MAX_FILE_LIST_ENTRIES > 0 else 1))
+        # A cohort's series count is 0 until its stats are in, so don't offer manifest parts for it until then
+        item.stats_pending = (item.stats_status == Cohort.STATS_PENDING)
+        file_parts_count = None if item.stats_pending else math.ceil(
+            item.series_count / (MAX_FILE_LIST_ENTRIES if MAX_FILE_LIST_ENTRIES > 0 else 1)
+        )
         item.file_parts_count = file_parts_count
-        item.display_file_parts_count = min(file_parts_count, 10)
-        item.has_inactive_attr = bool(len(item.get_attrs().filter(active=False)) > 0)
+        item.display_file_parts_count = None if item.stats_pending else min(file_parts_count, 10)
+        item.has_inactive_attr = (item.id in inactive_attr_cohorts)
 
     #     item.perm = item.get_perm(request).get_perm_display()
     #     item.owner = item.get_owner()
@@ -288,7 +447,11 @@ def cohort_detail(request, cohort_id):
             with_derived, collapse_on, False
         )
 
-        file_parts_count = math.ceil(cohort.series_count / (MAX_FILE_LIST_ENTRIES if MAX_FILE_LIST_ENTRIES > 0 else 1))
+        # The series count is 0 until the cohort's stats are in, so the manifest parts are withheld until then
+        stats_pending = (cohort.stats_status == Cohort.STATS_PENDING)
+        file_parts_count = None if stats_pending else math.ceil(
+            cohort.series_count / (MAX_FILE_LIST_ENTRIES if MAX_FILE_LIST_ENTRIES > 0 else 1)
+        )
         bq_string = get_query_string(request, cohort_id)
 
         template_values.update({
@@ -301,8 +464,9 @@ def cohort_detail(request, cohort_id):
             'cohort_id': cohort_id,
             'is_social': bool(len(request.user.socialaccount_set.all()) > 0),
             'cohort_file_parts_count': file_parts_count,
-            'cohort_display_file_parts_count': min(file_parts_count, 10),
-            'bq_string': bq_string
+            'cohort_display_file_parts_count': None if stats_pending else min(file_parts_count, 10),
+            'bq_string': bq_string,
+            'stats_pending': stats_pending
         })
 
         template = 'cohorts/cohort_details.html'
@@ -316,7 +480,11 @@ def cohort_detail(request, cohort_id):
         messages.error(request, "There was an error while trying to load that cohort's details page.")
         return redirect('cohort_list')
 
-    return render(request, template, template_values)
+    response = render(request, template, template_values)
+    # Don't let the page cache hold on to a cohort whose counts are still being computed
+    if template_values['stats_pending']:
+        add_never_cache_headers(response)
+    return response
 
 
 @login_required
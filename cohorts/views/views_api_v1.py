@@ -37,6 +37,7 @@ from cohorts.utils_api_v1 import get_filterSet_api, get_idc_data_version, \
     _cohort_manifest_api, _cohort_preview_manifest_api, \
     _cohort_preview_query_api, _cohort_query_api
 from ..views.views import _save_cohort,_delete_cohort
+from cohorts.utils import get_cohort_list
 
 BQ_ATTEMPT_MAX = 10
 
@@ -273,23 +274,13 @@ def cohort_list_api(request):
     if debug: logger.debug('Called ' + sys._getframe().f_code.co_name)
     try:
         user = User.objects.get(email=request.GET.get('email', ''))
-        cohortList = []
+        fields = request.GET.get('fields', None)
 
-        cohorts = [cohort for cohort in Cohort.objects.filter(active=True) if
-                   len(Cohort_Perms.objects.filter(user=user, cohort=cohort)) >= 1]
-
-        for cohort in cohorts:
-            cohortMetadata = {
-                "cohort_id": cohort.id,
-                "name": cohort.name,
-                "description": cohort.description,
-                "owner": "{} {}".format(cohort.cohort_perms_set.get().user.first_name,cohort.cohort_perms_set.get().user.last_name),
-                "permission": cohort.cohort_perms_set.get().perm,
-                "filterSet": get_filterSet_api(cohort)
-            }
-            cohortList.append(cohortMetadata)
-
-        response = {"cohorts": cohortList}
+        # Paging is optional; without a page_size, every cohort is returned
+        response = get_cohort_list(
+            user, fields=fields.split(",") if fields else None, cursor=request.GET.get('cursor', None),
+            page_size=request.GET.get('page_size', None)
+        )
 
     except Exception as e:
         logger.error("[ERROR] While trying to view the cohort file list: ")
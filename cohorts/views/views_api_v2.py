@@ -31,8 +31,9 @@ from ..decorators import api_auth
 from idc_collections.models import Attribute
 from cohorts.models import Cohort, Cohort_Perms
 from cohorts.utils_api_v2 import to_numeric_list, get_filterSet_api, get_idc_data_version, \
-    _cohort_preview_query_api, _cohort_query_api
+    _cohort_preview_query_api, _cohort_query_api, _bulk_cohorts_api
 from ..views.views import _save_cohort,_delete_cohort
+from cohorts.utils import get_cohort_list
 
 NUMERIC_OPS = ('_btw', '_ebtw', '_btwe', '_ebtwe', '_gte', '_lte', '_gt', '_lt', '_eq')
 BQ_ATTEMPT_MAX = 10
@@ -113,6 +114,58 @@ def save_cohort_api(request):
     return JsonResponse(cohort_properties)
 
 
+# Save many cohorts at once
+@csrf_exempt
+@api_auth
+@require_http_methods(["POST"])
+def bulk_save_cohort_api(request):
+    return _bulk_cohorts_response(request, save=True)
+
+
+# Count many cohort definitions at once without saving them
+@csrf_exempt
+@api_auth
+@require_http_methods(["POST"])
+def bulk_preview_cohort_api(request):
+    return _bulk_cohorts_response(request, save=False)
+
+
+def _bulk_cohorts_response(request, save):
+    if debug: logger.debug('Called '+sys._getframe().f_code.co_name)
+    try:
+        body = json.loads(request.body.decode('utf-8'))
+        try:
+            user = User.objects.get(email=body['email'])
+        except Exception as e:
+            logger.error(f"[ERROR]:{body['email']} is not a known user")
+            logger.exception(e)
+            response = {
+                "message": f"{body['email']} is not a known user",
+                "code": 401,
+            }
+            return JsonResponse(response)
+
+        response = _bulk_cohorts_api(user, body["request_data"]["cohorts"], save=save)
+        # A batch which couldn't be accepted at all comes back with its own message and code
+        if 'code' in response:
+            return JsonResponse(response)
+        for cohort in response['cohorts']:
+            for filter, value in cohort.get('filterSet', {}).get('filters', {}).items():
+                if filter.endswith(NUMERIC_OPS):
+                    cohort['filterSet']['filters'][filter] = to_numeric_list(value)
+        response['code'] = 200
+
+    except Exception as e:
+        logger.error(f"[ERROR]{e}: While trying to process a bulk cohort request: ")
+        logger.exception(e)
+        response = {
+            "message": f"There was an error processing your cohorts: {e}",
+            "code": 500,
+        }
+
+    return JsonResponse(response)
+
+
 @csrf_exempt
 @api_auth
 @require_http_methods(["POST"])
@@ -224,26 +277,15 @@ def cohort_list_api(request):
             }
             return JsonResponse(response)
 
-        cohortList = []
-        cohorts = [cohort for cohort in Cohort.objects.filter(active=True) if
-                   len(Cohort_Perms.objects.filter(user=user, cohort=cohort)) >= 1]
-        for cohort in cohorts:
-            cohortMetadata = {
-                "cohort_id": cohort.id,
-                "name": cohort.name,
-                "description": cohort.description,
-                "owner": "{} {}".format(cohort.cohort_perms_set.get().user.first_name,cohort.cohort_perms_set.get().user.last_name),
-                "permission": cohort.cohort_perms_set.get().perm,
-                "filterSet": get_filterSet_api(cohort)
-            }
-            for filter, value in cohortMetadata['filterSet']['filters'].items():
-                # if filter.endswith(('_lt', '_lte', '_ebtw', '_ebtwe', '_btw', '_btwe', '_gte' '_gt')):
-                #     if filter.endswith(('_lt', '_lte', '_ebtw', '_ebtwe', '_btw', '_btwe', '_gte' '_gt')):
+        # Paging is optional; without a page_size, every cohort is returned
+        response = get_cohort_list(
+            user, fields=body.get('fields', None), cursor=body.get('cursor', None),
+            page_size=body.get('page_size', None)
+        )
+        for cohortMetadata in response['cohorts']:
+            for filter, value in cohortMetadata.get('filterSet', {}).get('filters', {}).items():
                 if filter.endswith(NUMERIC_OPS):
                     cohortMetadata['filterSet']['filters'][filter] = to_numeric_list(value)
-            cohortList.append(cohortMetadata)
-
-        response = {"cohorts": cohortList}
     except Exception as e:
         logger.error("[ERROR] While trying to view the cohort file list: ")
         logger.exception(e)
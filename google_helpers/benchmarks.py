@@ -0,0 +1,46 @@
+#
+# Copyright 2015-2024, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Benchmarks, run by hand from a Django shell, eg.:
+#
+#   from google_helpers.benchmarks import benchmark_stackdriver_logger
+#   benchmark_stackdriver_logger()
+
+import time
+import logging
+
+from django.test import override_settings
+from google_helpers.stackdriver import StackDriverLogger
+
+logger = logging.getLogger(__name__)
+
+
+# Time queueing count log entries, and then flushing them, through the in-memory log backend, so nothing is written to
+# Cloud Logging. Returns {'queue': <seconds>, 'flush': <seconds>}.
+def benchmark_stackdriver_logger(count=10000):
+    with override_settings(STACKDRIVER_LOG_BACKEND='memory'):
+        st_logger = StackDriverLogger.build_from_django_settings()
+        st_logger.worker.sink.clear()
+        start = time.time()
+        for i in range(count):
+            st_logger.write_text_log_entry('benchmark_log', "Entry {}".format(i))
+        queued = time.time()
+        st_logger.flush()
+        stop = time.time()
+        st_logger.worker.sink.clear()
+    logger.info("[BENCHMARKING] {} log entries queued in {}s, flushed in {}s".format(
+        count, str(queued-start), str(stop-queued)))
+    return {'queue': queued-start, 'flush': stop-queued}
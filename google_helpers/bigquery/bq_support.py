@@ -17,6 +17,7 @@
 from builtins import str
 import logging
 import re
+import time
 from time import sleep
 from uuid import uuid4
 import copy
@@ -29,6 +30,7 @@ from google.cloud import bigquery
 from google.cloud.bigquery import QueryJob, QueryJobConfig
 from googleapiclient.errors import HttpError
 from .utils import build_bq_filter_and_params as build_bq_flt_prm, build_bq_where_clause as build_bq_clause, build_bq_filter_and_params_v1
+from metrics_helpers import histogram, counter, get_caller
 
 logger = logging.getLogger(__name__)
 
@@ -36,6 +38,15 @@ MAX_INSERT = settings.MAX_BQ_INSERT
 MAX_RESULTS = settings.MAX_FILE_LIST_REQUEST
 BQ_ATTEMPT_MAX = settings.BQ_MAX_ATTEMPTS
 
+BQ_JOBS = counter('idc_bigquery_jobs_total', "BigQuery jobs inserted, by kind and calling function", ['kind', 'caller'])
+BQ_QUERY_SECONDS = histogram(
+    'idc_bigquery_query_seconds', "Time from inserting a BigQuery job to having its results, by operation and calling function",
+    ['operation', 'caller'], backend='bigquery')
+BQ_ERRORS = counter('idc_bigquery_errors_total', "Failed or timed out BigQuery jobs, by operation and calling function",
+                    ['operation', 'caller'])
+BQ_BYTES_PROCESSED = counter('idc_bigquery_bytes_processed_total', "Bytes processed by BigQuery jobs, by calling function",
+                             ['caller'])
+
 
 class BigQuerySupport(BigQueryABC):
 
@@ -222,6 +233,7 @@ class BigQuerySupport(BigQueryABC):
         if cost_est:
             job_config.dry_run = True
 
+        BQ_JOBS.inc(kind='dry_run' if cost_est else 'query', caller=get_caller((__name__,)))
         return self.bq_client.query(query, job_config=job_config)
 
     # Runs a basic, optionally parameterized query
@@ -229,6 +241,8 @@ class BigQuerySupport(BigQueryABC):
     # will be used as the destination table for the query
     # WRITE_DISPOSITION is assumed to be for an empty table unless specified
     def execute_query(self, query, parameters=None, write_disposition='WRITE_EMPTY', cost_est=False, paginated=False):
+        caller = get_caller((__name__,))
+        start = time.time()
 
         query_job = self.insert_bq_query_job(query, parameters, write_disposition, cost_est)
 
@@ -250,6 +264,7 @@ class BigQuerySupport(BigQueryABC):
         # Parse the final disposition
         if query_job.done():
             if query_job.errors or query_job.error_result:
+                BQ_ERRORS.inc(operation='execute', caller=caller)
                 query_job.error_result and logger.error("[ERROR] During query job {}: {}".format(job_id, str(query_job.error_result)))
                 query_job.errors and logger.error("[ERROR] During query job {}: {}".format(job_id, str(query_job.errors)))
                 logger.error("[ERROR] Error'd out query: {}".format(query))
@@ -257,10 +272,13 @@ class BigQuerySupport(BigQueryABC):
                 logger.info("[STATUS] Query {} done, fetching results...".format(job_id))
                 query_results = self.fetch_job_results(query_job, paginated=paginated)
                 logger.info("[STATUS] {} results found for query {}.".format(str(len(query_results)), job_id))
+                BQ_BYTES_PROCESSED.inc(query_job.total_bytes_processed or 0, caller=caller)
         else:
+            BQ_ERRORS.inc(operation='execute', caller=caller)
             logger.error("[ERROR] Query took longer than the allowed time to execute. " +
                          "If you check job ID {} manually you can wait for it to finish.".format(job_id))
             logger.error("[ERROR] Timed out query: {}".format(query))
+        BQ_QUERY_SECONDS.observe(time.time() - start, operation='execute', caller=caller)
 
         if query_job.timeline and len(query_job.timeline):
             logger.debug("Elapsed: {}".format(str(query_job.timeline[-1].elapsed_ms)))
@@ -343,6 +361,27 @@ class BigQuerySupport(BigQueryABC):
         bqs = cls(None, None, None)
         return bqs.insert_bq_query_job(query, parameters)
 
+    # Execute a query, optionally parameterized, and yield its rows as they're paged in rather than collecting them
+    # all first. Unlike execute_query_and_fetch_results there's no MAX_RESULTS cap, so this is suited to streaming
+    # large, ordered result sets.
+    @classmethod
+    def stream_query_results(cls, query, parameters=None, fetch_size=None):
+        caller = get_caller((__name__,))
+        start = time.time()
+        bqs = cls(None, None, None)
+        query_job = bqs.insert_bq_query_job(query, parameters)
+        try:
+            # Raises if the job fails
+            query_job.result()
+        except Exception:
+            BQ_ERRORS.inc(operation='stream', caller=caller)
+            raise
+        finally:
+            BQ_QUERY_SECONDS.observe(time.time() - start, operation='stream', caller=caller)
+        BQ_BYTES_PROCESSED.inc(query_job.total_bytes_processed or 0, caller=caller)
+        for row in bqs.bq_client.list_rows(query_job.destination, page_size=fetch_size or MAX_RESULTS):
+            yield row
+
     # Do a 'dry run' query, which estimates the cost
     @classmethod
     def estimate_query_cost(cls, query, parameters=None):
@@ -431,6 +470,8 @@ class BigQuerySupport(BigQueryABC):
     # Method for submitting a group of jobs and awaiting the results of the whole set
     @classmethod
     def insert_job_batch_and_get_results(cls, query_set):
+        caller = get_caller((__name__,))
+        start = time.time()
         bqs = cls(None, None, None)
         submitted_job_set = {}
         for query in query_set:
@@ -459,10 +500,13 @@ class BigQuerySupport(BigQueryABC):
             if submitted_job_set[query['job_id']].done():
                 query['bq_results'] = bqs.fetch_job_results(submitted_job_set[query['job_id']])
                 query['result_schema'] = submitted_job_set[query['job_id']].schema
+                BQ_BYTES_PROCESSED.inc(submitted_job_set[query['job_id']].total_bytes_processed or 0, caller=caller)
             else:
+                BQ_ERRORS.inc(operation='batch', caller=caller)
                 query['bq_results'] = None
                 query['result_schema'] = None
 
+        BQ_QUERY_SECONDS.observe(time.time() - start, operation='batch', caller=caller)
         return query_set
 
     # v2 API pass through for filter and paramter builder
@@ -26,6 +26,12 @@ from django.core.files.storage import Storage
 from google_helpers import storage_service
 from googleapiclient import http
 from .utils import execute_with_retries
+from metrics_helpers import histogram, get_caller
+
+# Shared with the manifest storage's GCS requests
+GCS_REQUEST_SECONDS = histogram(
+    'idc_gcs_request_seconds', "Time taken by GCS requests, by operation and calling function", ['operation', 'caller'],
+    backend='gcs')
 
 class CloudFileStorage(Storage):
 
@@ -37,7 +43,8 @@ class CloudFileStorage(Storage):
         bucket = filepath.pop(0)
         name = '/'.join(filepath)
         req = self.storage.objects().get(bucket=bucket, object=name)
-        response = execute_with_retries(req, 'GET_BUCKET', 2)
+        with GCS_REQUEST_SECONDS.time(operation='download', caller=get_caller(('django.core.files.storage',))):
+            response = execute_with_retries(req, 'GET_BUCKET', 2)
         return response
 
     def _save(self, name, content):
@@ -50,7 +57,8 @@ class CloudFileStorage(Storage):
             name=name,
             media_body=media
         )
-        execute_with_retries(req, 'SAVE_TO_BUCKET', 2)
+        with GCS_REQUEST_SECONDS.time(operation='upload', caller=get_caller(('django.core.files.storage',))):
+            execute_with_retries(req, 'SAVE_TO_BUCKET', 2)
         return bucket + '/' + name
 
     def get_available_name(self, name, max_length):
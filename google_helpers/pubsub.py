@@ -0,0 +1,148 @@
+#
+# Copyright 2015-2024, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import logging
+import threading
+from uuid import uuid4
+from concurrent.futures import Future
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+PUBSUB_GCP = 'gcp'
+PUBSUB_MEMORY = 'memory'
+
+# Batching defaults, overridable with PUBSUB_BATCH_MAX_MESSAGES, PUBSUB_BATCH_MAX_BYTES, and PUBSUB_BATCH_MAX_LATENCY.
+# A batch is sent as soon as any one of these is reached.
+BATCH_MAX_MESSAGES = 100
+BATCH_MAX_BYTES = 1024 * 1024
+BATCH_MAX_LATENCY = 0.05
+
+# Retry policy for a publish, in seconds; overridable with PUBSUB_RETRY_INITIAL, PUBSUB_RETRY_MAXIMUM, and
+# PUBSUB_RETRY_DEADLINE
+RETRY_INITIAL = 0.1
+RETRY_MAXIMUM = 10.0
+RETRY_MULTIPLIER = 2.0
+RETRY_DEADLINE = 60.0
+
+# Publishers are shared process-wide (both the Pub/Sub client and the in-memory broker are thread safe), keyed on the
+# backend they publish to
+PUBLISHERS = {}
+PUBLISHER_LOCK = threading.Lock()
+
+
+# A local stand-in for Pub/Sub, selected with PUBSUB_BACKEND = 'memory'. Messages are held per topic in publication
+# order until pulled; subscribers registered for a topic are instead handed each message as it's published. Publishing
+# returns an already-resolved future, as a successful Pub/Sub publish would.
+class InMemoryBroker(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.topics = {}
+        self.subscribers = {}
+
+    def publish(self, topic, data, retry=None, **attrs):
+        if not isinstance(data, bytes):
+            raise TypeError("Data must be a bytestring, not {}.".format(type(data).__name__))
+        message_id = str(uuid4())
+        message = {'message_id': message_id, 'data': data, 'attributes': attrs}
+        with self.lock:
+            subscribers = list(self.subscribers.get(topic, []))
+            if not len(subscribers):
+                self.topics.setdefault(topic, []).append(message)
+        for subscriber in subscribers:
+            subscriber(message)
+        future = Future()
+        future.set_result(message_id)
+        return future
+
+    def subscribe(self, topic, callback):
+        with self.lock:
+            self.subscribers.setdefault(topic, []).append(callback)
+            waiting = self.topics.pop(topic, [])
+        for message in waiting:
+            callback(message)
+
+    # Remove and return up to max_messages of a topic's waiting messages, oldest first
+    def pull(self, topic, max_messages=None):
+        with self.lock:
+            waiting = self.topics.get(topic, [])
+            max_messages = len(waiting) if max_messages is None else max_messages
+            pulled, self.topics[topic] = waiting[:max_messages], waiting[max_messages:]
+        return pulled
+
+    def clear(self):
+        with self.lock:
+            self.topics = {}
+            self.subscribers = {}
+
+
+def _build_gcp_publisher():
+    from google.cloud import pubsub_v1
+    batch_settings = pubsub_v1.types.BatchSettings(
+        max_messages=getattr(settings, 'PUBSUB_BATCH_MAX_MESSAGES', BATCH_MAX_MESSAGES),
+        max_bytes=getattr(settings, 'PUBSUB_BATCH_MAX_BYTES', BATCH_MAX_BYTES),
+        max_latency=getattr(settings, 'PUBSUB_BATCH_MAX_LATENCY', BATCH_MAX_LATENCY)
+    )
+    return pubsub_v1.PublisherClient(batch_settings)
+
+
+def _retry_policy():
+    from google.api_core import retry
+    return retry.Retry(
+        initial=getattr(settings, 'PUBSUB_RETRY_INITIAL', RETRY_INITIAL),
+        maximum=getattr(settings, 'PUBSUB_RETRY_MAXIMUM', RETRY_MAXIMUM),
+        multiplier=RETRY_MULTIPLIER,
+        deadline=getattr(settings, 'PUBSUB_RETRY_DEADLINE', RETRY_DEADLINE)
+    )
+
+
+# Fetch the shared publisher for the configured backend, creating it on first use
+def get_publisher():
+    backend = getattr(settings, 'PUBSUB_BACKEND', PUBSUB_GCP)
+    if backend not in PUBLISHERS:
+        with PUBLISHER_LOCK:
+            if backend not in PUBLISHERS:
+                if backend == PUBSUB_MEMORY:
+                    PUBLISHERS[backend] = InMemoryBroker()
+                elif backend == PUBSUB_GCP:
+                    PUBLISHERS[backend] = _build_gcp_publisher()
+                else:
+                    raise Exception("Unrecognized Pub/Sub backend: {}".format(backend))
+    return PUBLISHERS[backend]
+
+
+# Publish a message without waiting for it to be sent. The message joins the publisher's current batch, and is retried
+# per the retry policy if sending fails. The returned future resolves to the message ID; if a callback is supplied it's
+# called with that future once the publish completes or finally fails. Failures are always logged.
+def publish_message(topic, data, callback=None, **attrs):
+    publisher = get_publisher()
+    retry = None if isinstance(publisher, InMemoryBroker) else _retry_policy()
+    future = publisher.publish(topic, data, retry=retry, **attrs)
+
+    def _on_published(f):
+        e = f.exception()
+        if e:
+            # Not in an except block, so the exception has to be passed along explicitly
+            logger.error("[ERROR] Failed to publish message to {}:".format(topic), exc_info=e)
+        if callback:
+            try:
+                callback(f)
+            except Exception as e:
+                logger.error("[ERROR] While running the publish callback for {}:".format(topic))
+                logger.exception(e)
+
+    future.add_done_callback(_on_published)
+    return future
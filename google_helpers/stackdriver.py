@@ -14,68 +14,236 @@
 # limitations under the License.
 #
 
-from future import standard_library
-standard_library.install_aliases()
 from builtins import object
-import logging as logger
-from urllib.parse import quote as urllib2_quote
-import google.cloud.logging as stackdriver_logging
+import time
+import atexit
+import logging
+import threading
+from collections import deque
+from django.conf import settings
+from metrics_helpers import counter
 
+logger = logging.getLogger(__name__)
+
+LOG_BACKEND_GCP = 'gcp'
+LOG_BACKEND_MEMORY = 'memory'
+
+# What to do with a new entry when the queue is full: wait up to STACKDRIVER_QUEUE_BLOCK_TIMEOUT seconds for room and
+# then drop it, drop it immediately, or make room by dropping the oldest queued entry
+OVERFLOW_BLOCK = 'block'
+OVERFLOW_DROP_NEWEST = 'drop_newest'
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+
+# Queueing and batching defaults, overridable with the setting of the same name prefixed with STACKDRIVER_. A batch is
+# written as soon as it has BATCH_MAX_ENTRIES entries or its first entry has waited BATCH_MAX_LATENCY seconds.
+QUEUE_MAX_SIZE = 10000
+QUEUE_BLOCK_TIMEOUT = 0.05
+OVERFLOW_POLICY = OVERFLOW_DROP_OLDEST
+BATCH_MAX_ENTRIES = 500
+BATCH_MAX_LATENCY = 1.0
+
+# Longest the process waits at exit for queued entries to be written, in seconds
+SHUTDOWN_TIMEOUT = 5.0
+
+LOG_ENTRIES_WRITTEN = counter('idc_log_entries_written_total', "Log entries written to Cloud Logging")
+LOG_ENTRIES_DROPPED = counter(
+    'idc_log_entries_dropped_total', "Log entries dropped, by reason (an overflow policy, or a failed write)",
+    ['reason'])
+
+# Workers are shared process-wide, keyed on the backend and project they write to
+LOG_WORKERS = {}
+WORKER_LOCK = threading.Lock()
+
+
+def _setting(name, default):
+    return getattr(settings, 'STACKDRIVER_{}'.format(name), default)
+
+
+# Writes batches of entries to Cloud Logging, grouped by log. The client is created on first write, on the worker
+# thread.
+class CloudLoggingSink(object):
+    def __init__(self, project_name):
+        self.project_name = project_name
+        self.client = None
+
+    def write(self, log_name, entries):
+        if not self.client:
+            import google.cloud.logging as stackdriver_logging
+            self.client = stackdriver_logging.Client(project=self.project_name)
+        batch = self.client.logger(name=log_name).batch()
+        for entry in entries:
+            if 'jsonPayload' in entry:
+                batch.log_struct(entry['jsonPayload'], severity=entry['severity'])
+            else:
+                batch.log_text(entry['textPayload'], severity=entry['severity'])
+        batch.commit()
+
+
+# A local stand-in for Cloud Logging, selected with STACKDRIVER_LOG_BACKEND = 'memory'. Entries are held per log in
+# the order they were written.
+class InMemoryLogSink(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.logs = {}
+
+    def write(self, log_name, entries):
+        with self.lock:
+            self.logs.setdefault(log_name, []).extend(entries)
+
+    def get_entries(self, log_name):
+        with self.lock:
+            return list(self.logs.get(log_name, []))
+
+    def clear(self):
+        with self.lock:
+            self.logs = {}
+
+
+# Writes queued entries to its sink in batches on a background thread. Entries are numbered as they're queued, so a
+# flush can wait for everything queued before it to be written (or dropped).
+class _LogWorker(object):
+    def __init__(self, sink):
+        self.sink = sink
+        self.policy = _setting('OVERFLOW_POLICY', OVERFLOW_POLICY)
+        self.block_timeout = _setting('QUEUE_BLOCK_TIMEOUT', QUEUE_BLOCK_TIMEOUT)
+        self.max_size = _setting('QUEUE_MAX_SIZE', QUEUE_MAX_SIZE)
+        self.max_entries = _setting('BATCH_MAX_ENTRIES', BATCH_MAX_ENTRIES)
+        self.max_latency = _setting('BATCH_MAX_LATENCY', BATCH_MAX_LATENCY)
+        self.condition = threading.Condition()
+        self.pending = deque()
+        self.queued = 0
+        self.written = 0
+        self.flushing = False
+        self.stopping = False
+        self.thread = threading.Thread(target=self._run, name="stackdriver_logger", daemon=True)
+        self.thread.start()
+
+    # Queue an entry per the overflow policy; returns False if it was dropped
+    def enqueue(self, log_name, entry):
+        with self.condition:
+            if len(self.pending) >= self.max_size:
+                if self.policy == OVERFLOW_DROP_OLDEST:
+                    self.pending.popleft()
+                    LOG_ENTRIES_DROPPED.inc(reason=self.policy)
+                elif self.policy != OVERFLOW_BLOCK or not self.condition.wait_for(
+                        lambda: len(self.pending) < self.max_size, self.block_timeout):
+                    LOG_ENTRIES_DROPPED.inc(reason=self.policy)
+                    return False
+            self.queued += 1
+            self.pending.append((self.queued, log_name, entry))
+            # The worker only needs waking for a new batch, or a full one
+            if len(self.pending) == 1 or len(self.pending) >= self.max_entries:
+                self.condition.notify_all()
+        return True
+
+    def _write(self, batch):
+        by_log = {}
+        for number, log_name, entry in batch:
+            by_log.setdefault(log_name, []).append(entry)
+        for log_name, entries in by_log.items():
+            try:
+                self.sink.write(log_name, entries)
+                LOG_ENTRIES_WRITTEN.inc(len(entries))
+            except Exception as e:
+                LOG_ENTRIES_DROPPED.inc(len(entries), reason='write_failed')
+                logger.error("[ERROR] Failed to write {} entries to log {}:".format(len(entries), log_name))
+                logger.exception(e)
+
+    def _run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: len(self.pending) or self.stopping)
+                if not len(self.pending):
+                    return
+                deadline = time.time() + self.max_latency
+                while len(self.pending) < self.max_entries and not self.flushing and not self.stopping:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                batch = [self.pending.popleft() for _ in range(min(len(self.pending), self.max_entries))]
+                self.flushing = self.flushing and len(self.pending) > 0
+                # Wake any callers blocked on a full queue
+                self.condition.notify_all()
+            self._write(batch)
+            with self.condition:
+                self.written = batch[-1][0]
+                self.condition.notify_all()
+
+    # Wait up to timeout seconds for everything queued so far to be written; returns False on timing out
+    def flush(self, timeout=None):
+        with self.condition:
+            target = self.queued
+            self.flushing = True
+            self.condition.notify_all()
+            return self.condition.wait_for(lambda: self.written >= target or not self.thread.is_alive(), timeout)
+
+    # Write everything queued, then stop the worker
+    def close(self, timeout=SHUTDOWN_TIMEOUT):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            logger.warning("[WARNING] Timed out writing queued log entries at shutdown; some may be lost.")
+
+
+# Fetch the shared worker for the configured backend and project, starting it on first use
+def get_log_worker(project_name):
+    backend = _setting('LOG_BACKEND', LOG_BACKEND_GCP)
+    key = (backend, project_name if backend == LOG_BACKEND_GCP else None)
+    if key not in LOG_WORKERS:
+        with WORKER_LOCK:
+            if key not in LOG_WORKERS:
+                if backend == LOG_BACKEND_MEMORY:
+                    sink = InMemoryLogSink()
+                elif backend == LOG_BACKEND_GCP:
+                    sink = CloudLoggingSink(project_name)
+                else:
+                    raise Exception("Unrecognized StackDriver log backend: {}".format(backend))
+                LOG_WORKERS[key] = _LogWorker(sink)
+                atexit.register(LOG_WORKERS[key].close)
+    return LOG_WORKERS[key]
+
+
+# Writes log entries through Cloud Logging without blocking the caller: entries are queued and written in batches by
+# a shared background worker. Use flush() where entries must be written before continuing.
 class StackDriverLogger(object):
 
     def __init__(self, project_name):
         self.project_name = project_name
-        self.logging_client = stackdriver_logging.Client(project=self.project_name)
+        self.worker = get_log_worker(project_name)
 
     def write_log_entries(self, log_name, log_entry_array):
-        """ Creates log entries using the StackDriver logging API.
+        """ Queues log entries to be written using the StackDriver logging API.
 
             Args:
-                log_name: Log name. Will be URL encoded (see code).
-                log_entry_array: List of log entries. See https://cloud.google.com/logging/docs/api/reference/rest/v2/LogEntry
-        """
-        try:
-            client = self.logging_client
-        except Exception as e:
-            logger.error("failed to get a logging client: {}".format(e.message))
-            return
-
-        stackdriver_logger = client.logger(name=log_name)
-
-        try:
-            if len(log_entry_array) > 1:
-                # Batch commit multiple entries
-                batch = stackdriver_logger.batch()
-                for log_entry in log_entry_array:
-                    batch.log(log_entry['textPayload'], severity=log_entry['severity'])
-                batch.commit()
-            else:
-                # otherwise a single-write will be fine
-                log_entry = log_entry_array[0]
-                stackdriver_logger.log(log_entry['textPayload'], severity=log_entry['severity'])
+                log_name: Log name.
+                log_entry_array: List of log entries, each with a severity and either a textPayload or a jsonPayload.
+                    See https://cloud.google.com/logging/docs/api/reference/rest/v2/LogEntry
 
-        except Exception as e:
-            # If we still get an exception, figure out what the type is:
-            logger.error("Exception while calling logging API: {0}.".format(e.__class__.__name__))
-            logger.exception(e)
+            Returns:
+                The number of entries queued; the rest were dropped because the queue was full.
+        """
+        return len([x for x in log_entry_array if self.worker.enqueue(log_name, x)])
 
     def write_struct_log_entry(self, log_name, log_entry, severity="DEFAULT"):
-        self.write_log_entries(log_name, [{
+        return self.write_log_entries(log_name, [{
             'severity': severity,
             'jsonPayload': log_entry
         }])
 
     def write_text_log_entry(self, log_name, log_text, severity="DEFAULT" ):
-        self.write_log_entries(log_name, [{
+        return self.write_log_entries(log_name, [{
             'severity': severity,
             'textPayload': log_text
         }])
 
+    def flush(self, timeout=None):
+        return self.worker.flush(timeout)
 
     # This *IS* used in a few places 4/25/25. Converting to ISB-CGC form!
     @classmethod
     def build_from_django_settings(cls):
-        from django.conf import settings
         project_name = settings.GCLOUD_PROJECT_ID
         return cls(project_name)
-
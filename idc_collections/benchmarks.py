@@ -0,0 +1,161 @@
+#
+# Copyright 2015-2024, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Benchmarks, run by hand from a Django shell against a copy of the database and a live Solr, eg.:
+#
+#   from idc_collections.benchmarks import record_explorer_facets, benchmark_format_facet_values
+#   record_explorer_facets("explorer_facets.json")
+#   benchmark_format_facet_values("explorer_facets.json")
+#   benchmark_attr_get_data_sources()
+#   benchmark_submit_manifest_jobs()
+#   benchmark_manifest_compression("manifest_20240101_120000_aws.s5cmd")
+#
+# Anything a benchmark creates is rolled back when it finishes.
+
+import json
+import time
+import logging
+from unittest import mock
+
+from django.db import transaction
+from django.test import override_settings
+from google_helpers.pubsub import get_publisher
+from idc_collections import collex_metadata_utils
+from idc_collections.collex_metadata_utils import build_explorer_context, format_facet_values, \
+    fetch_data_source_types, submit_manifest_job
+from idc_collections.compression import compress_stream, available_encodings
+from idc_collections.models import Attribute, Attribute_Display_Values, DataSource, DataSetType, \
+    ImagingDataCommonsVersion
+
+logger = logging.getLogger(__name__)
+
+
+# Record the facet response Solr gives the explorer for filters (by default, none) to file_name, for replaying with
+# benchmark_format_facet_values
+def record_explorer_facets(file_name, filters=None):
+    responses = []
+    get_collex_metadata = collex_metadata_utils.get_collex_metadata
+
+    def recording(*args, **kwargs):
+        result = get_collex_metadata(*args, **kwargs)
+        responses.append(result)
+        return result
+
+    with mock.patch.object(collex_metadata_utils, 'get_collex_metadata', recording):
+        build_explorer_context(False, DataSource.SOLR, None, filters or {}, [], [], True, True, True,
+                               'SeriesInstanceUID', True)
+    with open(file_name, "w") as f:
+        json.dump({'facets': responses[0].get('facets', {})}, f)
+
+
+# Time iterations passes of the per-attribute facet transform over a recorded explorer facet response. Returns the
+# seconds taken by all passes.
+def benchmark_format_facet_values(file_name, iterations=50):
+    with open(file_name) as f:
+        facet_counts = json.load(f)['facets']
+    source_ids = [int(x.split(":")[-1]) for x in facet_counts]
+    source_types = fetch_data_source_types(DataSource.objects.filter(id__in=source_ids))
+    attr_names = set(x for source in facet_counts.values() for x in source['facets'])
+    attrs = {x.name: x for x in Attribute.objects.filter(name__in=attr_names)}
+    display_vals = Attribute_Display_Values.objects.filter(attribute__in=attrs.values()).to_dict()
+    transforms = [
+        (attrs[name], vals, DataSetType.DERIVED_DATA in source_types[int(source.split(":")[-1])])
+        for source in facet_counts for name, vals in facet_counts[source]['facets'].items() if name in attrs
+    ]
+
+    start = time.time()
+    for i in range(iterations):
+        for attr, vals, is_derived in transforms:
+            format_facet_values(attr, vals, display_vals, is_derived)
+    stop = time.time()
+    logger.info("[BENCHMARKING] {} passes of {} facet transforms: {}s".format(
+        iterations, len(transforms), str(stop-start)))
+    return stop-start
+
+
+# Time the set-based AttributeQuerySet.get_data_sources against the per-attribute OR'd querysets it replaced, for
+# sets of each of sizes attributes spread over the first 10 data sources, logging the query plan of each. Returns
+# {<size>: {'per_attribute': <seconds>, 'set_based': <seconds>}}.
+def benchmark_attr_get_data_sources(sizes=(5, 50, 500)):
+    timings = {}
+    with transaction.atomic():
+        sources = list(DataSource.objects.all()[:10])
+        if not len(sources):
+            raise Exception("There are no data sources to attach the benchmark's attributes to.")
+        for size in sizes:
+            Attribute.objects.bulk_create([Attribute(
+                name='benchmark_attr_{}_{}'.format(size, i), display_name='Benchmark {}'.format(i)
+            ) for i in range(size)])
+            attrs = Attribute.objects.filter(name__startswith='benchmark_attr_{}_'.format(size))
+            for i, attr in enumerate(attrs):
+                attr.data_sources.add(sources[i % len(sources)])
+
+            start = time.time()
+            legacy = None
+            for attr in attrs:
+                legacy = attr.data_sources.all() if not legacy else (legacy | attr.data_sources.all())
+            legacy = legacy.distinct()
+            list(legacy.values_list('id', flat=True))
+            stop = time.time()
+            timings[size] = {'per_attribute': stop-start}
+
+            start = time.time()
+            data_sources = attrs.get_data_sources()
+            list(data_sources.values_list('id', flat=True))
+            stop = time.time()
+            timings[size]['set_based'] = stop-start
+
+            logger.info("[BENCHMARKING] {} attributes, per-attribute querysets: {}s, set-based query: {}s".format(
+                size, str(timings[size]['per_attribute']), str(timings[size]['set_based'])))
+            logger.info("[BENCHMARKING] Per-attribute query plan: {}".format(legacy.explain()))
+            logger.info("[BENCHMARKING] Set-based query plan: {}".format(data_sources.explain()))
+        transaction.set_rollback(True)
+    return timings
+
+
+# Time a burst of count distinct asynchronous manifest submissions, published to the in-memory broker so nothing is
+# sent to Pub/Sub. Returns the seconds taken.
+def benchmark_submit_manifest_jobs(count=100):
+    topic = 'benchmark-manifest-topic'
+    with override_settings(PUBSUB_BACKEND='memory', PUBSUB_USER_MANIFEST_TOPIC=topic), transaction.atomic():
+        versions = ImagingDataCommonsVersion.objects.filter(active=True)
+        start = time.time()
+        # Distinct manifests, so none are deduplicated
+        for i in range(count):
+            submit_manifest_job(versions, {'collection_id': ['4d_lung']}, 'aws_bucket', 's5cmd',
+                                "# Benchmark {} {}\n".format(start, i), ['crdc_series_uuid', 'aws_bucket'])
+        stop = time.time()
+        get_publisher().pull(topic)
+        transaction.set_rollback(True)
+    logger.info("[BENCHMARKING] {} manifest jobs submitted in {}s".format(count, str(stop-start)))
+    return stop-start
+
+
+# Compress a manifest file with each available encoding, streamed in chunks of chunk_size as a download would be.
+# Returns {<encoding>: {'ratio': <uncompressed/compressed>, 'seconds': <Number>}}.
+def benchmark_manifest_compression(file_name, chunk_size=65536):
+    with open(file_name, "rb") as f:
+        content = f.read()
+    chunks = [content[i:i+chunk_size] for i in range(0, len(content), chunk_size)]
+    results = {}
+    for encoding in available_encodings():
+        start = time.time()
+        compressed = sum(len(x) for x in compress_stream(iter(chunks), encoding))
+        stop = time.time()
+        results[encoding] = {'ratio': len(content) / max(compressed, 1), 'seconds': stop-start}
+        logger.info("[BENCHMARKING] Manifest compression with {}: ratio {}, {}s".format(
+            encoding, results[encoding]['ratio'], str(stop-start)))
+    return results
@@ -23,14 +23,25 @@ from uuid import uuid4
 import os
 import json
 import io
+import itertools
+import threading
+from collections import OrderedDict
 from time import sleep
 from idc_collections.models import Collection, Attribute_Tooltips, DataSource, Attribute, \
     Attribute_Display_Values, Program, DataVersion, DataSourceJoin, DataSetType, Attribute_Set_Type, \
     ImagingDataCommonsVersion
-from solr_helpers import query_solr_and_format_result, query_solr, build_solr_stats, build_solr_facets, build_solr_query
+from solr_helpers import query_solr_and_format_result, query_solr, build_solr_stats, build_solr_facets, build_solr_query, \
+    export_solr, can_export, get_active_version_key
 from google_helpers.bigquery.bq_support import BigQuerySupport
 from google_helpers.bigquery.export_support import BigQueryExportFileList
 from google_helpers.bigquery.utils import build_bq_filter_and_params as build_bq_filter_and_params_v2, build_bq_filter_and_params_v1
+from idc_collections.manifest_jobs import build_manifest_shards, get_manifest_executor, register_manifest_job, \
+    SHARD_BY_SERIES, MANIFEST_INDEX_FILE
+from idc_collections.compression import negotiate_encoding, compress_response, available_encodings, GZIP
+from idc_collections.parquet_export import stream_parquet, parquet_available, manifest_field_types, get_row_group_size, \
+    PARQUET_CONTENT_TYPE
+from idc_collections.manifest_cache import manifest_cache_key, get_cached_manifest, claim_manifest_cache, \
+    cached_manifest_stream, cache_manifest_stream, cache_file_name
 import hashlib
 from django.conf import settings
 from django.shortcuts import render, redirect
@@ -39,15 +50,21 @@ import math
 
 from django.contrib import messages
 from django.http import StreamingHttpResponse, HttpResponse, JsonResponse
-from google.cloud import pubsub_v1
 from google.cloud import storage
 from google.auth import jwt
+from metrics_helpers import histogram, get_caller
 
 BQ_ATTEMPT_MAX = 10
 MAX_FILE_LIST_ENTRIES = settings.MAX_FILE_LIST_REQUEST
 
 logger = logging.getLogger(__name__)
 
+COLLEX_METADATA_SECONDS = histogram(
+    'idc_collex_metadata_seconds', "Time to fetch metadata, by backend, whether the data is current or archived, and "
+    "calling function", ['backend', 'version', 'caller'])
+METADATA_SOURCE_SECONDS = histogram(
+    'idc_metadata_source_seconds', "Time to build and run the Solr queries for one data source", ['source'])
+
 BMI_MAPPING = {
     'underweight': [0, 18.5],
     'normal weight': [18.5, 25],
@@ -132,7 +149,8 @@ def fetch_data_source_attr(sources, fetch_settings, cache_as=None):
 
 
 def fetch_data_source_types(sources):
-    source_ids = [str(x) for x in sources.order_by('id').values_list('id', flat=True)]
+    # Iterate rather than re-query, so an already-evaluated QuerySet costs nothing here
+    source_ids = [str(x) for x in sorted(source.id for source in sources)]
     source_set = ":".join(source_ids)
 
     if source_set not in DATA_SOURCE_TYPES:
@@ -141,6 +159,126 @@ def fetch_data_source_types(sources):
     return DATA_SOURCE_TYPES[source_set]
 
 
+# A graph of the joins available between data sources, built from the DataSourceJoin table in a single query:
+#
+# {
+#   <data source database ID>: {
+#       <joinable data source database ID>: DataSourceJoinEdge, ...
+#   }
+# }
+#
+# Joins only change with a data release, so the graph is loaded once per set of active versions (see
+# get_active_version_key). Resolved paths are cached alongside it, keyed on (from ID, to ID), including pairs which
+# can't be joined (as None). A reload builds a new graph and path cache and swaps both in with a single assignment, so
+# readers on other threads always see a complete graph and the paths resolved against it.
+DATA_SOURCE_JOIN_GRAPH = {'version': None, 'joins': {}, 'paths': {}}
+DATA_SOURCE_JOIN_LOCK = threading.Lock()
+
+
+# A single hop in the join graph; mirrors DataSourceJoin.get_col without the related-object lookups
+class DataSourceJoinEdge(object):
+    def __init__(self, from_id, from_name, from_col, to_id, to_name, to_col):
+        self.from_id = from_id
+        self.from_name = from_name
+        self.from_col = from_col
+        self.to_id = to_id
+        self.to_name = to_name
+        self.to_col = to_col
+
+    def get_col(self, source_name):
+        if source_name == self.from_name:
+            return self.from_col
+        elif source_name == self.to_name:
+            return self.to_col
+        return None
+
+    def reversed(self):
+        return DataSourceJoinEdge(self.to_id, self.to_name, self.to_col, self.from_id, self.from_name, self.from_col)
+
+
+def load_data_source_join_graph(version_key=None):
+    global DATA_SOURCE_JOIN_GRAPH
+    joins = {}
+    for from_id, from_name, from_col, to_id, to_name, to_col in DataSourceJoin.objects.values_list(
+        'from_src_id', 'from_src__name', 'from_src_col', 'to_src_id', 'to_src__name', 'to_src_col'
+    ):
+        edge = DataSourceJoinEdge(from_id, from_name, from_col, to_id, to_name, to_col)
+        joins.setdefault(from_id, {})[to_id] = edge
+        joins.setdefault(to_id, {})[from_id] = edge.reversed()
+    DATA_SOURCE_JOIN_GRAPH = {'version': version_key, 'joins': joins, 'paths': {}}
+    logger.debug("[STATUS] Loaded data source join graph for {} sources.".format(len(joins)))
+    return DATA_SOURCE_JOIN_GRAPH
+
+
+def _find_join_path(joins, from_id, to_id):
+    # Breadth-first, so the path found has the fewest hops
+    visited = {from_id: None}
+    queue = [from_id]
+    while len(queue):
+        current = queue.pop(0)
+        if current == to_id:
+            path = []
+            while visited[current] is not None:
+                prev = visited[current]
+                path.insert(0, joins[prev][current])
+                current = prev
+            return path
+        for neighbor in joins.get(current, {}):
+            if neighbor not in visited:
+                visited[neighbor] = current
+                queue.append(neighbor)
+    return None
+
+
+# Returns the shortest list of DataSourceJoinEdges leading from from_src to to_src, each oriented in that direction
+# (empty if they're the same source); raises an exception if the sources can't be joined
+def fetch_data_source_join_path(from_src, to_src):
+    from_id = from_src if isinstance(from_src, int) else from_src.id
+    to_id = to_src if isinstance(to_src, int) else to_src.id
+    path_key = (from_id, to_id,)
+
+    version_key = get_active_version_key()
+    graph = DATA_SOURCE_JOIN_GRAPH
+    if graph['version'] != version_key:
+        # Only one thread reloads, the rest use the graph it loaded
+        with DATA_SOURCE_JOIN_LOCK:
+            if DATA_SOURCE_JOIN_GRAPH['version'] != version_key:
+                load_data_source_join_graph(version_key)
+            graph = DATA_SOURCE_JOIN_GRAPH
+    if path_key not in graph['paths']:
+        graph['paths'][path_key] = _find_join_path(graph['joins'], from_id, to_id)
+    path = graph['paths'][path_key]
+    if path is None:
+        raise Exception("[ERROR] No join path found between data sources {} and {}.".format(from_id, to_id))
+
+    return path
+
+
+# Returns the direct join between two data sources (equivalent to the DataSourceJoin record between them)
+def fetch_data_source_join(from_src, to_src):
+    path = fetch_data_source_join_path(from_src, to_src)
+    if not len(path):
+        raise Exception("[ERROR] Data source {} can't be joined to itself.".format(
+            from_src if isinstance(from_src, int) else from_src.id
+        ))
+    if len(path) != 1:
+        raise Exception("[ERROR] Data sources {} and {} have no direct join.".format(
+            path[0].from_id, path[-1].to_id
+        ))
+    return path[0]
+
+
+# Build a Solr join query which selects records in to_src based on a query against from_src, nesting joins through any
+# intermediate sources
+def build_solr_join_query(from_src, to_src, query):
+    joined_query = query
+    for edge in fetch_data_source_join_path(from_src, to_src):
+        joined_query = ("{!join %s}" % "from={} fromIndex={} to={}".format(
+            edge.from_col, edge.from_name, edge.to_col
+        )) + joined_query
+    return joined_query
+
+
 def fetch_solr_facets(fetch_settings, cache_as=None):
     facet_set = None
 
@@ -235,6 +373,91 @@ def sortNum(x):
             return float(strt)
 
 
+# Display order of the BMI buckets
+BMI_SORT_ORDER = {'underweight': 0, 'normal weight': 1, 'overweight': 2, 'obese': 3, 'None': 4}
+
+# Display values and categories for the attributes of an explorer attribute set, keyed on the active versions, set
+# name, data sources, and attribute IDs. These only change with a data release, so they're loaded once per version
+# rather than on every explorer request.
+#
+# {
+#   (<active version IDs>, '<set name>_<source IDs asc joined by colon>_<attribute IDs asc joined by colon>'): {
+#       'display_vals': {<attribute ID>: {<raw value>: <display value>, ...}, ...},
+#       'cats': {<attribute name>: {'cat_name': <String>, 'cat_display_name': <String>}, ...}
+#   }
+# }
+#
+# At most MAX_EXPLORER_ATTR_TABLES are held, least recently used dropped first, so tables for a superseded version
+# age out.
+EXPLORER_ATTR_TABLES = OrderedDict()
+MAX_EXPLORER_ATTR_TABLES = 64
+EXPLORER_ATTR_TABLES_LOCK = threading.Lock()
+
+
+# set_attrs: the 'attributes' dict of an attr_by_source set, {<attribute name>: {'id': <Integer>, ...}, ...}
+def fetch_explorer_attr_tables(set_name, sources, set_attrs):
+    attr_ids = sorted(x['id'] for x in set_attrs.values())
+    cache_name = (get_active_version_key(), "{}_{}_{}".format(
+        set_name, ":".join([str(x) for x in sorted(source.id for source in sources)]),
+        ":".join([str(x) for x in attr_ids])
+    ))
+    with EXPLORER_ATTR_TABLES_LOCK:
+        tables = EXPLORER_ATTR_TABLES.get(cache_name, None)
+        if tables is not None:
+            EXPLORER_ATTR_TABLES.move_to_end(cache_name)
+    if tables is None:
+        logger.debug("[STATUS] Explorer attribute tables for {} not found, pulling.".format(cache_name))
+        tables = {
+            'display_vals': Attribute_Display_Values.objects.filter(attribute__id__in=attr_ids).to_dict(),
+            'cats': Attribute.objects.filter(id__in=attr_ids).get_attr_cats()
+        }
+        with EXPLORER_ATTR_TABLES_LOCK:
+            EXPLORER_ATTR_TABLES[cache_name] = tables
+            while len(EXPLORER_ATTR_TABLES) > MAX_EXPLORER_ATTR_TABLES:
+                EXPLORER_ATTR_TABLES.popitem(last=False)
+    return tables
+
+
+# Convert one attribute's faceted counts into an ordered list of value entries, plus its min_max stats if present
+#
+# attr: Attribute object
+# facet_vals: {<value>: <count>, ..., ['min_max': {'min': <Number>, 'max': <Number>}]}
+# display_vals: {<attribute ID>: {<raw value>: <display value>}}
+# is_derived: derived attributes carry their units and sort on their raw value
+def format_facet_values(attr, facet_vals, display_vals, is_derived=False):
+    min_max = None
+    values = []
+    attr_display_vals = display_vals.get(attr.id, {})
+    for val, count in facet_vals.items():
+        if val == 'min_max':
+            min_max = count
+            continue
+        value = {
+            'value': val,
+            'display_value': val if attr.preformatted_values else attr_display_vals.get(val, None)
+        }
+        if is_derived:
+            value['units'] = attr.units
+        value['count'] = count
+        values.append(value)
+
+    if not is_derived and attr.name == 'bmi':
+        values.sort(key=lambda x: BMI_SORT_ORDER[x['value']])
+    elif attr.data_type == Attribute.CONTINUOUS_NUMERIC:
+        values.sort(key=lambda x: sortNum(x['value']))
+        # None sorts first numerically, but is always displayed last
+        if len(values) and values[0]['value'] == 'None':
+            values.append(values.pop(0))
+    elif is_derived:
+        values.sort(key=lambda x: x['value'])
+    else:
+        # Because categorical numerics are a thing, always cast any compared values for sorting to string in case
+        # they're lurking
+        values.sort(key=lambda x: str(x['value']))
+
+    return values, min_max
+
+
 # Build data exploration context/response
 def build_explorer_context(is_dicofdic, source, versions, filters, fields, order_docs, counts_only, with_related,
                            with_derived, collapse_on, is_json, uniques=None, totals=None, with_stats=True,
@@ -324,18 +547,17 @@ def build_explorer_context(is_dicofdic, source, versions, filters, fields, order
         if len(custom_facets.keys()) <= 0:
             custom_facets = None
 
-        start = time.time()
         source_metadata = get_collex_metadata(
             filters, fields, record_limit=3000, offset=0, counts_only=counts_only, with_ancillary=with_related,
             collapse_on=collapse_on, order_docs=order_docs, sources=sources, versions=versions, uniques=uniques,
             record_source=record_source, search_child_records_by=None, totals=totals, custom_facets=custom_facets
         )
-        stop = time.time()
-        logger.debug("[STATUS] Benchmarking: Time to collect metadata for source type {}: {}s".format(
-            "BigQuery" if sources.first().source_type == DataSource.BIGQUERY else "Solr",
-            str((stop - start))
-        ))
-        filtered_attr_by_source = copy.deepcopy(attr_by_source)
+        # Attribute entries are copied individually; the Attribute objects within them are never altered, so there's
+        # no need to deepcopy the whole structure
+        filtered_attr_by_source = {
+            set_type: {'attributes': {name: dict(entry) for name, entry in attr_set['attributes'].items()}}
+            for set_type, attr_set in attr_by_source.items()
+        }
         for which, _attr_by_source in {'filtered_facets': filtered_attr_by_source,
                                        'facets': attr_by_source}.items():
             facet_counts = source_metadata.get(which, {})
@@ -345,110 +567,41 @@ def build_explorer_context(is_dicofdic, source, versions, filters, fields, order
                 source_name = ":".join(source.split(":")[0:2])
                 facet_set = facet_counts[source]['facets']
                 for dataset in data_sets:
-                    if dataset.data_type in source_data_types[int(source.split(":")[-1])]:
-                        set_name = dataset.get_set_name()
-                        if set_name == 'origin_set':
-                            if 'dois' in facet_set:
-                                context['dois'] = facet_set['dois']
-                            if with_stats:
-                                context['stats'] = {}
-                                if 'patient_per_collec' in facet_set:
-                                    context['stats']['patient_per_collec'] = facet_set['patient_per_collec']
-                                else:
-                                    context['stats']['patient_per_collec'] = 0
-                                if 'study_per_collec' in facet_set:
-                                    context['stats']['study_per_collec'] = facet_set['study_per_collec']
-                                else:
-                                    context['stats']['study_per_collec'] = 0
-                                if 'series_per_collec' in facet_set:
-                                    context['stats']['series_per_collec'] = facet_set['series_per_collec']
-                                else:
-                                    context['stats']['series_per_collec'] = 0
-
-                        if dataset.data_type in data_types and set_name in attr_sets:
-                            attr_display_vals = Attribute_Display_Values.objects.filter(
-                                attribute__id__in=attr_sets[set_name]).to_dict()
-                            if dataset.data_type == DataSetType.DERIVED_DATA:
-                                attr_cats = attr_sets[set_name].get_attr_cats()
-                                for attr in facet_set:
-                                    if attr in _attr_by_source[set_name]['attributes']:
-                                        source_name = "{}:{}".format(source_name.split(":")[0],
-                                                                     attr_cats[attr]['cat_name'])
-                                        if source_name not in _attr_by_source[set_name]:
-                                            _attr_by_source[set_name][source_name] = {'attributes': {}}
-                                        _attr_by_source[set_name][source_name]['attributes'][attr] = \
-                                            _attr_by_source[set_name]['attributes'][attr]
-                                        this_attr = _attr_by_source[set_name]['attributes'][attr]['obj']
-                                        values = []
-                                        for val in facet_set[attr]:
-                                            if val == 'min_max':
-                                                _attr_by_source[set_name][source_name]['attributes'][attr][val] = \
-                                                    facet_set[attr][val]
-                                            else:
-                                                displ_val = val if this_attr.preformatted_values else attr_display_vals.get(
-                                                    this_attr.id, {}).get(val, None)
-                                                values.append({
-                                                    'value': val,
-                                                    'display_value': displ_val,
-                                                    'units': this_attr.units,
-                                                    'count': facet_set[attr][val] if val in facet_set[attr] else 0
-                                                })
-                                        if _attr_by_source[set_name][source_name]['attributes'][attr][
-                                            'obj'].data_type == 'N':
-                                            _attr_by_source[set_name][source_name]['attributes'][attr]['vals'] = sorted(
-                                                values, key=lambda x: sortNum(x['value']))
-                                            if _attr_by_source[set_name][source_name]['attributes'][attr]['vals'][0][
-                                                'value'] == 'None':
-                                                litem = _attr_by_source[set_name][source_name]['attributes'][attr][
-                                                    'vals'].pop(0)
-                                                _attr_by_source[set_name][source_name]['attributes'][attr][
-                                                    'vals'].append(litem)
-                                            pass
-                                        else:
-                                            _attr_by_source[set_name][source_name]['attributes'][attr]['vals'] = sorted(
-                                                values, key=lambda x: x['value'])
-                            else:
-                                _attr_by_source[set_name]['All'] = {
-                                    'attributes': _attr_by_source[set_name]['attributes']}
-                                for attr in facet_set:
-                                    if attr in _attr_by_source[set_name]['attributes']:
-                                        this_attr = _attr_by_source[set_name]['attributes'][attr]['obj']
-                                        values = []
-                                        for val in facet_counts[source]['facets'][attr]:
-                                            if val == 'min_max':
-                                                _attr_by_source[set_name]['All']['attributes'][attr][val] = \
-                                                facet_set[attr][
-                                                    val]
-                                            else:
-                                                displ_val = val if this_attr.preformatted_values else attr_display_vals.get(
-                                                    this_attr.id, {}).get(val, None)
-                                                values.append({
-                                                    'value': val,
-                                                    'display_value': displ_val,
-                                                    'count': facet_set[attr][val] if val in facet_set[attr] else 0
-                                                })
-                                        if attr == 'bmi':
-                                            sortDic = {'underweight': 0, 'normal weight': 1, 'overweight': 2,
-                                                       'obese': 3,
-                                                       'None': 4}
-                                            _attr_by_source[set_name]['All']['attributes'][attr]['vals'] = sorted(
-                                                values, key=lambda x: sortDic[x['value']])
-                                        elif _attr_by_source[set_name]['All']['attributes'][attr]['obj'].data_type in [
-                                            Attribute.CONTINUOUS_NUMERIC]:
-                                            _attr_by_source[set_name]['All']['attributes'][attr]['vals'] = sorted(
-                                                values, key=lambda x: sortNum(x['value']))
-                                            if _attr_by_source[set_name]['All']['attributes'][attr]['vals'][0][
-                                                'value'] == 'None':
-                                                litem = _attr_by_source[set_name]['All']['attributes'][attr][
-                                                    'vals'].pop(0)
-                                                _attr_by_source[set_name]['All']['attributes'][attr]['vals'].append(
-                                                    litem)
-                                            pass
-                                        else:
-                                            # Because categorical numerics are a thing, always cast any compared values for sorting to string in case
-                                            # they're lurking
-                                            _attr_by_source[set_name]['All']['attributes'][attr]['vals'] = sorted(
-                                                values, key=lambda x: str(x['value']))
+                    if dataset.data_type not in source_data_types[int(source.split(":")[-1])]:
+                        continue
+                    set_name = dataset.get_set_name()
+                    if set_name == 'origin_set':
+                        if 'dois' in facet_set:
+                            context['dois'] = facet_set['dois']
+                        if with_stats:
+                            context['stats'] = {
+                                x: facet_set.get(x, 0) for x in ['patient_per_collec', 'study_per_collec',
+                                                                 'series_per_collec']
+                            }
+
+                    if dataset.data_type in data_types and set_name in attr_sets:
+                        set_attrs = _attr_by_source[set_name]['attributes']
+                        attr_tables = fetch_explorer_attr_tables(set_name, sources, set_attrs)
+                        is_derived = (dataset.data_type == DataSetType.DERIVED_DATA)
+                        if not is_derived:
+                            _attr_by_source[set_name]['All'] = {'attributes': set_attrs}
+                        for attr in facet_set:
+                            if attr not in set_attrs:
+                                continue
+                            attr_entry = set_attrs[attr]
+                            if is_derived:
+                                # Derived attributes are grouped by their category
+                                source_name = "{}:{}".format(source_name.split(":")[0],
+                                                             attr_tables['cats'][attr]['cat_name'])
+                                if source_name not in _attr_by_source[set_name]:
+                                    _attr_by_source[set_name][source_name] = {'attributes': {}}
+                                _attr_by_source[set_name][source_name]['attributes'][attr] = attr_entry
+                            values, min_max = format_facet_values(
+                                attr_entry['obj'], facet_set[attr], attr_tables['display_vals'], is_derived
+                            )
+                            if min_max is not None:
+                                attr_entry['min_max'] = min_max
+                            attr_entry['vals'] = values
 
         for which, _attr_by_source in {'filtered_attr_by_source': filtered_attr_by_source,
                                        'attr_by_source': attr_by_source}.items():
@@ -601,8 +754,10 @@ def build_explorer_context(is_dicofdic, source, versions, filters, fields, order
     return None
 
 
+# stream: if possible, fetch the records from Solr's /export handler; records will be returned as a generator rather than
+#   a list (see get_metadata_solr)
 def filter_manifest(filters, sources, versions, fields, limit, offset=0, level="SeriesInstanceUID", with_size=False,
-                    series_only=False):
+                    series_only=False, stream=False):
     try:
         custom_facets = None
         search_by = {x: "StudyInstanceUID" for x in filters} if (
@@ -618,7 +773,8 @@ def filter_manifest(filters, sources, versions, fields, limit, offset=0, level="
             filters, fields, limit, offset, sources=sources, versions=versions, counts_only=False,
             collapse_on=level, records_only=bool(custom_facets is None),
             sort="PatientID asc, StudyInstanceUID asc, SeriesInstanceUID asc", filtered_needed=False,
-            search_child_records_by=search_by, custom_facets=custom_facets, default_facets=False
+            search_child_records_by=search_by, custom_facets=custom_facets, default_facets=False,
+            stream_records=stream
         )
 
         return records
@@ -684,14 +840,17 @@ def parse_partition_to_filter(cart_partition):
     return {'filter_string': cart_filter_str, 'parameters': cart_params}
 
 
-# Manifest types supported: s5cmd, idc_index, json.
+# Manifest types supported: s5cmd, idc_index, json. The job is published without waiting on Pub/Sub.
+#
+# With a shard_count above 1, the query is split by shard_key (series or collection) into that many jobs, which run in
+# parallel and each write a numbered file; an index file listing them is written alongside, and the returned file
+# name is that of the index.
 def submit_manifest_job(
         data_version, filters, storage_loc, manifest_type, instructions, fields, from_cart=False,
-        cart_partition=None, filtergrp_list=None, filename=None
+        cart_partition=None, filtergrp_list=None, filename=None, shard_count=1, shard_key=SHARD_BY_SERIES
     ):
     cart_filters = parse_partition_to_filter(cart_partition) if cart_partition else None
     child_records = None if cart_filters else "StudyInstanceUID"
-    publisher = pubsub_v1.PublisherClient()
     jobId = str(uuid4())
     data_version_display = "IDC Data Version(s): {}".format(str(data_version.get_displays(joined=True)))
     timestamp = time.time()
@@ -705,10 +864,23 @@ def submit_manifest_job(
 
     reformatted_fields = [
         "CONCAT('cp s3://',{storage_loc},'/',crdc_series_uuid,'/* ./') AS series".format(storage_loc=storage_loc)]
-    if manifest_type in ["json", "csv", "tsv"]:
+    if manifest_type in ["json", "csv", "tsv", "parquet"]:
         reformatted_fields = None
 
     filters = filters or {}
+    stored_compression = [x for x in getattr(settings, 'MANIFEST_STORED_COMPRESSION', [GZIP]) if x in available_encodings()]
+
+    # Identical requests share one job (finished or still running). The file name, and the header written with it, are
+    # what the requester sees, so only requests for the same file name share a job.
+    content_key = manifest_cache_key(
+        filters=filters if not from_cart else None, cart=[cart_partition, filtergrp_list] if from_cart else None,
+        versions=data_version, fields=fields, file_type=manifest_type, compression=stored_compression, mode='async',
+        storage_loc=storage_loc, instructions=instructions, shard_count=shard_count, shard_key=shard_key,
+        file_name=file_name
+    )
+    cached = get_cached_manifest(content_key)
+    if cached:
+        return cached.job.job_id, cached.job.file_name
 
     if from_cart:
         bq_query_and_params = create_cart_sql(cart_partition, filtergrp_list, storage_loc, lvl="series")
@@ -725,14 +897,33 @@ def submit_manifest_job(
         "jobId": jobId,
         "file_name": file_name,
         "header": header.format(instructions=instructions),
-        "file_type": manifest_type
+        "file_type": manifest_type,
+        # Compressed copies to store alongside the manifest, so fetches accepting them needn't compress on the fly
+        "compression": stored_compression
     }
-
-    future = publisher.publish(settings.PUBSUB_USER_MANIFEST_TOPIC, json.dumps(manifest_job).encode('utf-8'))
-
-    future.result()
-
-    return jobId, "{}/{}".format(jobId, file_name)
+    if manifest_type == 'parquet':
+        # Parquet is written with the column types of the attribute registry
+        manifest_job.update({
+            "fields": fields,
+            "schema": manifest_field_types(fields),
+            "row_group_size": get_row_group_size()
+        })
+
+    # Reformatted and cart queries don't output the fields by name
+    columns = fields if not (from_cart or reformatted_fields) else None
+    shard_jobs, index = build_manifest_shards(manifest_job, shard_count, shard_key, columns)
+
+    # Jobs are batched with any others submitted around the same time and sent in the background; a failed publish
+    # fails the job
+    job = register_manifest_job(shard_jobs, index)
+    entry, created = claim_manifest_cache(content_key, job.file_name, job=job)
+    if not created and entry.job_id and entry.job_id != job.id:
+        # A concurrent request for the same manifest got there first
+        job.delete()
+        return entry.job.job_id, entry.job.file_name
+    get_manifest_executor().submit(shard_jobs, index)
+
+    return jobId, "{}/{}".format(jobId, MANIFEST_INDEX_FILE if index else file_name)
 
 
 # Creates a file manifest of the supplied Cohort object or filters and returns a StreamingFileResponse
@@ -748,6 +939,8 @@ def create_file_manifest(request, cohort=None):
         filtergrp_list = None
         S5CMD_BASE = "cp s3://{}/{}/* .{}"
         file_type = req.get('file_type', 's5cmd').lower()
+        if file_type == 'parquet' and not parquet_available():
+            raise Exception("Parquet manifests were requested, but pyarrow isn't installed.")
         loc = req.get('loc_type_{}'.format(file_type), 'aws')
         storage_bucket = '%s_bucket' % loc
         instructions = ""
@@ -828,26 +1021,49 @@ def create_file_manifest(request, cohort=None):
 
         # All async downloads are managed here
         if async_download and (file_type not in ["bq"]):
+            shard_count = int(req.get('shards', getattr(settings, 'MANIFEST_SHARDS', 1)))
             jobId, file_name = submit_manifest_job(
                 ImagingDataCommonsVersion.objects.filter(active=True), filters, storage_bucket, file_type, instructions,
                 selected_columns_sorted if file_type not in ["s5cmd", "idc_index"] else field_list, from_cart=from_cart,
                 cart_partition=partitions, filtergrp_list=filtergrp_list,
-                filename=file_name
+                filename=file_name, shard_count=shard_count, shard_key=req.get('shard_key', SHARD_BY_SERIES)
             )
-            return JsonResponse({
+            response = {
                 "jobId": jobId,
-                "file_name": file_name
-            }, status=200)
+                "file_name": file_name,
+                "wait": reverse('wait_for_manifest', kwargs={'job_id': jobId})
+            }
+            if shard_count > 1:
+                response['progress'] = reverse('manifest_progress', kwargs={'job_id': jobId})
+            return JsonResponse(response, status=200)
 
         # All downloads from this segment onwards are sync
-        if from_cart:
-            items = cart_manifest(filtergrp_list, partitions, mxstudies, field_list, MAX_FILE_LIST_ENTRIES)
+        # Identical manifests are served from the manifest cache. Only the records are cached: headers may be
+        # particular to this request, so they're always generated fresh.
+        cache_key = manifest_cache_key(
+            filters=filters if not from_cart else None,
+            cart=[partitions, filtergrp_list, mxstudies] if from_cart else None, versions=versions,
+            fields=(selected_columns if file_type == 'json' else selected_columns_sorted), file_type=file_type,
+            mode='sync', storage_bucket=storage_bucket, single_series=single_series, static_fields=static_fields,
+            row_group_size=get_row_group_size(req.get('row_group_size', None)) if file_type == 'parquet' else None
+        )
+        cache_entry = get_cached_manifest(cache_key)
+        if cache_entry:
+            items = {'total': cache_entry.total_records, 'total_instance_size': cache_entry.total_instance_size}
+        # Records are streamed from Solr's /export handler when the requested fields allow it, and are otherwise
+        # paged as usual; either way they're written out as they're read
+        elif from_cart:
+            items = cart_manifest(filtergrp_list, partitions, mxstudies, field_list, MAX_FILE_LIST_ENTRIES, stream=True)
         else:
             items = filter_manifest(filters, sources, versions, field_list, MAX_FILE_LIST_ENTRIES, with_size=True,
-                                    series_only=single_series)
-        if 'docs' in items:
+                                    series_only=single_series, stream=True)
+        if items.get('docs', None) is not None:
             manifest = items['docs']
-        if not manifest or len(manifest) <= 0:
+            if not isinstance(manifest, list):
+                # Streamed records: peek at the first one to make sure there's something to export
+                first = next(manifest, None)
+                manifest = None if first is None else itertools.chain([first], manifest)
+        if not manifest and not cache_entry:
             if 'error' in items:
                 messages.error(request, items['error']['message'])
             else:
@@ -864,6 +1080,17 @@ def create_file_manifest(request, cohort=None):
                     }, status=400)
                 return redirect(reverse('explore_data'))
 
+        # The manifest's records: from the cache if it had them, otherwise formatted from the query results, and
+        # stored in the cache as they're sent unless another request is already doing so
+        def manifest_body(body_rows):
+            if cache_entry:
+                return cached_manifest_stream(cache_entry)
+            entry, created = claim_manifest_cache(cache_key, cache_file_name(cache_key, file_type))
+            if not created:
+                return body_rows
+            return cache_manifest_stream(entry, body_rows, items.get('total', None),
+                                         items.get('total_instance_size', None))
+
         if file_type in ['csv', 'tsv', 's5cmd', 'idc_index']:
             # CSV/TSV/s5cmd/idc_index export
             rows = ()
@@ -920,52 +1147,73 @@ def create_file_manifest(request, cohort=None):
                 if file_type not in ['s5cmd', 'idc_index']:
                     rows += (selected_columns_sorted,)
 
-            for row in manifest:
-                if file_type in ['s5cmd', 'idc_index']:
-                    this_row = S5CMD_BASE.format(row[storage_bucket][0], row['crdc_series_uuid'],
-                                                 os.linesep) if isinstance(row[storage_bucket],
-                                                                           list) else S5CMD_BASE.format(
-                        row[storage_bucket], row['crdc_series_uuid'], os.linesep)
-                    content_type = "text/plain"
-                else:
-                    content_type = "text/csv"
-                    if 'collection_id' in row:
-                        row['collection_id'] = "; ".join(row['collection_id'])
-                    if 'source_DOI' in row:
-                        row['source_DOI'] = ", ".join(row['source_DOI'])
-                    this_row = [(row[x] if x in row else static_fields[x] if x in static_fields else "") for x in
-                                selected_columns_sorted]
-                rows += (this_row,)
+            content_type = "text/plain" if file_type in ['s5cmd', 'idc_index'] else "text/csv"
+
+            def manifest_rows():
+                for row in manifest:
+                    if file_type in ['s5cmd', 'idc_index']:
+                        this_row = S5CMD_BASE.format(row[storage_bucket][0], row['crdc_series_uuid'],
+                                                     os.linesep) if isinstance(row[storage_bucket],
+                                                                               list) else S5CMD_BASE.format(
+                            row[storage_bucket], row['crdc_series_uuid'], os.linesep)
+                    else:
+                        if 'collection_id' in row:
+                            row['collection_id'] = "; ".join(row['collection_id'])
+                        if 'source_DOI' in row:
+                            row['source_DOI'] = ", ".join(row['source_DOI'])
+                        this_row = [(row[x] if x in row else static_fields[x] if x in static_fields else "") for x in
+                                    selected_columns_sorted]
+                    yield this_row
 
             if file_type in ['s5cmd', 'idc_index']:
-                response = StreamingHttpResponse((row for row in rows), content_type=content_type)
+                header_rows, body_rows = rows, manifest_rows()
             else:
                 pseudo_buffer = Echo()
                 if file_type == 'csv':
                     writer = csv.writer(pseudo_buffer)
                 elif file_type == 'tsv':
                     writer = csv.writer(pseudo_buffer, delimiter='\t')
-                response = StreamingHttpResponse((writer.writerow(row) for row in rows), content_type=content_type)
+                header_rows = (writer.writerow(row) for row in rows)
+                body_rows = (writer.writerow(row) for row in manifest_rows())
+            response = StreamingHttpResponse(itertools.chain(header_rows, manifest_body(body_rows)),
+                                             content_type=content_type)
 
         elif file_type == 'json':
             # JSON export
-            json_result = ""
+            def json_rows():
+                for row in manifest:
+                    if 'collection_id' in row:
+                        row['collection_id'] = "; ".join(row['collection_id'])
+                    if 'source_DOI' in row:
+                        row['source_DOI'] = ", ".join(row['source_DOI'])
+                    this_row = {}
+                    for key in selected_columns:
+                        this_row[key] = row[key] if key in row else ""
 
-            for row in manifest:
-                if 'collection_id' in row:
-                    row['collection_id'] = "; ".join(row['collection_id'])
-                if 'source_DOI' in row:
-                    row['source_DOI'] = ", ".join(row['source_DOI'])
-                this_row = {}
-                for key in selected_columns:
-                    this_row[key] = row[key] if key in row else ""
+                    yield json.dumps(this_row) + "\n"
 
-                json_row = json.dumps(this_row) + "\n"
-                json_result += json_row
+            response = StreamingHttpResponse(manifest_body(json_rows()), content_type="text/json")
 
-            response = HttpResponse(json_result, content_type="text/json")
+        elif file_type == 'parquet':
+            # Parquet export, written out one row group at a time. The header details are kept in the file's metadata.
+            def parquet_rows():
+                for row in manifest:
+                    this_row = {}
+                    for key in selected_columns_sorted:
+                        this_row[key] = row[key] if key in row else static_fields[key] if key in static_fields else None
+                    yield this_row
+
+            response = StreamingHttpResponse(manifest_body(stream_parquet(
+                parquet_rows(), selected_columns_sorted, row_group_size=req.get('row_group_size', None),
+                metadata={'idc_version': "; ".join([str(x) for x in versions])}
+            )), content_type=PARQUET_CONTENT_TYPE)
 
         response['Content-Disposition'] = 'attachment; filename=' + file_name
+        # Manifests are largely repeated URL text and so compress well; rows are compressed as they're streamed.
+        # Parquet files are already compressed, so they're only compressed again if that's explicitly asked for.
+        compression = req.get('compression', None)
+        if compression or file_type != 'parquet':
+            compress_response(response, negotiate_encoding(request, compression), file_name, as_file=bool(compression))
         response.set_cookie("downloadToken", req.get('downloadToken'))
     except Exception as e:
         logger.error("[ERROR] While creating an export manifest:")
@@ -997,13 +1245,15 @@ def get_collex_metadata(filters, fields, record_limit=3000, offset=0, counts_onl
                         collapse_on='PatientID', order_docs=None, sources=None, versions=None, with_derived=True,
                         facets=None, records_only=False, sort=None, uniques=None, record_source=None, totals=None,
                         search_child_records_by=None, filtered_needed=True, custom_facets=None, raw_format=False,
-                        default_facets=True, aux_sources=None):
+                        default_facets=True, aux_sources=None, stream_records=False):
+    caller = get_caller()
     try:
         source_type = sources.first().source_type if sources else DataSource.SOLR
 
         if not versions:
             versions = ImagingDataCommonsVersion.objects.get(active=True).dataversion_set.all().distinct()
-        if not versions.first().active and not sources:
+        archived = not versions.first().active
+        if archived and not sources:
             source_type = DataSource.BIGQUERY
 
         if not sources:
@@ -1034,10 +1284,15 @@ def get_collex_metadata(filters, fields, record_limit=3000, offset=0, counts_onl
                 filters, fields, sources, counts_only, collapse_on, record_limit, offset, facets, records_only, sort,
                 uniques, record_source, totals, search_child_records_by=search_child_records_by,
                 filtered_needed=filtered_needed, custom_facets=custom_facets, raw_format=raw_format,
-                default_facets=default_facets, aux_sources=aux_sources
+                default_facets=default_facets, aux_sources=aux_sources,
+                # Streamed records can't be post-processed below
+                stream_records=bool(stream_records and not order_docs and 'SeriesNumber' not in (fields or []))
             )
         stop = time.time()
-        logger.debug("Metadata received: {}".format(stop - start))
+        COLLEX_METADATA_SECONDS.observe(
+            stop - start, backend="bigquery" if source_type == DataSource.BIGQUERY else "solr",
+            version="archived" if archived else "current", caller=caller
+        )
         if not raw_format:
             for counts in ['facets', 'filtered_facets']:
                 facet_set = results.get(counts, {})
@@ -1132,12 +1387,7 @@ def create_query_set(solr_query, sources, source, all_ui_attrs, image_source, Da
                             if DataSetType.IMAGE_DATA in source_data_types[source.id] or DataSetType.IMAGE_DATA in \
                                     source_data_types[ds.id]:
                                 joined_origin = True
-                            # DataSource join pairs are unique, so, this should only produce a single record
-                            source_join = DataSourceJoin.objects.get(from_src__in=[ds.id, source.id],
-                                                                     to_src__in=[ds.id, source.id])
-                            joined_query = ("{!join %s}" % "from={} fromIndex={} to={}".format(
-                                source_join.get_col(ds.name), ds.name, source_join.get_col(source.name)
-                            )) + solr_query['queries'][attr]
+                            joined_query = build_solr_join_query(ds, source, solr_query['queries'][attr])
                             if DataSetType.ANCILLARY_DATA in source_data_types[
                                 ds.id] and not DataSetType.ANCILLARY_DATA in source_data_types[source.id]:
                                 joined_query = '(has_related:"False" OR _query_:"%s")' % joined_query.replace("\"",
@@ -1148,11 +1398,7 @@ def create_query_set(solr_query, sources, source, all_ui_attrs, image_source, Da
                     list(sources.values_list('name', flat=True)))))
 
     if not joined_origin and not DataSetType.IMAGE_DATA in source_data_types[source.id]:
-        source_join = DataSourceJoin.objects.get(from_src__in=[image_source.id, source.id],
-                                                 to_src__in=[image_source.id, source.id])
-        query_set.append(("{!join %s}" % "from={} fromIndex={} to={}".format(
-            source_join.get_col(image_source.name), image_source.name, source_join.get_col(source.name)
-        )) + "*:*")
+        query_set.append(build_solr_join_query(image_source, source, "*:*"))
 
     return query_set
 
@@ -1205,38 +1451,141 @@ def parse_partition_att_strings(query_sets, partition, join_with_child):
     return attStrA
 
 
-def create_cart_query_string(query_list, partitions, join_with_child, as_terms=False):
+# Compiled cart query strings, keyed on a hash of the inputs which produced them (filter groups, cart partitions, and
+# options). Carts are re-sent with every table page and stats call, so the same partitions are compiled over and over
+# for the life of a user's session.
+CART_QUERY_STRINGS = {}
+CART_QUERY_CACHE_MAX = 512
+CART_QUERY_LOCK = threading.Lock()
+
+# ID sets at or above this size are sent as a {!terms} query rather than a series of OR'd clauses
+CART_TERMS_THRESHOLD = 8
+# Solr's maxBooleanClauses (default 1024) caps the clauses in the whole query, however they're nested, so carts which
+# would exceed this many are compiled with every ID set as a {!terms} query, which counts as a single clause
+CART_MAX_CLAUSES = 1000
+# {!terms} splits its value on a separator; the first of these which doesn't appear in any of the IDs is used
+CART_TERMS_SEPARATORS = [',', '|', ';', '~', '^']
+CART_LEVEL_FIELDS = ["collection_id", "PatientID", "StudyInstanceUID", "SeriesInstanceUID"]
+
+
+def _cart_cache_key(*args):
+    return hashlib.sha256(json.dumps(args, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+# Store a value, returning the one now cached under the key (which is another thread's, if it got there first)
+def _cache_cart_value(key, value):
+    with CART_QUERY_LOCK:
+        if key in CART_QUERY_STRINGS:
+            return CART_QUERY_STRINGS[key]
+        if len(CART_QUERY_STRINGS) >= CART_QUERY_CACHE_MAX:
+            # Drop the oldest entry
+            CART_QUERY_STRINGS.pop(next(iter(CART_QUERY_STRINGS)))
+        CART_QUERY_STRINGS[key] = value
+        return value
+
+
+def _quote_escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+
+def _cart_id_clause(field, ids, as_terms=False):
+    if as_terms or len(ids) >= CART_TERMS_THRESHOLD:
+        separator = next((x for x in CART_TERMS_SEPARATORS if not any(x in y for y in ids)), None)
+        if separator:
+            return '_query_:"{!terms f=%s%s}%s"' % (
+                field, " separator='{}'".format(separator) if separator != ',' else "",
+                _quote_escape(separator.join(ids)))
+    return '+{}:({})'.format(field, " OR ".join(['"{}"'.format(_quote_escape(x)) for x in ids]))
+
+
+# Approximate number of boolean clauses in a query string, as counted against maxBooleanClauses: each {!terms} query
+# counts once, as does each quoted value or range outside of one
+def _cart_clause_count(query_string):
+    terms = re.findall(r'_query_:"\{!terms(?:[^"\\]|\\.)*"', query_string)
+    rest = re.sub(r'_query_:"\{!terms(?:[^"\\]|\\.)*"', '', query_string)
+    return len(terms) + len(re.findall(r'"(?:[^"\\]|\\.)*"|\[[^\]]*\]', rest))
+
+
+# As parse_partition_string, but large exclusion sets are sent as a {!terms} query
+def _cart_partition_string(partition, as_terms=False):
+    id = partition['id']
+    part_str = " AND ".join(
+        ['(' + _cart_id_clause(CART_LEVEL_FIELDS[i], [id[i]]) + ')' for i in range(0, len(id))]
+    )
+    if len(partition['not']) > 0:
+        part_str += ' AND NOT (' + _cart_id_clause(CART_LEVEL_FIELDS[len(id)], partition['not'], as_terms) + ')'
+    return part_str
+
+
+# Compile a set of cart partitions into a Solr query string.
+#
+# Partitions which share a level, a parent collection, and a set of filter strings, and which have no exclusions, are
+# combined into a single ID set per group; partitions wholly contained in another partition with the same filters are
+# dropped. Exclusion sets and ID sets are emitted as {!terms} queries once they're large enough to warrant it. The
+# result is equivalent to OR'ing every partition's clauses together individually.
+#
+# query_list: list of filter group query strings, indexed by each partition's 'filt' entries
+# partitions: list of cart partitions, each of the form {'id': [<collection_id>, [<PatientID>, ...]], 'not': [...],
+#   'filt': [[<query_list index>, ...], ...]}
+# join_with_child: if True, filter group strings are joined to their child records on StudyInstanceUID
+# as_terms: if True, always use {!terms} for ID sets and exclusions
+def compile_cart_query_string(query_list, partitions, join_with_child, as_terms=False):
+    clauses = []
+    groups = {}
+    compiled = []
+    for part in partitions:
+        compiled.append((part, tuple(parse_partition_att_strings(query_list, part, join_with_child))))
+
+    whole = set((tuple(part['id']), att_strs,) for part, att_strs in compiled if not len(part['not']))
+
+    for part, att_strs in compiled:
+        id = part['id']
+        if any((tuple(id[:i]), att_strs,) in whole for i in range(1, len(id))):
+            # Already covered by a partition higher up the hierarchy
+            continue
+        if len(part['not']):
+            clauses.append((_cart_partition_string(part, as_terms), att_strs,))
+        else:
+            # Study and series UIDs are unique, but a study can be present in more than one collection (eg. analysis
+            # results), so IDs are always grouped under their collection
+            group_key = (len(id)-1, tuple(id[:1]) if len(id) > 1 else (), att_strs,)
+            if group_key not in groups:
+                groups[group_key] = []
+                clauses.append((group_key, att_strs,))
+            if id[-1] not in groups[group_key]:
+                groups[group_key].append(id[-1])
+
     solrA = []
-    # Clause counts over 1024 must be handled as a terms query
-    if as_terms or len(partitions) > 1000:
-        term_q = ""
-        term_fields = ["collection_id", "PatientID", "StudyInstanceUID", "SeriesInstanceUID"]
-        term_qs = {
-            "collection_id": [],
-            "PatientID": [],
-            "StudyInstanceUID": [],
-            "SeriesInstanceUID": []
-        }
-        for part in partitions:
-            term_level = len(part['id'])-1
-            term_qs[term_fields[term_level]].append(part['id'][-1])
-        for term, terms in term_qs.items():
-            if len(terms):
-                term_q += "{!terms f="+term+"}" + ",".join(terms)
-        return term_q
-
-    for i in range(len(partitions)):
-        cur_part = partitions[i]
-        cur_part_attr_strA = parse_partition_att_strings(query_list, cur_part, join_with_child)
-        cur_part_str = parse_partition_string(cur_part)
-        for j in range(len(cur_part_attr_strA)):
-            if (len(cur_part_attr_strA[j]) > 0):
-                solrA.append('(' + cur_part_str + ') AND (' + cur_part_attr_strA[j] + ')')
+    for clause, att_strs in clauses:
+        if clause in groups:
+            level, parent, x = clause
+            id_clauses = ['(' + _cart_id_clause(CART_LEVEL_FIELDS[0], list(parent)) + ')'] if len(parent) else []
+            id_clauses.append('(' + _cart_id_clause(CART_LEVEL_FIELDS[level], groups[clause], as_terms) + ')')
+            clause = " AND ".join(id_clauses)
+        for att_str in att_strs:
+            if len(att_str) > 0:
+                solrA.append('(' + clause + ') AND (' + att_str + ')')
             else:
-                solrA.append(cur_part_str)
-    solrA = ['(' + x + ')' for x in solrA]
-    solrStr = ' OR '.join(solrA)
-    return solrStr
+                solrA.append(clause)
+    query_string = ' OR '.join(['(' + x + ')' for x in solrA])
+
+    clause_count = _cart_clause_count(query_string)
+    if clause_count > CART_MAX_CLAUSES:
+        if not as_terms:
+            return compile_cart_query_string(query_list, partitions, join_with_child, as_terms=True)
+        logger.warning("[WARNING] Cart query has about {} clauses, more than CART_MAX_CLAUSES ({}); Solr may reject it.".format(
+            clause_count, CART_MAX_CLAUSES))
+
+    return query_string
+
+
+def create_cart_query_string(query_list, partitions, join_with_child, as_terms=False):
+    cache_key = _cart_cache_key('query_string', query_list, partitions, join_with_child, as_terms)
+    query_string = CART_QUERY_STRINGS.get(cache_key, None)
+    if query_string is None:
+        query_string = _cache_cart_value(
+            cache_key, compile_cart_query_string(query_list, partitions, join_with_child, as_terms))
+    return query_string
 
 
 table_formats = {
@@ -1565,11 +1914,20 @@ upstream_cart_facets = {
 }
 
 
+# Produces [<current filter string>, <full cart string>, <study level cart string>, <series level cart string>]; results are
+# cached against the active version, filters, and cart (see CART_QUERY_STRINGS)
 def generate_solr_cart_and_filter_strings(current_filters, filtergrp_list, partitions):
     aggregate_level = "StudyInstanceUID"
-    versions = ImagingDataCommonsVersion.objects.filter(
-        active=True
-    ).get_data_versions(active=True)
+    active_versions = ImagingDataCommonsVersion.objects.filter(active=True)
+    cache_key = _cart_cache_key(
+        'cart_and_filter_strings', list(active_versions.values_list('version_number', flat=True)), current_filters,
+        filtergrp_list, partitions
+    )
+    if cache_key in CART_QUERY_STRINGS:
+        return list(CART_QUERY_STRINGS[cache_key])
+    cacheable = True
+
+    versions = active_versions.get_data_versions(active=True)
 
     data_types = [DataSetType.IMAGE_DATA, DataSetType.ANCILLARY_DATA, DataSetType.DERIVED_DATA]
     data_sets = DataSetType.objects.filter(data_type__in=data_types)
@@ -1605,6 +1963,7 @@ def generate_solr_cart_and_filter_strings(current_filters, filtergrp_list, parti
             current_filt_str = "".join(current_filt_query_set)
         except:
             current_filt_str = ""
+            cacheable = False
     else:
         current_filt_str = None
 
@@ -1669,7 +2028,11 @@ def generate_solr_cart_and_filter_strings(current_filters, filtergrp_list, parti
         cart_query_str_serieslvl = None
         cart_query_str_studylvl = None
 
-    return ([current_filt_str, cart_query_str_all, cart_query_str_studylvl, cart_query_str_serieslvl])
+    result = [current_filt_str, cart_query_str_all, cart_query_str_studylvl, cart_query_str_serieslvl]
+    if cacheable:
+        _cache_cart_value(cache_key, list(result))
+
+    return result
 
 
 def get_table_data_with_cart_data(tabletype, sortarg, sortdir, current_filters, filtergrp_list, partitions, limit,
@@ -1719,6 +2082,8 @@ def get_table_data_with_cart_data(tabletype, sortarg, sortdir, current_filters,
     num_found = 0
     tblfiltstr = ""
     tblitems = ['PatientID', 'StudyInstanceUID', 'SeriesInstanceUID']
+    # Attribute records for the page, if they were retrieved as part of determining the page's IDs
+    page_docs = None
 
     for tblitem in tblitems:
         if (tblitem in current_filters):
@@ -1787,19 +2152,23 @@ def get_table_data_with_cart_data(tabletype, sortarg, sortdir, current_filters,
         else:
             fqs = None
 
+        # This is the same record set the attribute query below would retrieve (same core, filters, sort, and
+        # collapse) so fetch the attribute fields now and save a round trip
         rng_query = query_solr(
-            collection=imgNm, fields=[id], query_string=None, fqs=fqs,
+            collection=imgNm, fields=field_list, query_string=None, fqs=fqs,
             facets=None, sort=sortStr, counts_only=False, collapse_on=collapse_id, offset=offset, limit=limit,
             uniques=None, with_cursor=None, stats=None, totals=None, op='AND'
         )
         sorted_ids = [x[id] for x in rng_query['response']['docs']]
         num_found = rng_query['response']['numFound']
+        page_docs = rng_query['response']['docs']
 
     # If nothing matched our search string, there's no need to do the rest.
     if num_found <= 0:
         return [num_found, []]
 
-    rngfilt = '(+' + id + ':(' + ' OR '.join(['"' + x + '"' for x in sorted_ids]) + '))'
+    # Large pages are sent as a terms query, so the clause count doesn't grow with the page size
+    rngfilt = '(' + _cart_id_clause(id, sorted_ids) + ')'
     # define table array to put results in tabular form
     table_arr = []
     idRowNumMp = {}
@@ -1879,7 +2248,9 @@ def get_table_data_with_cart_data(tabletype, sortarg, sortdir, current_filters,
 
     attr_results = []
     # if table is collections, don't need attributes only cart stats. if table is series used series store
-    if tabletype not in ["series", "collections"]:
+    if page_docs is not None:
+        attr_results.append(page_docs)
+    elif tabletype not in ["series", "collections"]:
         solr_result = query_solr(
             collection=image_source.name, fields=field_list, query_string=None, fqs=fqset[:],
             facets=None, sort=sortStr, counts_only=False, collapse_on=collapse_id, offset=0, limit=limit,
@@ -1887,7 +2258,7 @@ def get_table_data_with_cart_data(tabletype, sortarg, sortdir, current_filters,
         )
         attr_results.append(solr_result['response']['docs'])
 
-    if tabletype == "series":
+    elif tabletype == "series":
         solr_result_serieslvl = query_solr(
             collection=image_source_series.name, fields=field_list, query_string=None, fqs=fqset[:],
             facets=None, sort=sortStr, counts_only=False, collapse_on=collapse_id, offset=0, limit=limit,
@@ -1935,26 +2306,26 @@ def get_table_data_with_cart_data(tabletype, sortarg, sortdir, current_filters,
 
     if tabletype in ["cases", "series", "studies"]:
         collstr = list(attrRowNumMp["collections"].keys())
-        colrngfilt = '(+collection_id:(' + ' OR '.join(['"' + x + '"' for x in collstr]) + '))'
+        colrngfilt = '(' + _cart_id_clause('collection_id', collstr) + ')'
         custom_facets["upstream_collection_filter"] = copy.deepcopy(upstream_cart_facets["upstream_collection_filter"])
         custom_facets["upstream_collection_filter"]["domain"]["filter"] = colrngfilt + no_tble_item_filt_str
 
     if tabletype in ["series", "studies"]:
         casestr = list(attrRowNumMp["cases"].keys())
-        caserngfilt = '(+PatientID:(' + ' OR '.join(['"' + x + '"' for x in casestr]) + '))'
+        caserngfilt = '(' + _cart_id_clause('PatientID', casestr) + ')'
         custom_facets["upstream_case_filter"] = copy.deepcopy(upstream_cart_facets["upstream_case_filter"])
         custom_facets["upstream_case_filter"]["domain"]["filter"] = caserngfilt + no_tble_item_filt_str
 
     if tabletype in ["series"]:
         studystr = list(attrRowNumMp["studies"].keys())
-        studyrngfilt = '(+StudyInstanceUID:(' + ' OR '.join(['"' + x + '"' for x in studystr]) + '))'
+        studyrngfilt = '(' + _cart_id_clause('StudyInstanceUID', studystr) + ')'
         custom_facets["upstream_study_filter"] = copy.deepcopy(upstream_cart_facets["upstream_study_filter"])
         custom_facets["upstream_study_filter"]["domain"]["filter"] = studyrngfilt + no_tble_item_filt_str
 
     if with_cart:
         if tabletype in ["cases", "series", "studies"]:
             collstr = list(attrRowNumMp["collections"].keys())
-            colrngfilt = '(+collection_id:(' + ' OR '.join(['"' + x + '"' for x in collstr]) + '))'
+            colrngfilt = '(' + _cart_id_clause('collection_id', collstr) + ')'
             colrngQ = '(' + colrngfilt + ')(' + cart_query_str_all + ')'
             custom_facets["upstream_collection_cart"] = copy.deepcopy(upstream_cart_facets["upstream_collection_cart"])
             custom_facets["upstream_collection_cart"]["domain"]["filter"] = colrngQ
@@ -1965,7 +2336,7 @@ def get_table_data_with_cart_data(tabletype, sortarg, sortdir, current_filters,
 
         if tabletype in ["series", "studies"]:
             casestr = list(attrRowNumMp["cases"].keys())
-            caserngfilt = '(+PatientID:(' + ' OR '.join(['"' + x + '"' for x in casestr]) + '))'
+            caserngfilt = '(' + _cart_id_clause('PatientID', casestr) + ')'
             caserngQ = '(' + caserngfilt + ')(' + cart_query_str_all + ')'
             custom_facets["upstream_case_cart"] = copy.deepcopy(upstream_cart_facets["upstream_case_cart"])
             custom_facets["upstream_case_cart"]["domain"]["filter"] = caserngQ
@@ -1975,7 +2346,7 @@ def get_table_data_with_cart_data(tabletype, sortarg, sortdir, current_filters,
 
         if tabletype in ["series"]:
             studystr = list(attrRowNumMp["studies"].keys())
-            studyrngfilt = '(+StudyInstanceUID:(' + ' OR '.join(['"' + x + '"' for x in studystr]) + '))'
+            studyrngfilt = '(' + _cart_id_clause('StudyInstanceUID', studystr) + ')'
             studyrngQ = '(' + studyrngfilt + ')(' + cart_query_str_all + ')'
             custom_facets["upstream_study_cart"] = copy.deepcopy(upstream_cart_facets["upstream_study_cart"])
             custom_facets["upstream_study_cart"]["domain"]["filter"] = studyrngQ
@@ -2023,7 +2394,7 @@ def get_table_data_with_cart_data(tabletype, sortarg, sortdir, current_filters,
 
     # if there is a serieslvl component of cart get series stats for that
     if not (cart_query_str_serieslvl == None) and (len(cart_query_str_serieslvl) > 0):
-        custom_facets = cart_facets_serieslvl
+        custom_facets = copy.deepcopy(cart_facets_serieslvl)
         custom_facets["series_in_filter_and_cart"]["domain"] = {"filter": cart_query_str_serieslvl}
         custom_facets["series_in_filter_and_cart"]["field"] = id
 
@@ -2323,7 +2694,10 @@ def get_cart_data_studylvl(filtergrp_list, partitions, limit, offset, length, mx
     return solr_result['response']
 
 
-def get_cart_data_serieslvl(filtergrp_list, partitions, field_list, limit, offset, with_records=True, dois_only=False, size_only=False):
+# stream_records: if the fields requested are all docValues-backed, fetch the records from Solr's /export handler, in which
+#   case the 'docs' returned will be a generator of at most limit records
+def get_cart_data_serieslvl(filtergrp_list, partitions, field_list, limit, offset, with_records=True, dois_only=False,
+                            size_only=False, stream_records=False):
     aggregate_level = "SeriesInstanceUID"
     limit = limit if with_records else 0
 
@@ -2376,10 +2750,16 @@ def get_cart_data_serieslvl(filtergrp_list, partitions, field_list, limit, offse
         query_list.append(query_string_for_filt)
 
     query_str = create_cart_query_string(query_list, partitions, False)
+    export_sort = "SeriesInstanceUID asc"
+    # This source is series-level, so the collapse is implicit and /export can be used in place of paging
+    stream_records = stream_records and with_records and not offset and can_export(image_source.name, field_list, export_sort)
     solr_result = query_solr(collection=image_source.name, fields=field_list, query_string=None, fqs=[query_str],
-                             facets=custom_facets, sort=None, counts_only=False, collapse_on='SeriesInstanceUID',
+                             facets=custom_facets, sort=None, counts_only=stream_records, collapse_on='SeriesInstanceUID',
                              offset=offset, limit=limit, uniques=None,
                              with_cursor=None, stats=None, totals=['SeriesInstanceUID', 'collection_id', 'PatientID', 'StudyInstanceUID'], op='AND')
+    if stream_records:
+        docs = export_solr(collection=image_source.name, fields=field_list, fqs=[query_str], sort=export_sort, op='AND')
+        solr_result['response']['docs'] = itertools.islice(docs, limit) if limit else docs
     solr_result['response']['total'] = solr_result['facets']['total_SeriesInstanceUID']
     solr_result['response']['facets'] = solr_result['facets']
 
@@ -2553,9 +2933,10 @@ def create_cart_sql(partitions, filtergrp_lst, storage_loc, lvl="series"):
     return {'sql_string': cart_sql, 'params': params}
 
 
-def cart_manifest(filtergrp_list, partitions, mxstudies, field_list, MAX_FILE_LIST_ENTRIES):
+def cart_manifest(filtergrp_list, partitions, mxstudies, field_list, MAX_FILE_LIST_ENTRIES, stream=False):
     manifest = {}
-    solr_result = get_cart_data_serieslvl(filtergrp_list, partitions, field_list, MAX_FILE_LIST_ENTRIES, 0)
+    solr_result = get_cart_data_serieslvl(filtergrp_list, partitions, field_list, MAX_FILE_LIST_ENTRIES, 0,
+                                          stream_records=stream)
     manifest['docs'] = solr_result['docs']
     manifest['facets'] = solr_result['facets']
 
@@ -2598,11 +2979,15 @@ def cart_manifest(filtergrp_list, partitions, mxstudies, field_list, MAX_FILE_LI
 #   higher order parent, based on the provided attribute name (str)
 # filtered_needed: (optional) boolean indicating the faceted counts should also include a set of fully filtered counts
 # raw_format: (optional) boolean indicating the Solr result should not be parsed, merely returned as it is received from Solr
+# stream_records: (optional) boolean indicating records should be streamed from Solr's /export handler when all fields and
+#   sort fields are docValues-backed and the collapse (if any) is implied by the record source's aggregation level. In
+#   that case results['docs'] is a generator of at most record_limit documents instead of a list, and a records_only
+#   request gets no 'total' back. Not available for offset or cursor requests, which will always page normally.
 #
 def get_metadata_solr(filters, fields, sources, counts_only, collapse_on, record_limit, offset=0, attr_facets=None,
                       records_only=False, sort=None, uniques=None, record_source=None, totals=None, cursor=None,
                       search_child_records_by=None, filtered_needed=True, custom_facets=None, raw_format=False,
-                      default_facets=True, aux_sources=None):
+                      default_facets=True, aux_sources=None, stream_records=False):
     filters = filters or {}
     results = {'docs': None, 'facets': {}}
 
@@ -2724,9 +3109,7 @@ def get_metadata_solr(filters, fields, sources, counts_only, collapse_on, record
                 }, raw_format=raw_format)
 
             stop = time.time()
-            logger.info("[BENCHMARKING] Total time to examine source {} and query: {}".format(
-                source.name, str(stop - start))
-            )
+            METADATA_SOURCE_SECONDS.observe(stop - start, source=source.name)
 
             if DataSetType.IMAGE_DATA in source_data_types[source.id]:
                 if 'numFound' in solr_result:
@@ -2759,22 +3142,29 @@ def get_metadata_solr(filters, fields, sources, counts_only, collapse_on, record
                     "[WARNING] Requesting records without a field lists results in all fields being returned, which we almost never want!")
                 logger.warning("[WARNING] Always give a precise list of fields!")
                 fields = ["collection_id", "SeriesInstanceUID", "StudyInstanceUID", "PatientID", "program_name"]
-            solr_result = query_solr_and_format_result({
-                'collection': source.name if not record_source else record_source.name,
-                'fields': list(fields),
-                'fqs': query_set,
-                'query_string': None,
-                'collapse_on': collapse_on,
-                'counts_only': counts_only,
-                'sort': sort,
-                'limit': record_limit,
-                'offset': offset if not cursor else 0,
-                'with_cursor': cursor
-            })
+            doc_source = source if not record_source else record_source
+            if stream_records and not offset and not cursor and (
+                    collapse_on is None or collapse_on == doc_source.aggregate_level
+            ) and can_export(doc_source.name, fields, sort):
+                docs = export_solr(collection=doc_source.name, fields=list(fields), fqs=query_set, sort=sort)
+                results['docs'] = itertools.islice(docs, record_limit) if record_limit else docs
+            else:
+                solr_result = query_solr_and_format_result({
+                    'collection': doc_source.name,
+                    'fields': list(fields),
+                    'fqs': query_set,
+                    'query_string': None,
+                    'collapse_on': collapse_on,
+                    'counts_only': counts_only,
+                    'sort': sort,
+                    'limit': record_limit,
+                    'offset': offset if not cursor else 0,
+                    'with_cursor': cursor
+                })
 
-            results['docs'] = solr_result['docs']
-            if records_only:
-                results['total'] = solr_result['numFound']
+                results['docs'] = solr_result['docs']
+                if records_only:
+                    results['total'] = solr_result['numFound']
 
     return results
 
@@ -2908,9 +3298,8 @@ def get_bq_facet_counts(filters, facets, data_versions, sources_and_attrs=None):
                     )
                     param_sfx += 1
 
-                    source_join = DataSourceJoin.objects.get(
-                        from_src__in=[table_info[filter_bqtable]['id'], table_info[image_table]['id']],
-                        to_src__in=[table_info[filter_bqtable]['id'], table_info[image_table]['id']]
+                    source_join = fetch_data_source_join(
+                        table_info[filter_bqtable]['id'], table_info[image_table]['id']
                     )
                     join_type = ""
                     if table_info[filter_bqtable]['set'] == DataSetType.RELATED_SET:
@@ -2938,9 +3327,8 @@ def get_bq_facet_counts(filters, facets, data_versions, sources_and_attrs=None):
                 facet_joins = copy.deepcopy(joins)
                 source_join = None
                 if facet_table not in image_tables and facet_table not in tables_in_query:
-                    source_join = DataSourceJoin.objects.get(
-                        from_src__in=[table_info[facet_table]['id'], table_info[image_table]['id']],
-                        to_src__in=[table_info[facet_table]['id'], table_info[image_table]['id']]
+                    source_join = fetch_data_source_join(
+                        table_info[facet_table]['id'], table_info[image_table]['id']
                     )
                     facet_joins.append(join_clause_base.format(
                         join_from_alias=table_info[image_table]['alias'],
@@ -3266,9 +3654,8 @@ def get_bq_metadata(filters, fields, data_version, sources_and_attrs=None, group
                     )
                     param_sfx += 1
 
-                    source_join = DataSourceJoin.objects.get(
-                        from_src__in=[table_info[filter_bqtable]['id'], table_info[image_table]['id']],
-                        to_src__in=[table_info[filter_bqtable]['id'], table_info[image_table]['id']]
+                    source_join = fetch_data_source_join(
+                        table_info[filter_bqtable]['id'], table_info[image_table]['id']
                     )
 
                     join_type = ""
@@ -3298,9 +3685,8 @@ def get_bq_metadata(filters, fields, data_version, sources_and_attrs=None, group
             if field_bqtable not in image_tables and field_bqtable not in tables_in_query:
                 if field_bqtable in field_clauses and len(field_clauses[field_bqtable]):
                     fields.append(field_clauses[field_bqtable])
-                source_join = DataSourceJoin.objects.get(
-                    from_src__in=[table_info[field_bqtable]['id'], table_info[image_table]['id']],
-                    to_src__in=[table_info[field_bqtable]['id'], table_info[image_table]['id']]
+                source_join = fetch_data_source_join(
+                    table_info[field_bqtable]['id'], table_info[image_table]['id']
                 )
                 joins.append(join_clause_base.format(
                     join_type=join_type,
@@ -3628,9 +4014,8 @@ def get_bq_string(filters, fields, data_version, sources_and_attrs=None, group_b
                         case_insens=True, type_schema=TYPE_SCHEMA, continuous_numerics=ranged_numerics
                     )
 
-                    source_join = DataSourceJoin.objects.get(
-                        from_src__in=[table_info[filter_bqtable]['id'], table_info[image_table]['id']],
-                        to_src__in=[table_info[filter_bqtable]['id'], table_info[image_table]['id']]
+                    source_join = fetch_data_source_join(
+                        table_info[filter_bqtable]['id'], table_info[image_table]['id']
                     )
 
                     join_type = ""
@@ -3659,9 +4044,8 @@ def get_bq_string(filters, fields, data_version, sources_and_attrs=None, group_b
             if field_bqtable not in image_tables and field_bqtable not in tables_in_query:
                 if field_bqtable in field_clauses and len(field_clauses[field_bqtable]):
                     fields.append(field_clauses[field_bqtable])
-                source_join = DataSourceJoin.objects.get(
-                    from_src__in=[table_info[field_bqtable]['id'], table_info[image_table]['id']],
-                    to_src__in=[table_info[field_bqtable]['id'], table_info[image_table]['id']]
+                source_join = fetch_data_source_join(
+                    table_info[field_bqtable]['id'], table_info[image_table]['id']
                 )
                 joins.append(join_clause_base.format(
                     join_type=join_type,
@@ -0,0 +1,124 @@
+#
+# Copyright 2015-2024, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import logging
+import re
+import zlib
+from django.utils.cache import patch_vary_headers
+
+# zstd support is optional; without the zstandard package only gzip is offered
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+GZIP = 'gzip'
+ZSTD = 'zstd'
+
+# Preferred first when a client accepts both equally
+ENCODINGS = [ZSTD, GZIP]
+
+COMPRESSION_EXTENSIONS = {
+    GZIP: 'gz',
+    ZSTD: 'zst'
+}
+
+COMPRESSION_CONTENT_TYPES = {
+    GZIP: 'application/gzip',
+    ZSTD: 'application/zstd'
+}
+
+COMPRESSION_LEVELS = {
+    GZIP: 6,
+    ZSTD: 3
+}
+
+
+def available_encodings():
+    return [x for x in ENCODINGS if x != ZSTD or zstandard]
+
+
+# Pick the encoding for a response: an explicitly requested one ('gzip', 'zstd', or 'none') wins if it's available,
+# otherwise the client's Accept-Encoding is used. Returns None for an uncompressed response.
+def negotiate_encoding(request, requested=None):
+    available = available_encodings()
+    if requested:
+        requested = requested.lower()
+        if requested in available:
+            return requested
+        if requested != 'none':
+            logger.warning("[WARNING] Requested compression '{}' isn't available.".format(requested))
+        return None
+
+    accepted = {}
+    for part in request.META.get('HTTP_ACCEPT_ENCODING', '').split(","):
+        match = re.match(r'^\s*([\w\-\*]+)\s*(?:;\s*q\s*=\s*([0-9.]+))?\s*$', part)
+        if not match:
+            continue
+        try:
+            accepted[match.group(1).lower()] = float(match.group(2)) if match.group(2) else 1.0
+        except ValueError:
+            continue
+    best = None
+    for encoding in available:
+        q = accepted.get(encoding, accepted.get('*', 0))
+        if q > 0 and (not best or q > best[1]):
+            best = (encoding, q)
+    return best[0] if best else None
+
+
+def _compressor(encoding):
+    if encoding == GZIP:
+        # wbits of 31 produces a gzip container rather than a bare zlib stream
+        return zlib.compressobj(COMPRESSION_LEVELS[GZIP], zlib.DEFLATED, 31)
+    if encoding == ZSTD:
+        return zstandard.ZstdCompressor(level=COMPRESSION_LEVELS[ZSTD]).compressobj()
+    raise Exception("Unsupported compression: {}".format(encoding))
+
+
+# Compress a stream of chunks (str or bytes) incrementally, yielding compressed output as the compressor produces it;
+# nothing beyond the compressor's own window is held in memory
+def compress_stream(chunks, encoding):
+    compressor = _compressor(encoding)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+# Compress a streaming response. Compression negotiated through Accept-Encoding is transparent to the client (the
+# file downloads as its original name); requested explicitly, the response is instead a .gz/.zst file download.
+# Content which is already compressed (eg. a stored variant) is passed through as-is.
+def compress_response(response, encoding, file_name, as_file=False, precompressed=False):
+    if not encoding:
+        return response
+    if not precompressed:
+        response.streaming_content = compress_stream(response.streaming_content, encoding)
+    if as_file:
+        response['Content-Type'] = COMPRESSION_CONTENT_TYPES[encoding]
+        response['Content-Disposition'] = 'attachment; filename="{}.{}"'.format(
+            file_name, COMPRESSION_EXTENSIONS[encoding])
+    else:
+        response['Content-Encoding'] = encoding
+    patch_vary_headers(response, ['Accept-Encoding'])
+    if not precompressed and response.has_header('Content-Length'):
+        del response['Content-Length']
+    return response
@@ -0,0 +1,268 @@
+#
+# Copyright 2015-2024, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import logging
+import time
+import json
+import hashlib
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Sum
+from django.utils import timezone
+from idc_collections.models import Manifest_Cache_Entry, Manifest_Job
+from idc_collections.manifest_jobs import get_manifest_storage, get_manifest_chunk_size
+from idc_collections.compression import COMPRESSION_EXTENSIONS
+from metrics_helpers import histogram, counter
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_CACHE_LOOKUPS = counter(
+    'idc_manifest_cache_lookups_total', "Manifest cache lookups, by whether a usable entry was found", ['result'])
+MANIFEST_CACHE_EVICTIONS = counter('idc_manifest_cache_evictions_total', "Cached manifests evicted")
+MANIFEST_CACHE_EVICTION_SECONDS = histogram('idc_manifest_cache_eviction_seconds', "Time taken by a cache eviction pass")
+
+# Defaults for the cache limits, overridable with the setting of the same name: entries are evicted once older than
+# MANIFEST_CACHE_MAX_AGE seconds, and then oldest-accessed first while the store is over MANIFEST_CACHE_MAX_BYTES. A
+# build which hasn't finished after MANIFEST_CACHE_BUILD_TIMEOUT seconds is assumed to have died.
+MANIFEST_CACHE_MAX_AGE = 7 * 24 * 60 * 60
+MANIFEST_CACHE_MAX_BYTES = 50 * 1024 * 1024 * 1024
+MANIFEST_CACHE_BUILD_TIMEOUT = 60 * 60
+MANIFEST_CACHE_EVICT_INTERVAL = 10 * 60
+MANIFEST_CACHE_FOLDER = "manifest_cache"
+
+LAST_EVICTION = {'time': 0}
+EVICTION_LOCK = threading.Lock()
+# Eviction passes delete from storage, so they're run on a background thread rather than in the request which
+# triggers them
+EVICTION_WORKER = ThreadPoolExecutor(max_workers=1, thread_name_prefix="manifest_cache_eviction")
+
+
+def _cache_setting(name, default):
+    return getattr(settings, name, default)
+
+
+def _canonical_filters(filters):
+    if not filters:
+        return None
+    return {str(k): sorted(str(x) for x in (v if isinstance(v, list) else [v])) for k, v in filters.items()}
+
+
+# Canonical hash of everything that determines a manifest's content. Filter values are order-insensitive; field order
+# isn't, since it sets the column order. Anything else which changes the output (storage location, headers common to
+# every copy, shard layout...) goes in options.
+def manifest_cache_key(filters=None, cart=None, versions=None, fields=None, file_type=None, compression=None, **options):
+    if versions is not None and not isinstance(versions, list):
+        versions = list(versions.values_list('version_number', flat=True))
+    key = {
+        'filters': _canonical_filters(filters),
+        'cart': cart,
+        'versions': sorted(str(x) for x in versions) if versions is not None else None,
+        'fields': fields,
+        'file_type': file_type,
+        'compression': sorted(compression) if compression else None,
+        'options': options
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def _expired(entry):
+    return entry.date_created < timezone.now() - datetime.timedelta(
+        seconds=_cache_setting('MANIFEST_CACHE_MAX_AGE', MANIFEST_CACHE_MAX_AGE))
+
+
+def _usable(entry):
+    if _expired(entry):
+        return False
+    if entry.job_id:
+        if entry.job.status != Manifest_Job.QUEUED:
+            return entry.job.status == Manifest_Job.READY
+    elif entry.status == Manifest_Cache_Entry.READY:
+        return True
+    # Still building, or queued; either is given up on after MANIFEST_CACHE_BUILD_TIMEOUT
+    return entry.date_created > timezone.now() - datetime.timedelta(
+        seconds=_cache_setting('MANIFEST_CACHE_BUILD_TIMEOUT', MANIFEST_CACHE_BUILD_TIMEOUT))
+
+
+def _touch(entry):
+    Manifest_Cache_Entry.objects.filter(id=entry.id).update(last_accessed=timezone.now())
+
+
+# The files belonging to an entry: a stored manifest, or an asynchronous job's manifest files (with any stored
+# compressed copies) and index
+def _entry_files(entry):
+    if not entry.job_id:
+        return [entry.file_name]
+    files = json.loads(entry.job.files)
+    return files + ["{}.{}".format(x, ext) for x in files for ext in COMPRESSION_EXTENSIONS.values()] + \
+        ([entry.job.file_name] if entry.job.file_name not in files else [])
+
+
+def _remove_entry(entry):
+    manifest_storage = get_manifest_storage()
+    for file_name in _entry_files(entry):
+        try:
+            manifest_storage.delete(file_name)
+        except Exception as e:
+            logger.warning("[WARNING] Couldn't remove cached manifest file {}: {}".format(file_name, e))
+    # Removing a job removes its entry as well
+    if entry.job_id:
+        entry.job.delete()
+    else:
+        entry.delete()
+
+
+# A ready, unexpired cached manifest for this key, or None
+def get_cached_manifest(content_key):
+    entry = Manifest_Cache_Entry.objects.select_related('job').filter(content_key=content_key).first()
+    if not entry or not _usable(entry) or (not entry.job_id and entry.status != Manifest_Cache_Entry.READY):
+        MANIFEST_CACHE_LOOKUPS.inc(result='miss')
+        return None
+    MANIFEST_CACHE_LOOKUPS.inc(result='hit')
+    _touch(entry)
+    return entry
+
+
+# Claim a key in the cache. Returns (entry, created): if another request already holds a usable entry for the key,
+# that entry is returned uncreated and the caller should use it (or, if it's still building, simply not cache its
+# own copy). Dead or expired entries are replaced.
+def claim_manifest_cache(content_key, file_name, job=None):
+    maybe_evict_manifest_cache()
+    entry = Manifest_Cache_Entry.objects.select_related('job').filter(content_key=content_key).first()
+    if entry:
+        if _usable(entry):
+            _touch(entry)
+            return entry, False
+        _remove_entry(entry)
+    try:
+        with transaction.atomic():
+            return Manifest_Cache_Entry.objects.create(content_key=content_key, file_name=file_name, job=job), True
+    except IntegrityError:
+        # Another request claimed the key in the meantime
+        return Manifest_Cache_Entry.objects.select_related('job').get(content_key=content_key), False
+
+
+def cache_file_name(content_key, file_type):
+    return "{}/{}.{}".format(MANIFEST_CACHE_FOLDER, content_key, file_type)
+
+
+# Stream a cached manifest's stored content
+def cached_manifest_stream(entry):
+    return get_manifest_storage().iter_chunks(entry.file_name, 0, entry.size - 1, get_manifest_chunk_size()) \
+        if entry.size else iter(())
+
+
+# Pass a manifest's chunks through while writing them to the store under a claimed entry. The entry becomes ready
+# only once the whole manifest has been written; if the stream fails or is abandoned (eg. the client disconnects),
+# the partial file and the claim are discarded.
+def cache_manifest_stream(entry, chunks, total_records=None, total_instance_size=None):
+    writer = get_manifest_storage().open_writer(entry.file_name)
+    size = 0
+    try:
+        for chunk in chunks:
+            data = chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+            writer.write(data)
+            size += len(data)
+            yield chunk
+        writer.commit()
+        Manifest_Cache_Entry.objects.filter(id=entry.id).update(
+            status=Manifest_Cache_Entry.READY, size=size, total_records=total_records,
+            total_instance_size=total_instance_size
+        )
+    except BaseException as e:
+        writer.discard()
+        Manifest_Cache_Entry.objects.filter(id=entry.id).delete()
+        if not isinstance(e, GeneratorExit):
+            logger.error("[ERROR] While caching manifest {}:".format(entry.content_key))
+            logger.exception(e)
+        raise e
+
+
+def _job_entry_size(entry):
+    manifest_storage = get_manifest_storage()
+    size = 0
+    for file_name in _entry_files(entry):
+        info = manifest_storage.stat(file_name)
+        size += info['size'] if info else 0
+    return size
+
+
+# Evict expired entries, then the least recently used until the store is within MANIFEST_CACHE_MAX_BYTES
+def evict_manifest_cache():
+    start = time.time()
+    evicted = 0
+    now = timezone.now()
+    max_age = datetime.timedelta(seconds=_cache_setting('MANIFEST_CACHE_MAX_AGE', MANIFEST_CACHE_MAX_AGE))
+    build_timeout = datetime.timedelta(
+        seconds=_cache_setting('MANIFEST_CACHE_BUILD_TIMEOUT', MANIFEST_CACHE_BUILD_TIMEOUT))
+
+    for entry in Manifest_Cache_Entry.objects.select_related('job').filter(date_created__lt=now - max_age):
+        _remove_entry(entry)
+        evicted += 1
+    for entry in Manifest_Cache_Entry.objects.select_related('job').filter(
+            job__isnull=True, status=Manifest_Cache_Entry.BUILDING, date_created__lt=now - build_timeout):
+        _remove_entry(entry)
+        evicted += 1
+    for entry in Manifest_Cache_Entry.objects.select_related('job').filter(
+            job__status__in=[Manifest_Job.QUEUED, Manifest_Job.FAILED], date_created__lt=now - build_timeout):
+        _remove_entry(entry)
+        evicted += 1
+
+    # Sizes of finished asynchronous jobs are only known once their files are written
+    for entry in Manifest_Cache_Entry.objects.select_related('job').filter(
+            job__status=Manifest_Job.READY, size__isnull=True):
+        entry.size = _job_entry_size(entry)
+        entry.save(update_fields=['size'])
+
+    max_bytes = _cache_setting('MANIFEST_CACHE_MAX_BYTES', MANIFEST_CACHE_MAX_BYTES)
+    total = Manifest_Cache_Entry.objects.aggregate(total=Sum('size'))['total'] or 0
+    if total > max_bytes:
+        for entry in Manifest_Cache_Entry.objects.select_related('job').filter(size__isnull=False).order_by(
+                'last_accessed'):
+            total -= entry.size
+            _remove_entry(entry)
+            evicted += 1
+            if total <= max_bytes:
+                break
+
+    stop = time.time()
+    MANIFEST_CACHE_EVICTIONS.inc(evicted)
+    MANIFEST_CACHE_EVICTION_SECONDS.observe(stop - start)
+    return evicted
+
+
+def _run_eviction():
+    try:
+        evict_manifest_cache()
+    except Exception as e:
+        logger.error("[ERROR] While evicting cached manifests:")
+        logger.exception(e)
+    finally:
+        # The worker thread holds its own database connection; don't leave it open between passes
+        connection.close()
+
+
+# Queue an eviction pass on the background worker if this process hasn't run one in the last
+# MANIFEST_CACHE_EVICT_INTERVAL seconds. It's queued once the caller's transaction commits, so that it sees the
+# caller's changes to the cache.
+def maybe_evict_manifest_cache():
+    with EVICTION_LOCK:
+        if time.time() - LAST_EVICTION['time'] < MANIFEST_CACHE_EVICT_INTERVAL:
+            return
+        LAST_EVICTION['time'] = time.time()
+    transaction.on_commit(lambda: EVICTION_WORKER.submit(_run_eviction))
@@ -0,0 +1,578 @@
+#
+# Copyright 2015-2024, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import logging
+import time
+import os
+import re
+import csv
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import connection, transaction
+from idc_collections.models import Manifest_Job
+from google_helpers.pubsub import publish_message
+from idc_collections.compression import compress_stream, COMPRESSION_EXTENSIONS
+from idc_collections.parquet_export import stream_parquet
+from google_helpers.cloud_file_storage import GCS_REQUEST_SECONDS
+from metrics_helpers import histogram, counter, get_caller
+
+logger = logging.getLogger(__name__)
+
+GCS_BYTES = counter('idc_gcs_bytes_total', "Bytes read from and written to GCS", ['direction'])
+MANIFEST_FILE_SECONDS = histogram(
+    'idc_manifest_file_seconds', "Time to write a manifest file in this process, by file type", ['file_type'])
+
+SHARD_BY_SERIES = 'series'
+SHARD_BY_COLLECTION = 'collection'
+MANIFEST_SHARD_KEYS = [SHARD_BY_SERIES, SHARD_BY_COLLECTION]
+MAX_MANIFEST_SHARDS = 64
+MANIFEST_INDEX_FILE = "index.json"
+
+# Executors are shared process-wide, keyed on the MANIFEST_EXECUTOR setting
+MANIFEST_EXECUTORS = {}
+EXECUTOR_LOCK = threading.Lock()
+
+# Manifest downloads are streamed in chunks of MANIFEST_CHUNK_SIZE bytes (capped at MAX_MANIFEST_CHUNK_SIZE), which
+# bounds the memory a download takes in a worker
+MANIFEST_CHUNK_SIZE = 1024 * 1024
+MAX_MANIFEST_CHUNK_SIZE = 8 * 1024 * 1024
+MANIFEST_STORAGES = {}
+
+# Longest a client may wait on a manifest in one request, how often a waiting request rechecks the registry, and how
+# often it looks for the job's files in storage, in seconds. Jobs completed in this process wake their waiters
+# immediately.
+MANIFEST_WAIT_TIMEOUT = 25
+MANIFEST_WAIT_INTERVAL = 1
+MANIFEST_STAT_INTERVAL = 5
+MANIFEST_WAITERS = {}
+WAITERS_LOCK = threading.Lock()
+# When each queued job's files were last looked for in storage, so that however many requests are waiting on a job,
+# it's checked at most once every MANIFEST_STAT_INTERVAL seconds
+MANIFEST_LAST_STAT = {}
+
+
+# Numbered file name for one shard of a manifest; the shard number goes ahead of the storage location suffix so the
+# name still matches the manifest fetch/check URLs, eg. manifest_20240101_120000_003_aws.s5cmd
+def shard_file_name(file_name, shard):
+    stem, ext = os.path.splitext(file_name)
+    match = re.match(r'^(.*?)(_aws|_gcs|_gcp)?$', stem)
+    return "{}_{:03d}{}{}".format(match.group(1), shard, match.group(2) or "", ext)
+
+
+# Restrict a manifest query to one shard. Rows are assigned to a shard by a fingerprint of their collection_id or
+# SeriesInstanceUID; if the key column isn't in the query's output (eg. s5cmd manifests, which list one reformatted
+# line per series), the whole row is fingerprinted instead, which for a series-level manifest is still one series.
+def shard_manifest_query(sql, shard, shard_count, shard_key=SHARD_BY_SERIES, columns=None):
+    columns = columns or []
+    if shard_key == SHARD_BY_COLLECTION and 'collection_id' in columns:
+        fingerprint = "FARM_FINGERPRINT(shard_row.collection_id)"
+    elif 'SeriesInstanceUID' in columns:
+        fingerprint = "FARM_FINGERPRINT(shard_row.SeriesInstanceUID)"
+    else:
+        fingerprint = "FARM_FINGERPRINT(TO_JSON_STRING(shard_row))"
+    # MOD keeps the sign of the fingerprint, hence the ABS
+    return "SELECT shard_row.* FROM ({sql}) AS shard_row WHERE ABS(MOD({fingerprint}, {count})) = {shard}".format(
+        sql=sql, fingerprint=fingerprint, count=int(shard_count), shard=int(shard)
+    )
+
+
+# Split a manifest job into shard_count jobs, each with its own query and numbered file, and build the index
+# describing them. An unsharded job is returned as-is, with no index.
+def build_manifest_shards(manifest_job, shard_count=1, shard_key=SHARD_BY_SERIES, columns=None):
+    shard_count = max(1, min(int(shard_count), MAX_MANIFEST_SHARDS))
+    if shard_count == 1:
+        return [manifest_job], None
+    if shard_key not in MANIFEST_SHARD_KEYS:
+        raise Exception("Unrecognized manifest shard key: {}".format(shard_key))
+
+    shard_jobs = []
+    for shard in range(shard_count):
+        shard_job = dict(manifest_job)
+        shard_job.update({
+            "query": shard_manifest_query(manifest_job['query'], shard, shard_count, shard_key, columns),
+            "file_name": shard_file_name(manifest_job['file_name'], shard),
+            "shard": shard,
+            "shard_count": shard_count
+        })
+        shard_jobs.append(shard_job)
+
+    index = {
+        "jobId": manifest_job['jobId'],
+        "file_name": manifest_job['file_name'],
+        "file_type": manifest_job['file_type'],
+        "shard_key": shard_key,
+        "shard_count": shard_count,
+        "shards": [{"shard": x['shard'], "file_name": "{}/{}".format(x['jobId'], x['file_name'])} for x in shard_jobs]
+    }
+    return shard_jobs, index
+
+
+# Record a newly submitted job (and its expected files) in the registry. A sharded job's index is kept with it, and
+# written out once every shard is ready.
+def register_manifest_job(shard_jobs, index=None):
+    job_id = shard_jobs[0]['jobId']
+    return Manifest_Job.objects.create(
+        job_id=job_id,
+        file_name="{}/{}".format(job_id, MANIFEST_INDEX_FILE if index else shard_jobs[0]['file_name']),
+        files=json.dumps(["{}/{}".format(job_id, x['file_name']) for x in shard_jobs]),
+        index=json.dumps(index) if index else None
+    )
+
+
+def _wake_waiters(job_id):
+    with WAITERS_LOCK:
+        waiter = MANIFEST_WAITERS.pop(job_id, None)
+    if waiter:
+        waiter.set()
+
+
+# Mark one of a job's files ('<job ID>/<file name>') as written; once all of them are, the job is ready. Files the
+# job doesn't expect (eg. stored compressed variants) and repeat notifications are ignored.
+def mark_manifest_file_ready(file_name):
+    job_id = file_name.split("/")[0]
+    completed = False
+    with transaction.atomic():
+        job = Manifest_Job.objects.select_for_update().filter(job_id=job_id).first()
+        if not job:
+            logger.warning("[WARNING] Manifest file {} isn't part of a registered job.".format(file_name))
+            return None
+        ready_files = json.loads(job.ready_files)
+        if file_name not in json.loads(job.files) or file_name in ready_files:
+            return job
+        ready_files.append(file_name)
+        job.ready_files = json.dumps(ready_files)
+        if len(ready_files) == len(json.loads(job.files)):
+            job.status = Manifest_Job.READY
+            completed = True
+        job.save()
+    if completed and job.index:
+        # The index is what a sharded job's client fetches, so it's only written once every shard is there
+        try:
+            get_manifest_executor().write_index(json.loads(job.index))
+        except Exception as e:
+            logger.error("[ERROR] While writing the index of manifest job {}:".format(job_id))
+            logger.exception(e)
+            Manifest_Job.objects.filter(id=job.id).update(status=Manifest_Job.FAILED)
+            job.status = Manifest_Job.FAILED
+    if job.status != Manifest_Job.QUEUED:
+        _wake_waiters(job_id)
+    return job
+
+
+def mark_manifest_job_failed(job_id):
+    Manifest_Job.objects.filter(job_id=job_id).update(status=Manifest_Job.FAILED)
+    _wake_waiters(job_id)
+
+
+# Check storage for any files of a queued job which haven't been marked ready, and mark those found. Files are
+# normally marked by the bucket's notifications, but this keeps jobs completing where those aren't set up (or one is
+# lost). A job is checked at most once every MANIFEST_STAT_INTERVAL seconds; returns the job as it now stands.
+def refresh_manifest_job(job):
+    if job.status != Manifest_Job.QUEUED:
+        return job
+    now = time.time()
+    with WAITERS_LOCK:
+        if now - MANIFEST_LAST_STAT.get(job.job_id, 0) < MANIFEST_STAT_INTERVAL:
+            return job
+        # Drop the jobs no one has waited on since their last check
+        for job_id in [x for x, checked in MANIFEST_LAST_STAT.items() if now - checked >= MANIFEST_STAT_INTERVAL]:
+            MANIFEST_LAST_STAT.pop(job_id)
+        MANIFEST_LAST_STAT[job.job_id] = now
+    try:
+        manifest_storage = get_manifest_storage()
+        ready_files = json.loads(job.ready_files)
+        for file_name in json.loads(job.files):
+            if file_name not in ready_files and manifest_storage.stat(file_name):
+                job = mark_manifest_file_ready(file_name) or job
+    except Exception as e:
+        logger.error("[ERROR] While checking storage for the files of manifest job {}:".format(job.job_id))
+        logger.exception(e)
+    return job
+
+
+# Status of a job from the registry, or None if it isn't registered
+def get_manifest_job_status(job_id):
+    job = Manifest_Job.objects.filter(job_id=job_id).first()
+    return job.get_status() if job else None
+
+
+# Wait up to timeout seconds for a job to finish, returning its status as soon as it does (or when the wait ends)
+def wait_for_manifest_job(job_id, timeout=MANIFEST_WAIT_TIMEOUT):
+    deadline = time.time() + min(timeout, MANIFEST_WAIT_TIMEOUT)
+    with WAITERS_LOCK:
+        waiter = MANIFEST_WAITERS.setdefault(job_id, threading.Event())
+    while True:
+        job = Manifest_Job.objects.filter(job_id=job_id).first()
+        if job:
+            job = refresh_manifest_job(job)
+        remaining = deadline - time.time()
+        if not job or job.status != Manifest_Job.QUEUED or remaining <= 0:
+            if job and job.status == Manifest_Job.QUEUED:
+                # Timed out; don't leave the event behind if nothing else is waiting on it
+                with WAITERS_LOCK:
+                    if MANIFEST_WAITERS.get(job_id, None) is waiter:
+                        MANIFEST_WAITERS.pop(job_id)
+            return job.get_status() if job else None
+        waiter.wait(min(MANIFEST_WAIT_INTERVAL, remaining))
+
+
+def _progress(index, ready_files):
+    shards = [dict(x, ready=(x['file_name'] in ready_files)) for x in index['shards']]
+    shards_ready = len([x for x in shards if x['ready']])
+    return {
+        "jobId": index['jobId'],
+        "shard_count": index['shard_count'],
+        "shards_ready": shards_ready,
+        "manifest_ready": (shards_ready == index['shard_count']),
+        "shards": shards
+    }
+
+
+# Hands manifest jobs to the manifest service over Pub/Sub; it runs each one as a BigQuery export into the user
+# manifest folder of the results bucket. Shards are published together, and so run in parallel. Files are read and
+# written through the shared manifest storage.
+class PubSubManifestExecutor(object):
+
+    def submit(self, shard_jobs, index=None):
+        for job in shard_jobs:
+            publish_message(settings.PUBSUB_USER_MANIFEST_TOPIC, json.dumps(job).encode('utf-8'),
+                            callback=self._on_published(job['jobId']))
+
+    # A shard which can't be published will never be written, so its job is failed
+    @staticmethod
+    def _on_published(job_id):
+        submitter = threading.get_ident()
+
+        def callback(future):
+            if not future.exception():
+                return
+            try:
+                mark_manifest_job_failed(job_id)
+            finally:
+                # Usually run on the publisher's thread, whose connection is its own; a future which was already
+                # resolved runs this on the submitting thread, which keeps its connection
+                if threading.get_ident() != submitter:
+                    connection.close()
+        return callback
+
+    def write_index(self, index):
+        writer = get_manifest_storage().open_writer("{}/{}".format(index['jobId'], MANIFEST_INDEX_FILE))
+        writer.write(json.dumps(index).encode('utf-8'))
+        writer.commit()
+
+    def progress(self, job_id):
+        manifest_storage = get_manifest_storage()
+        index_name = "{}/{}".format(job_id, MANIFEST_INDEX_FILE)
+        info = manifest_storage.stat(index_name)
+        if not info:
+            return None
+        index = json.loads(b"".join(manifest_storage.iter_chunks(
+            index_name, 0, info['size'] - 1, get_manifest_chunk_size(), info.get('generation', None))))
+        # One lookup per shard, rather than a listing of everything under the job
+        ready_files = set(x['file_name'] for x in index['shards'] if manifest_storage.stat(x['file_name']))
+        return _progress(index, ready_files)
+
+
+# Runs manifest jobs in this process: each shard's query is run with query_runner (by default, BigQuery) on a thread
+# pool and its file written under out_dir. Intended for tests and local development, with MANIFEST_EXECUTOR = 'local'.
+class LocalManifestExecutor(object):
+    def __init__(self, out_dir=None, query_runner=None, workers=4, on_ready=None, on_failure=None):
+        self.out_dir = out_dir or getattr(settings, 'MANIFEST_LOCAL_DIR', None) or os.path.join(os.getcwd(), "manifests")
+        self.query_runner = query_runner or self._run_bq_query
+        # Called with '<job ID>/<file name>' as each file is written, and with the job ID if a shard fails; by default
+        # these update the job registry
+        self.on_ready = on_ready or mark_manifest_file_ready
+        self.on_failure = on_failure or mark_manifest_job_failed
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="manifest_shard")
+        self.futures = {}
+
+    @staticmethod
+    def _run_bq_query(query, params):
+        from google_helpers.bigquery.bq_support import BigQuerySupport
+        return BigQuerySupport.stream_query_results(query, params)
+
+    def _run_shard(self, job):
+        try:
+            self._write_shard(job)
+            self.on_ready("{}/{}".format(job['jobId'], job['file_name']))
+        except Exception as e:
+            logger.error("[ERROR] While writing manifest file {}/{}:".format(job['jobId'], job['file_name']))
+            logger.exception(e)
+            self.on_failure(job['jobId'])
+            raise e
+        finally:
+            connection.close()
+
+    def _write_rows(self, job, rows, f):
+        if job['file_type'] == 'json':
+            json.dump([dict(x) for x in rows], f)
+        elif job['file_type'] in ['csv', 'tsv']:
+            f.write(job['header'])
+            writer = None
+            for row in rows:
+                if not writer:
+                    writer = csv.DictWriter(f, fieldnames=list(row.keys()),
+                                            delimiter=("\t" if job['file_type'] == 'tsv' else ","))
+                    writer.writeheader()
+                writer.writerow(dict(row))
+        else:
+            f.write(job['header'])
+            for row in rows:
+                f.write("{}{}".format(list(dict(row).values())[0], os.linesep))
+
+    def _write_shard(self, job):
+        start = time.time()
+        rows = self.query_runner(job['query'], job['params'])
+        path = os.path.join(self.out_dir, job['jobId'], job['file_name'])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written to a temporary file and moved into place, so a file's presence means its shard is complete
+        if job['file_type'] == 'parquet':
+            with open("{}.tmp".format(path), "wb") as f:
+                for data in stream_parquet((dict(x) for x in rows), job['fields'],
+                                           row_group_size=job.get('row_group_size', None)):
+                    f.write(data)
+        else:
+            with open("{}.tmp".format(path), "w", newline="") as f:
+                self._write_rows(job, rows, f)
+        # Stored compressed variants are written before the file itself is moved into place, so they're ready with it
+        for encoding in job.get('compression', []):
+            with open("{}.tmp".format(path), "rb") as src, open("{}.{}".format(path, COMPRESSION_EXTENSIONS[encoding]), "wb") as dst:
+                for data in compress_stream(iter(lambda: src.read(1024 * 1024), b""), encoding):
+                    dst.write(data)
+        os.replace("{}.tmp".format(path), path)
+        stop = time.time()
+        MANIFEST_FILE_SECONDS.observe(stop - start, file_type=job['file_type'])
+
+    def submit(self, shard_jobs, index=None):
+        for job in shard_jobs:
+            self.futures.setdefault(job['jobId'], []).append(self.pool.submit(self._run_shard, job))
+
+    def write_index(self, index):
+        path = os.path.join(self.out_dir, index['jobId'], MANIFEST_INDEX_FILE)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open("{}.tmp".format(path), "w") as f:
+            json.dump(index, f)
+        os.replace("{}.tmp".format(path), path)
+
+    # Block until a job's shards have all finished, raising the first shard error
+    def wait(self, job_id):
+        for future in self.futures.pop(job_id, []):
+            future.result()
+
+    def progress(self, job_id):
+        index_path = os.path.join(self.out_dir, job_id, MANIFEST_INDEX_FILE)
+        if not os.path.exists(index_path):
+            return None
+        with open(index_path) as f:
+            index = json.load(f)
+        ready_files = set("{}/{}".format(job_id, x) for x in os.listdir(os.path.join(self.out_dir, job_id)))
+        return _progress(index, ready_files)
+
+
+def get_manifest_executor():
+    executor = getattr(settings, 'MANIFEST_EXECUTOR', 'pubsub')
+    if executor not in MANIFEST_EXECUTORS:
+        with EXECUTOR_LOCK:
+            if executor not in MANIFEST_EXECUTORS:
+                if executor == 'local':
+                    MANIFEST_EXECUTORS[executor] = LocalManifestExecutor()
+                elif executor == 'pubsub':
+                    MANIFEST_EXECUTORS[executor] = PubSubManifestExecutor()
+                else:
+                    raise Exception("Unrecognized manifest executor: {}".format(executor))
+    return MANIFEST_EXECUTORS[executor]
+
+
+# Per-shard progress of a sharded manifest job, or None if there's no such job. Registered jobs are answered from the
+# registry; older ones from the executor's storage.
+def manifest_progress(job_id):
+    job = Manifest_Job.objects.filter(job_id=job_id).first()
+    if not job:
+        return get_manifest_executor().progress(job_id)
+    progress = _progress({
+        'jobId': job_id,
+        'shard_count': len(json.loads(job.files)),
+        'shards': [{'shard': i, 'file_name': x} for i, x in enumerate(json.loads(job.files))]
+    }, set(json.loads(job.ready_files)))
+    progress['status'] = job.get_status_display()
+    return progress
+
+
+def get_manifest_chunk_size():
+    return min(getattr(settings, 'MANIFEST_CHUNK_SIZE', MANIFEST_CHUNK_SIZE), MAX_MANIFEST_CHUNK_SIZE)
+
+
+# Parse a single-range HTTP Range header against a file of the given size, returning the inclusive (start, end) byte
+# positions, or None if the range can't be satisfied. Multiple ranges aren't supported, and are treated as
+# unsatisfiable.
+def parse_range_header(header, size):
+    match = re.match(r'^\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*$', header or "")
+    if not match or not (match.group(1) or match.group(2)):
+        return None
+    if not match.group(1):
+        # Suffix range: the last N bytes
+        length = int(match.group(2))
+        if length == 0 or size == 0:
+            return None
+        return max(size - length, 0), size - 1
+    start = int(match.group(1))
+    end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+    if start >= size or end < start:
+        return None
+    return start, end
+
+
+# Manifest files in the user manifest folder of the results bucket. One storage client is kept per process, and files
+# are read in ranged chunks rather than downloaded whole.
+class GCSManifestStorage(object):
+    def __init__(self):
+        from google.cloud import storage
+        self.bucket = storage.Client().bucket(settings.RESULT_BUCKET)
+
+    def _blob_name(self, file_name):
+        return "{}/{}".format(settings.USER_MANIFESTS_FOLDER, file_name)
+
+    # Size, ETag and generation of a file, or None if it doesn't exist
+    def stat(self, file_name):
+        with GCS_REQUEST_SECONDS.time(operation='stat', caller=get_caller((__name__,))):
+            blob = self.bucket.get_blob(self._blob_name(file_name))
+        return {'size': blob.size, 'etag': blob.etag.strip('"'), 'generation': blob.generation} if blob else None
+
+    # Bytes start through end (inclusive) of a file, in chunks of at most chunk_size, streamed over a single read.
+    # Given the generation from stat, the bytes are read from that version of the file even if it's since been
+    # replaced, so they match the size and ETag the caller was given.
+    def iter_chunks(self, file_name, start, end, chunk_size, generation=None):
+        blob = self.bucket.blob(self._blob_name(file_name), generation=generation)
+        caller = get_caller((__name__,))
+        with blob.open("rb", chunk_size=chunk_size) as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                with GCS_REQUEST_SECONDS.time(operation='download', caller=caller):
+                    data = f.read(min(chunk_size, remaining))
+                if not data:
+                    break
+                GCS_BYTES.inc(len(data), direction='download')
+                remaining -= len(data)
+                yield data
+
+    # A writer for a new file; nothing is visible under file_name until the writer is committed
+    def open_writer(self, file_name):
+        return _GCSManifestWriter(self.bucket.blob(self._blob_name(file_name)))
+
+    def delete(self, file_name):
+        with GCS_REQUEST_SECONDS.time(operation='delete', caller=get_caller((__name__,))):
+            blob = self.bucket.get_blob(self._blob_name(file_name))
+            if blob:
+                blob.delete()
+
+
+class _GCSManifestWriter(object):
+    def __init__(self, blob):
+        self.blob = blob
+        self.file = blob.open("wb")
+        self.caller = get_caller((__name__, 'idc_collections.manifest_cache'))
+
+    def write(self, data):
+        self.file.write(data)
+        GCS_BYTES.inc(len(data), direction='upload')
+
+    def commit(self):
+        with GCS_REQUEST_SECONDS.time(operation='upload', caller=self.caller):
+            self.file.close()
+
+    # A resumable upload can't be cancelled once started, so a discarded file is finished and then removed
+    def discard(self):
+        try:
+            self.file.close()
+            self.blob.delete()
+        except Exception as e:
+            logger.warning("[WARNING] Couldn't remove discarded manifest file {}: {}".format(self.blob.name, e))
+
+
+# Local filesystem stand-in for GCSManifestStorage, reading from the same folder LocalManifestExecutor writes to.
+# Selected with MANIFEST_STORAGE = 'local'.
+class LocalManifestStorage(object):
+    def __init__(self, root=None):
+        self.root = root or getattr(settings, 'MANIFEST_LOCAL_DIR', None) or os.path.join(os.getcwd(), "manifests")
+
+    def _path(self, file_name):
+        path = os.path.normpath(os.path.join(self.root, file_name))
+        if not path.startswith(os.path.normpath(self.root) + os.sep):
+            raise Exception("Manifest file {} is outside of the manifest folder.".format(file_name))
+        return path
+
+    def stat(self, file_name):
+        path = self._path(file_name)
+        if not os.path.isfile(path):
+            return None
+        info = os.stat(path)
+        return {'size': info.st_size, 'etag': "{:x}-{:x}".format(info.st_mtime_ns, info.st_size)}
+
+    # Files are only ever replaced whole, so an open file keeps the content it was opened with; there's no generation
+    # to pin
+    def iter_chunks(self, file_name, start, end, chunk_size, generation=None):
+        with open(self._path(file_name), "rb") as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                data = f.read(min(chunk_size, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+                yield data
+
+    def open_writer(self, file_name):
+        return _LocalManifestWriter(self._path(file_name))
+
+    def delete(self, file_name):
+        path = self._path(file_name)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class _LocalManifestWriter(object):
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = open("{}.tmp".format(path), "wb")
+
+    def write(self, data):
+        self.file.write(data)
+
+    def commit(self):
+        self.file.close()
+        os.replace("{}.tmp".format(self.path), self.path)
+
+    def discard(self):
+        self.file.close()
+        os.remove("{}.tmp".format(self.path))
+
+
+def get_manifest_storage():
+    storage_type = getattr(settings, 'MANIFEST_STORAGE', 'gcs')
+    key = storage_type if storage_type != 'local' else "local:{}".format(getattr(settings, 'MANIFEST_LOCAL_DIR', None))
+    if key not in MANIFEST_STORAGES:
+        if storage_type == 'local':
+            MANIFEST_STORAGES[key] = LocalManifestStorage()
+        elif storage_type == 'gcs':
+            MANIFEST_STORAGES[key] = GCSManifestStorage()
+        else:
+            raise Exception("Unrecognized manifest storage: {}".format(storage_type))
+    return MANIFEST_STORAGES[key]
+
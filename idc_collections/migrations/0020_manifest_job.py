@@ -0,0 +1,26 @@
+# Generated by Django 4.2.20 on 2026-10-19 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('idc_collections', '0019_alter_collection_location'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Manifest_Job',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('job_id', models.CharField(max_length=64, unique=True)),
+                ('file_name', models.CharField(max_length=512)),
+                ('status', models.CharField(choices=[('Q', 'Queued'), ('R', 'Ready'), ('F', 'Failed')], default='Q', max_length=1)),
+                ('files', models.TextField()),
+                ('ready_files', models.TextField(default='[]')),
+                ('date_created', models.DateTimeField(auto_now_add=True)),
+                ('date_updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
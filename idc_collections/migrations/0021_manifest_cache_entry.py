@@ -0,0 +1,29 @@
+# Generated by Django 4.2.20 on 2026-10-19 11:03
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('idc_collections', '0020_manifest_job'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Manifest_Cache_Entry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content_key', models.CharField(max_length=64, unique=True)),
+                ('file_name', models.CharField(max_length=512)),
+                ('status', models.CharField(choices=[('B', 'Building'), ('R', 'Ready')], default='B', max_length=1)),
+                ('size', models.BigIntegerField(blank=True, null=True)),
+                ('total_records', models.BigIntegerField(blank=True, null=True)),
+                ('total_instance_size', models.BigIntegerField(blank=True, null=True)),
+                ('date_created', models.DateTimeField(auto_now_add=True)),
+                ('last_accessed', models.DateTimeField(auto_now_add=True)),
+                ('job', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='idc_collections.manifest_job')),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.20 on 2026-10-19 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('idc_collections', '0021_manifest_cache_entry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='manifest_job',
+            name='index',
+            field=models.TextField(blank=True, null=True),
+        ),
+    ]
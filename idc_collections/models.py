@@ -4,10 +4,13 @@ import operator
 from django.db import models
 from django.contrib.auth.models import User
 from django.db.models import Q
+from django.db.backends.signals import connection_created
 import time
+import json
 import logging
 from sharing.models import Shared_Resource
 from functools import reduce
+from metrics_helpers.orm import instrument_connection
 
 logger = logging.getLogger(__name__)
 
@@ -596,6 +599,8 @@ class AttributeQuerySet(models.QuerySet):
 
     # Parameters:
     # versions: ImagingDataCommonsVersion QuerySet these data sources should be associated with
+    #
+    # Returns a DataSource QuerySet, which is empty (and so falsy once evaluated) if no sources match
     def get_data_sources(self, versions=None, source_type=None, active=None, current=True, aggregate_level=None):
         q_objects = Q()
         if versions:
@@ -606,12 +611,8 @@ class AttributeQuerySet(models.QuerySet):
             aggregate_level = aggregate_level if isinstance(aggregate_level, list) else [aggregate_level]
             q_objects &= Q(aggregate_level__in=aggregate_level)
 
-        data_sources = None
-        attrs = self.all()
-        for attr in attrs:
-            data_sources = attr.data_sources.filter(q_objects) if not data_sources else (data_sources|attr.data_sources.filter(q_objects))
-
-        return data_sources.distinct() if data_sources else None
+        # A single join through the attribute/data source table, rather than a UNION of one query per attribute
+        return DataSource.objects.filter(q_objects, attribute__in=self.values('id')).distinct()
 
     def get_attr_cats(self):
         categories = {}
@@ -876,3 +877,66 @@ class User_Feature_Counts(models.Model):
     feature = models.ForeignKey(User_Feature_Definitions, null=False, on_delete=models.CASCADE)
     value = models.TextField()
     count = models.IntegerField()
+
+
+# Status registry for asynchronous manifest jobs, so readiness checks are a local lookup rather than a storage bucket
+# query. files and ready_files are JSON lists of the job's manifest files ('<job ID>/<file name>'); the job is
+# ready once all of its files are.
+class Manifest_Job(models.Model):
+    QUEUED = 'Q'
+    READY = 'R'
+    FAILED = 'F'
+    STATUSES = (
+        (QUEUED, 'Queued'),
+        (READY, 'Ready'),
+        (FAILED, 'Failed')
+    )
+    job_id = models.CharField(max_length=64, null=False, blank=False, unique=True)
+    file_name = models.CharField(max_length=512, null=False, blank=False)
+    status = models.CharField(max_length=1, choices=STATUSES, default=QUEUED)
+    files = models.TextField(null=False, blank=False)
+    ready_files = models.TextField(null=False, blank=False, default="[]")
+    # A sharded job's index, written out once all of its shards are
+    index = models.TextField(null=True, blank=True)
+    date_created = models.DateTimeField(auto_now_add=True)
+    date_updated = models.DateTimeField(auto_now=True)
+
+    def get_status(self):
+        return {
+            'jobId': self.job_id,
+            'file_name': self.file_name,
+            'status': self.get_status_display(),
+            'manifest_ready': (self.status == self.READY),
+            'shard_count': len(json.loads(self.files)),
+            'shards_ready': len(json.loads(self.ready_files))
+        }
+
+    def __str__(self):
+        return "{} ({})".format(self.job_id, self.get_status_display())
+
+
+# Content-addressed store of generated manifests. content_key is a hash of everything which determines a manifest's
+# records (filters or cart, versions, fields, format, ...), so identical requests share one artifact: a stored file
+# for synchronous manifests (file_name, relative to the user manifest folder) or an asynchronous job.
+class Manifest_Cache_Entry(models.Model):
+    BUILDING = 'B'
+    READY = 'R'
+    STATUSES = (
+        (BUILDING, 'Building'),
+        (READY, 'Ready')
+    )
+    content_key = models.CharField(max_length=64, null=False, blank=False, unique=True)
+    file_name = models.CharField(max_length=512, null=False, blank=False)
+    status = models.CharField(max_length=1, choices=STATUSES, default=BUILDING)
+    job = models.ForeignKey(Manifest_Job, null=True, blank=True, on_delete=models.CASCADE)
+    size = models.BigIntegerField(null=True, blank=True)
+    total_records = models.BigIntegerField(null=True, blank=True)
+    total_instance_size = models.BigIntegerField(null=True, blank=True)
+    date_created = models.DateTimeField(auto_now_add=True)
+    last_accessed = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return "{} ({})".format(self.content_key, self.get_status_display())
+
+
+connection_created.connect(instrument_connection)
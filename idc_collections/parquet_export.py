@@ -0,0 +1,157 @@
+#
+# Copyright 2015-2024, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import logging
+import time
+from django.conf import settings
+from idc_collections.models import Attribute
+from metrics_helpers import histogram, counter
+
+# Parquet output is optional; without pyarrow the format isn't offered
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+logger = logging.getLogger(__name__)
+
+PARQUET_ROW_GROUP_SIZE = 100000
+MAX_PARQUET_ROW_GROUP_SIZE = 1000000
+PARQUET_CONTENT_TYPE = "application/vnd.apache.parquet"
+
+PARQUET_WRITE_SECONDS = histogram('idc_parquet_write_seconds', "Time to stream a Parquet manifest")
+PARQUET_ROWS = counter('idc_parquet_rows_total', "Rows written to Parquet manifests")
+PARQUET_ROW_GROUPS = counter('idc_parquet_row_groups_total', "Row groups written to Parquet manifests")
+
+
+def parquet_available():
+    return pyarrow is not None
+
+
+def get_row_group_size(requested=None):
+    size = int(requested or getattr(settings, 'PARQUET_ROW_GROUP_SIZE', PARQUET_ROW_GROUP_SIZE))
+    return max(1, min(size, MAX_PARQUET_ROW_GROUP_SIZE))
+
+
+PARQUET_DOUBLE = 'DOUBLE'
+PARQUET_INT64 = 'INT64'
+PARQUET_STRING = 'STRING'
+
+PARQUET_TYPES = {
+    Attribute.CONTINUOUS_NUMERIC: PARQUET_DOUBLE,
+    Attribute.CATEGORICAL_NUMERIC: PARQUET_INT64
+}
+
+
+# Column types of a manifest's fields, from the attribute registry; fields which aren't registered attributes (UIDs,
+# URLs, and the like) are strings
+def manifest_field_types(fields):
+    data_types = dict(Attribute.objects.filter(name__in=fields, active=True).values_list('name', 'data_type'))
+    return [{'name': x, 'type': PARQUET_TYPES.get(data_types.get(x, None), PARQUET_STRING)} for x in fields]
+
+
+def _arrow_type(parquet_type):
+    if parquet_type == PARQUET_DOUBLE:
+        return pyarrow.float64()
+    if parquet_type == PARQUET_INT64:
+        return pyarrow.int64()
+    return pyarrow.string()
+
+
+# Arrow schema for a manifest's fields; metadata is stored as the file's key/value metadata
+def manifest_arrow_schema(fields, metadata=None):
+    return pyarrow.schema(
+        [(x['name'], _arrow_type(x['type'])) for x in manifest_field_types(fields)],
+        metadata={str(k): str(v) for k, v in metadata.items()} if metadata else None
+    )
+
+
+def _coerce(value, arrow_type):
+    if value is None or value == "":
+        return None
+    if isinstance(value, list):
+        value = value[0] if len(value) == 1 else "; ".join(str(x) for x in value)
+    if pyarrow.types.is_floating(arrow_type):
+        return float(value)
+    if pyarrow.types.is_integer(arrow_type):
+        return int(float(value))
+    return str(value)
+
+
+# Write-only file object for the Parquet writer, whose output is handed off after each row group rather than kept
+class _ParquetSink(object):
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+# Stream a manifest's rows (dicts) as a Parquet file, yielding each row group's bytes as soon as it's written, so at
+# most one row group is held in memory. The footer follows the last row group.
+def stream_parquet(rows, fields, row_group_size=None, metadata=None):
+    if not parquet_available():
+        raise Exception("Parquet manifests require the pyarrow package, which isn't installed.")
+    start = time.time()
+    schema = manifest_arrow_schema(fields, metadata)
+    row_group_size = get_row_group_size(row_group_size)
+    sink = _ParquetSink()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema, compression='snappy')
+    columns = {x: [] for x in fields}
+    count = 0
+    row_groups = 0
+
+    def write_row_group():
+        writer.write_table(pyarrow.Table.from_pydict(columns, schema=schema), row_group_size=row_group_size)
+        for x in fields:
+            columns[x] = []
+
+    for row in rows:
+        for field in schema:
+            columns[field.name].append(_coerce(row.get(field.name, None), field.type))
+        count += 1
+        if count % row_group_size == 0:
+            write_row_group()
+            row_groups += 1
+            yield sink.drain()
+    if count % row_group_size or not count:
+        write_row_group()
+        row_groups += 1
+    writer.close()
+    yield sink.drain()
+    stop = time.time()
+    PARQUET_WRITE_SECONDS.observe(stop - start)
+    PARQUET_ROWS.inc(count)
+    PARQUET_ROW_GROUPS.inc(row_groups)
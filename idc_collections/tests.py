@@ -14,10 +14,36 @@
 # limitations under the License.
 #
 
-from django.test import TestCase
+from django.test import TestCase, override_settings, RequestFactory
 from django.contrib.auth.models import AnonymousUser, User
-from idc_collections.collex_metadata_utils import build_explorer_context, get_collex_metadata, get_metadata_solr, fetch_data_source_attr, fetch_solr_facets
-from idc_collections.models import Program, Project, ImagingDataCommonsVersion, DataSource, DataSetType
+from django.db import connection
+from idc_collections.collex_metadata_utils import build_explorer_context, get_collex_metadata, get_metadata_solr, fetch_data_source_attr, fetch_solr_facets, \
+    create_cart_query_string, CART_QUERY_STRINGS, CART_TERMS_THRESHOLD, fetch_data_source_join, build_solr_join_query, \
+    fetch_data_source_join_path, format_facet_values, submit_manifest_job
+from idc_collections.models import Program, Project, ImagingDataCommonsVersion, DataSource, DataSetType, DataSourceJoin, \
+    Attribute, Manifest_Cache_Entry
+from idc_collections.uid_index import UIDBitmap, UIDIndex
+from google_helpers.pubsub import get_publisher, PUBLISHERS
+from idc_collections.manifest_jobs import LocalManifestExecutor, MANIFEST_EXECUTORS, mark_manifest_file_ready, \
+    wait_for_manifest_job, manifest_progress, register_manifest_job, get_manifest_job_status
+import tempfile
+import os
+import gzip
+import io
+from unittest import skipIf
+from idc_collections.parquet_export import stream_parquet, parquet_available, manifest_field_types
+from idc_collections.manifest_cache import manifest_cache_key, claim_manifest_cache, cache_manifest_stream, \
+    get_cached_manifest, cached_manifest_stream, evict_manifest_cache, cache_file_name
+from idc_collections.compression import compress_stream, negotiate_encoding, available_encodings, GZIP, ZSTD
+from idc_collections.views import metrics_exposition
+from metrics_helpers import histogram, render_metrics
+from metrics_helpers.orm import DB_QUERY_SECONDS
+from metrics_helpers.middleware import RequestProfileMiddleware
+from django.http import HttpResponse
+from google_helpers.stackdriver import StackDriverLogger
+import re
+import json
+from datetime import timedelta
 
 
 class ModelsTest(TestCase):
@@ -164,6 +190,51 @@ class CollexMetaDataUtilsTests(TestCase):
             pass
 
 
+    def test_fetch_data_source_join(self):
+        joins = list(DataSourceJoin.objects.select_related('from_src', 'to_src').all())
+        for join in joins:
+            edge = fetch_data_source_join(join.from_src, join.to_src)
+            self.assertEqual(edge.get_col(join.from_src.name), join.from_src_col)
+            self.assertEqual(edge.get_col(join.to_src.name), join.to_src_col)
+            reverse = fetch_data_source_join(join.to_src, join.from_src)
+            self.assertEqual(reverse.from_col, join.to_src_col)
+        # Once loaded, resolving joins should never touch the database
+        with self.assertNumQueries(0):
+            for join in joins:
+                build_solr_join_query(join.from_src, join.to_src, "*:*")
+            # Nor should pairs which can't be joined, once they've been looked for
+            for i in range(2):
+                with self.assertRaises(Exception):
+                    fetch_data_source_join_path(-1, joins[0].from_src.id)
+            with self.assertRaises(Exception):
+                fetch_data_source_join(joins[0].from_src, joins[0].from_src)
+
+    def test_create_cart_query_string(self):
+        query_list = ['', '(+Modality:("CT"))']
+        partitions = [
+            {'id': ['tcga_brca'], 'not': [], 'filt': [[0]]},
+            # Contained in the collection partition above, so it should be dropped
+            {'id': ['tcga_brca', 'TCGA-A1-A0SB'], 'not': [], 'filt': [[0]]},
+            {'id': ['4d_lung', '100_HM10395'], 'not': [], 'filt': [[0]]},
+            {'id': ['4d_lung', '101_HM10395'], 'not': [], 'filt': [[0]]},
+            {'id': ['4d_lung', '102_HM10395', '1.2.3'], 'not': ['1.2.3.4', '1.2.3.5'], 'filt': [[0]]},
+        ] + [
+            {'id': ['nlst', '100002', '1.3.6', '1.3.6.{}'.format(x)], 'not': [], 'filt': [[0, 1]]}
+            for x in range(CART_TERMS_THRESHOLD)
+        ]
+        cart_str = create_cart_query_string(query_list, partitions, False)
+        self.assertNotIn('TCGA-A1-A0SB', cart_str)
+        self.assertIn('(+PatientID:("100_HM10395" OR "101_HM10395"))', cart_str)
+        self.assertIn('NOT (+SeriesInstanceUID:("1.2.3.4" OR "1.2.3.5"))', cart_str)
+        self.assertIn('{!terms f=SeriesInstanceUID}' + ",".join(
+            ['1.3.6.{}'.format(x) for x in range(CART_TERMS_THRESHOLD)]
+        ), cart_str)
+        self.assertEqual(cart_str.count(' OR ('), 3)
+        cache_size = len(CART_QUERY_STRINGS)
+        self.assertEqual(cart_str, create_cart_query_string(query_list, partitions, False))
+        self.assertEqual(cache_size, len(CART_QUERY_STRINGS))
+        self.assertEqual(create_cart_query_string(query_list, [], False), '')
+
     ''' 
     def test_set_attrs(self):
         versions = ImagingDataCommonsVersion.objects.get(active=True).dataversion_set.all().distinct()
@@ -190,6 +261,292 @@ class CollexMetaDataUtilsTests(TestCase):
         for i in range(len(self.exp_context)):
             context = build_explorer_context(*self.exp_context[i]['args'])
         
+    # The per-attribute facet transform, on a facet response shaped like those Solr returns for the explorer (a large
+    # numeric range facet, a categorical facet, and the BMI buckets). See idc_collections.benchmarks for its timing over
+    # recorded responses.
+    def test_format_facet_values(self):
+        numeric = Attribute(id=-1, name='SliceThickness', data_type=Attribute.CONTINUOUS_NUMERIC,
+                            preformatted_values=False, units='mm')
+        categorical = Attribute(id=-2, name='Modality', data_type=Attribute.CATEGORICAL, preformatted_values=True)
+        bmi = Attribute(id=-3, name='bmi', data_type=Attribute.CATEGORICAL, preformatted_values=False)
+        facet_response = {
+            'SliceThickness': dict({"{} to {}".format(x, x+1): x for x in range(2000, 0, -1)},
+                                   **{'None': 7, 'min_max': {'min': 1, 'max': 2001}}),
+            'Modality': {x: 5 for x in ['SEG', 'CT', 'MR', 'PT', 'SR', 'RTSTRUCT']},
+            'bmi': {'obese': 1, 'None': 2, 'underweight': 3, 'overweight': 4, 'normal weight': 5}
+        }
+        display_vals = {-3: {'obese': 'Obese', 'underweight': 'Underweight'}}
+
+        num_vals, num_min_max = format_facet_values(numeric, facet_response['SliceThickness'], display_vals, True)
+        cat_vals, cat_min_max = format_facet_values(categorical, facet_response['Modality'], display_vals)
+        bmi_vals, bmi_min_max = format_facet_values(bmi, facet_response['bmi'], display_vals)
+
+        self.assertEqual(num_min_max, {'min': 1, 'max': 2001})
+        self.assertEqual(len(num_vals), 2001)
+        self.assertEqual(num_vals[0]['value'], "1 to 2")
+        self.assertEqual(num_vals[-1]['value'], 'None')
+        self.assertEqual(num_vals[0]['units'], 'mm')
+        self.assertIsNone(cat_min_max)
+        self.assertEqual([x['value'] for x in cat_vals], sorted(facet_response['Modality'].keys()))
+        self.assertEqual(cat_vals[0]['display_value'], 'CT')
+        self.assertEqual([x['value'] for x in bmi_vals], ['underweight', 'normal weight', 'overweight', 'obese', 'None'])
+        self.assertEqual(bmi_vals[0]['display_value'], 'Underweight')
+
+    # The set-based AttributeQuerySet.get_data_sources finds the same sources as the per-attribute OR'd querysets it
+    # replaced, in one query. See idc_collections.benchmarks for the timings and query plans of each.
+    def test_attr_get_data_sources(self):
+        sources = list(DataSource.objects.all()[:10])
+        self.assertTrue(len(sources), "The fixture has no data sources to attach attributes to")
+        for size in [5, 50]:
+            Attribute.objects.bulk_create([Attribute(
+                name='test_attr_{}_{}'.format(size, i), display_name='Test {}'.format(i)
+            ) for i in range(size)])
+            attrs = Attribute.objects.filter(name__startswith='test_attr_{}_'.format(size))
+            for i, attr in enumerate(attrs):
+                attr.data_sources.add(sources[i % len(sources)])
+
+            legacy = None
+            for attr in attrs:
+                legacy = attr.data_sources.all() if not legacy else (legacy | attr.data_sources.all())
+            legacy_ids = set(legacy.distinct().values_list('id', flat=True))
+            with self.assertNumQueries(1):
+                set_ids = set(attrs.get_data_sources().values_list('id', flat=True))
+            self.assertEqual(set_ids, legacy_ids)
+        self.assertFalse(Attribute.objects.filter(name='no_such_attr').get_data_sources())
+
+    def test_uid_bitmap(self):
+        index = UIDIndex('test:SeriesInstanceUID', 'SeriesInstanceUID', ["1.2.{}".format(i) for i in range(1000)])
+        first = index.to_bitmap(["1.2.{}".format(i) for i in range(0, 1000, 2)])
+        second = index.to_bitmap(["1.2.{}".format(i) for i in range(0, 1000, 3)] + ["not.indexed"])
+        self.assertEqual(len(first), 500)
+        self.assertEqual(len(second), 334)
+        self.assertEqual(len(first & second), 167)
+        self.assertEqual(len(first | second), 667)
+        self.assertEqual(len(first - second), 333)
+        self.assertEqual(list(index.to_uids(first & second))[:3], ["1.2.0", "1.2.6", "1.2.12"])
+        self.assertEqual(UIDBitmap.from_bytes((first | second).to_bytes(), index.key), first | second)
+        with self.assertRaises(ValueError):
+            first | UIDBitmap(1, 'other:SeriesInstanceUID')
+
+    # Manifest job flow against the in-memory broker, as a burst of submissions. See idc_collections.benchmarks for its
+    # timing.
+    @override_settings(PUBSUB_BACKEND='memory', PUBSUB_USER_MANIFEST_TOPIC='test-manifest-topic')
+    def test_submit_manifest_job(self):
+        PUBLISHERS.clear()
+        versions = ImagingDataCommonsVersion.objects.filter(active=True)
+        # Distinct manifests, so none are deduplicated
+        jobs = [submit_manifest_job(versions, {'collection_id': ['4d_lung']}, 'aws_bucket', 's5cmd', "# {}\n".format(i),
+                                    ['crdc_series_uuid', 'aws_bucket'], filename="manifest_aws.s5cmd")
+                for i in range(100)]
+
+        messages = get_publisher().pull('test-manifest-topic')
+        self.assertEqual(len(messages), 100)
+        self.assertEqual([json.loads(x['data'])['jobId'] for x in messages], [x[0] for x in jobs])
+        self.assertEqual(get_publisher().pull('test-manifest-topic'), [])
+
+        # A repeat request is answered with the existing job, whatever order its filter values come in
+        repeat = submit_manifest_job(versions, {'collection_id': ['4d_lung']}, 'aws_bucket', 's5cmd', "# 0\n",
+                                     ['crdc_series_uuid', 'aws_bucket'], filename="manifest_aws.s5cmd")
+        self.assertEqual(repeat, jobs[0])
+        # but one under another name gets its own file
+        renamed = submit_manifest_job(versions, {'collection_id': ['4d_lung']}, 'aws_bucket', 's5cmd', "# 0\n",
+                                      ['crdc_series_uuid', 'aws_bucket'], filename="manifest_renamed_aws.s5cmd")
+        self.assertEqual(renamed[1], "{}/manifest_renamed_aws.s5cmd".format(renamed[0]))
+        self.assertEqual(len(get_publisher().pull('test-manifest-topic')), 1)
+        self.assertEqual(manifest_cache_key(filters={'collection_id': ['a', 'b']}, versions=['1.0']),
+                         manifest_cache_key(filters={'collection_id': ['b', 'a']}, versions=['1.0']))
+        self.assertEqual(get_publisher().pull('test-manifest-topic'), [])
+
+    def test_manifest_cache(self):
+        manifest_dir = tempfile.mkdtemp()
+        with override_settings(MANIFEST_STORAGE='local', MANIFEST_LOCAL_DIR=manifest_dir):
+            key = manifest_cache_key(filters={'collection_id': ['4d_lung']}, versions=['1.0'], fields=['crdc_series_uuid'],
+                                     file_type='s5cmd')
+            rows = ["cp s3://idc-open-data/{}/* .\n".format(i) for i in range(1000)]
+            entry, created = claim_manifest_cache(key, cache_file_name(key, 's5cmd'))
+            self.assertTrue(created)
+            # While it's building, other requests don't get it, and can't claim it
+            self.assertIsNone(get_cached_manifest(key))
+            self.assertFalse(claim_manifest_cache(key, cache_file_name(key, 's5cmd'))[1])
+            self.assertEqual(list(cache_manifest_stream(entry, iter(rows), total_records=1000)), rows)
+
+            cached = get_cached_manifest(key)
+            self.assertEqual(cached.total_records, 1000)
+            self.assertEqual(b"".join(cached_manifest_stream(cached)).decode('utf-8'), "".join(rows))
+
+            # An abandoned build leaves nothing behind
+            other_key = manifest_cache_key(filters={'collection_id': ['other']}, versions=['1.0'])
+            entry, created = claim_manifest_cache(other_key, cache_file_name(other_key, 's5cmd'))
+            stream = cache_manifest_stream(entry, iter(rows))
+            next(stream)
+            stream.close()
+            self.assertIsNone(get_cached_manifest(other_key))
+            self.assertTrue(claim_manifest_cache(other_key, cache_file_name(other_key, 's5cmd'))[1])
+
+            with override_settings(MANIFEST_CACHE_MAX_BYTES=10):
+                evict_manifest_cache()
+            self.assertIsNone(get_cached_manifest(key))
+            self.assertFalse(os.path.exists(os.path.join(manifest_dir, cache_file_name(key, 's5cmd'))))
+
+            # A job which never completes stops holding its key after MANIFEST_CACHE_BUILD_TIMEOUT
+            job = register_manifest_job([{'jobId': 'stalled-job', 'file_name': "manifest_20240101_120000_aws.s5cmd"}])
+            job_key = manifest_cache_key(filters={'collection_id': ['stalled']}, versions=['1.0'])
+            entry, created = claim_manifest_cache(job_key, job.file_name, job=job)
+            self.assertFalse(claim_manifest_cache(job_key, job.file_name)[1])
+            Manifest_Cache_Entry.objects.filter(id=entry.id).update(date_created=entry.date_created - timedelta(days=1))
+            with override_settings(MANIFEST_CACHE_BUILD_TIMEOUT=60):
+                self.assertTrue(claim_manifest_cache(job_key, cache_file_name(job_key, 's5cmd'))[1])
+
+    @skipIf(not parquet_available(), "pyarrow isn't installed")
+    def test_stream_parquet(self):
+        import pyarrow.parquet
+        fields = ['SeriesInstanceUID', 'collection_id', 'crdc_series_uuid']
+        rows = ({'SeriesInstanceUID': "1.2.{}".format(i), 'collection_id': ['4d_lung'], 'crdc_series_uuid': str(i)}
+                for i in range(2500))
+        chunks = list(stream_parquet(rows, fields, row_group_size=1000, metadata={'idc_version': '3.0'}))
+        # One chunk per full row group, then the last partial group with the footer
+        self.assertEqual(len(chunks), 3)
+        parquet_file = pyarrow.parquet.ParquetFile(io.BytesIO(b"".join(chunks)))
+        self.assertEqual(parquet_file.metadata.num_row_groups, 3)
+        self.assertEqual(parquet_file.metadata.num_rows, 2500)
+        self.assertEqual(parquet_file.schema_arrow.names, fields)
+        self.assertEqual([x['type'] for x in manifest_field_types(fields)], ['STRING', 'STRING', 'STRING'])
+        self.assertEqual(parquet_file.read().slice(1, 1).to_pylist(),
+                         [{'SeriesInstanceUID': '1.2.1', 'collection_id': '4d_lung', 'crdc_series_uuid': '1'}])
+
+    def test_manifest_compression(self):
+        rows = ["cp s3://idc-open-data/{}/* .\n".format(i) for i in range(10000)]
+        compressed = b"".join(compress_stream(iter(rows), GZIP))
+        self.assertEqual(gzip.decompress(compressed).decode('utf-8'), "".join(rows))
+        # Manifests are mostly repeated URL text; see idc_collections.benchmarks for the ratio and timing on a manifest
+        self.assertLess(len(compressed) * 4, len("".join(rows)))
+
+        factory = RequestFactory()
+        self.assertEqual(negotiate_encoding(factory.get('/', HTTP_ACCEPT_ENCODING='gzip, deflate')), GZIP)
+        self.assertEqual(negotiate_encoding(factory.get('/', HTTP_ACCEPT_ENCODING='gzip;q=0, identity')), None)
+        self.assertEqual(negotiate_encoding(factory.get('/', HTTP_ACCEPT_ENCODING='gzip'), 'none'), None)
+        self.assertEqual(negotiate_encoding(factory.get('/', HTTP_ACCEPT_ENCODING='zstd, gzip;q=0.5')),
+                         ZSTD if ZSTD in available_encodings() else GZIP)
+
+    @override_settings(METRICS_TOKEN='test-token')
+    def test_metrics(self):
+        test_seconds = histogram('idc_test_seconds', "Test timings", ['core'], buckets=(0.1, 1.0))
+        test_seconds.observe(0.05, core='a "quoted" core')
+        test_seconds.observe(5, core='a "quoted" core')
+        selects = DB_QUERY_SECONDS.get(alias='default', vendor=connection.vendor, statement='SELECT',
+                                       caller='test_metrics')['count']
+        Attribute.objects.count()
+        self.assertEqual(DB_QUERY_SECONDS.get(alias='default', vendor=connection.vendor, statement='SELECT',
+                                              caller='test_metrics')['count'], selects + 1)
+
+        exposition = render_metrics()
+        self.assertIn('# TYPE idc_test_seconds histogram', exposition)
+        self.assertIn('idc_test_seconds_bucket{core="a \\"quoted\\" core",le="0.1"} 1', exposition)
+        self.assertIn('idc_test_seconds_bucket{core="a \\"quoted\\" core",le="+Inf"} 2', exposition)
+        self.assertIn('idc_test_seconds_count{core="a \\"quoted\\" core"} 2', exposition)
+
+        factory = RequestFactory()
+        request = factory.get('/collections/metrics/')
+        request.user = AnonymousUser()
+        self.assertEqual(metrics_exposition(request).status_code, 403)
+        request = factory.get('/collections/metrics/', HTTP_AUTHORIZATION='Bearer test-token')
+        request.user = AnonymousUser()
+        response = metrics_exposition(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'# TYPE idc_db_query_seconds histogram', response.content)
+
+    def test_request_profile_middleware(self):
+        def view(request):
+            Attribute.objects.count()
+            Program.objects.count()
+            return HttpResponse("OK")
+
+        profile_dir = tempfile.mkdtemp()
+        request = RequestFactory().get('/collections/')
+        request.user = AnonymousUser()
+        # The header is only sent where it's been enabled, and here only to staff
+        self.assertFalse(RequestProfileMiddleware(view)(request).has_header('Server-Timing'))
+        with override_settings(REQUEST_PROFILE_SERVER_TIMING='staff'):
+            self.assertFalse(RequestProfileMiddleware(view)(request).has_header('Server-Timing'))
+            request.user = User(username='staff', is_staff=True)
+            with override_settings(REQUEST_PROFILE_SAMPLE_RATE=1, REQUEST_PROFILE_DIR=profile_dir):
+                with self.assertLogs('metrics_helpers.middleware', level='INFO') as logs:
+                    response = RequestProfileMiddleware(view)(request)
+        self.assertRegex(response['Server-Timing'], r'^db;dur=[0-9.]+;desc="2 calls", app;dur=[0-9.]+, total;dur=[0-9.]+$')
+        record = json.loads(logs.records[-1].getMessage()[len("[PROFILE] "):])
+        self.assertEqual(record['backends']['db']['calls'], 2)
+        self.assertIn('view', record['profile'])
+        self.assertEqual(len(os.listdir(profile_dir)), 1)
+
+    @override_settings(STACKDRIVER_LOG_BACKEND='memory', STACKDRIVER_BATCH_MAX_ENTRIES=10)
+    def test_stackdriver_logger(self):
+        st_logger = StackDriverLogger.build_from_django_settings()
+        st_logger.worker.sink.clear()
+        for i in range(100):
+            st_logger.write_text_log_entry('test_log', "Entry {}".format(i))
+        st_logger.write_struct_log_entry('test_struct_log', {'cohort_id': 1}, severity="INFO")
+        self.assertTrue(st_logger.flush(timeout=5))
+        self.assertEqual([x['textPayload'] for x in st_logger.worker.sink.get_entries('test_log')],
+                         ["Entry {}".format(i) for i in range(100)])
+        self.assertEqual(st_logger.worker.sink.get_entries('test_struct_log'),
+                         [{'severity': "INFO", 'jsonPayload': {'cohort_id': 1}}])
+
+    # A sharded manifest job run on the local executor, with a stand-in for BigQuery which returns each shard's number
+    @override_settings(MANIFEST_EXECUTOR='local')
+    def test_sharded_manifest_job(self):
+        # Shards complete on worker threads, which can't see this test's transaction, so the registry is updated here
+        written = []
+        executor = LocalManifestExecutor(
+            out_dir=tempfile.mkdtemp(), on_ready=written.append, on_failure=lambda job_id: None,
+            query_runner=lambda query, params: [{'series': "cp s3://bucket/{}/* ./".format(re.search(r'= (\d+)$', query).group(1))}]
+        )
+        MANIFEST_EXECUTORS['local'] = executor
+        # Storage is left empty, so only the notifications below mark the shards ready
+        storage = override_settings(MANIFEST_STORAGE='local', MANIFEST_LOCAL_DIR=tempfile.mkdtemp())
+        storage.enable()
+        try:
+            versions = ImagingDataCommonsVersion.objects.filter(active=True)
+            job_id, file_name = submit_manifest_job(versions, {'collection_id': ['4d_lung']}, 'aws_bucket', 's5cmd', "",
+                                                    ['crdc_series_uuid', 'aws_bucket'], filename="manifest_20240101_120000_aws.s5cmd",
+                                                    shard_count=4)
+            executor.wait(job_id)
+
+            self.assertEqual(wait_for_manifest_job(job_id, 0)['status'], 'Queued')
+            # Repeat notifications and files the job doesn't expect are ignored
+            for written_file in sorted(written):
+                # The index is only written once every shard is ready
+                self.assertIsNone(executor.progress(job_id))
+                mark_manifest_file_ready(written_file)
+                mark_manifest_file_ready(written_file)
+            mark_manifest_file_ready("{}.gz".format(written[0]))
+        finally:
+            storage.disable()
+            del MANIFEST_EXECUTORS['local']
+        status = wait_for_manifest_job(job_id, 5)
+        self.assertEqual((status['manifest_ready'], status['shards_ready']), (True, 4))
+        self.assertEqual(manifest_progress(job_id)['shards_ready'], 4)
+        self.assertIsNone(wait_for_manifest_job('no-such-job', 0))
+
+        self.assertEqual(file_name, "{}/index.json".format(job_id))
+        progress = executor.progress(job_id)
+        self.assertEqual((progress['shards_ready'], progress['manifest_ready']), (4, True))
+        self.assertEqual(progress['shards'][3]['file_name'], "{}/manifest_20240101_120000_003_aws.s5cmd".format(job_id))
+        with open("{}/{}".format(executor.out_dir, progress['shards'][3]['file_name'])) as f:
+            self.assertEqual(f.read().splitlines()[-1], "cp s3://bucket/3/* ./")
+
+    def test_manifest_job_storage_fallback(self):
+        # Status checks only read the registry, but a waiting request finds a job's file in storage even if no
+        # notification for it ever arrives
+        manifest_dir = tempfile.mkdtemp()
+        with override_settings(MANIFEST_STORAGE='local', MANIFEST_LOCAL_DIR=manifest_dir):
+            register_manifest_job([{'jobId': 'fallback-job', 'file_name': "manifest_20240101_120000_aws.s5cmd"}])
+            self.assertEqual(get_manifest_job_status('fallback-job')['status'], 'Queued')
+            os.makedirs(os.path.join(manifest_dir, 'fallback-job'))
+            with open(os.path.join(manifest_dir, 'fallback-job', "manifest_20240101_120000_aws.s5cmd"), 'w') as f:
+                f.write("cp s3://bucket/1/* ./\n")
+            self.assertEqual(get_manifest_job_status('fallback-job')['status'], 'Queued')
+            self.assertTrue(wait_for_manifest_job('fallback-job', 0)['manifest_ready'])
+
     def test_get_collex_metadata(self):
         #default_collex = get_collex_metadata(None,None)
         default_collex = get_collex_metadata(None, [])
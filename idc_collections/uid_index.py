@@ -0,0 +1,200 @@
+#
+# Copyright 2015-2024, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import logging
+import time
+import zlib
+import threading
+from collections import OrderedDict
+from idc_collections.models import ImagingDataCommonsVersion, DataSetType, DataSource
+from idc_collections.collex_metadata_utils import filter_manifest, get_cart_data_serieslvl
+from solr_helpers import export_solr, can_export
+from metrics_helpers import histogram
+
+logger = logging.getLogger(__name__)
+
+UID_INDEX_BUILD_SECONDS = histogram(
+    'idc_uid_index_build_seconds', "Time to build a UID index from Solr, by level and IDC versions", ['level', 'version'])
+
+# Dense integer indexes of the series/study UIDs in an IDC version, keyed on '<version numbers>:<level>'. A version's
+# data never changes once released, so an index is built once (from a sorted Solr export) and then reused; a UID's
+# integer ID is its position in UID order.
+#
+# Each index holds every UID of its level, so only MAX_UID_INDEXES are kept (least recently used dropped first), and
+# indexes of versions which are no longer active are dropped whenever a new one is built.
+UID_INDEXES = OrderedDict()
+MAX_UID_INDEXES = 2
+UID_INDEX_LOCK = threading.Lock()
+
+
+# A set of dense UID index IDs, stored as the bits of a Python int (bit n is set if ID n is a member). Union,
+# intersection, and difference are single big-integer operations, and the serialized form is zlib compressed, which
+# keeps the sparse sets most cohorts produce small.
+#
+# Bitmaps built against different indexes aren't comparable, so each carries the key of the index it came from.
+class UIDBitmap(object):
+    __slots__ = ('bits', 'index_key')
+
+    def __init__(self, bits=0, index_key=None):
+        self.bits = bits
+        self.index_key = index_key
+
+    @classmethod
+    def from_ids(cls, ids, size, index_key=None):
+        data = bytearray((size + 7) // 8)
+        for i in ids:
+            data[i >> 3] |= 1 << (i & 7)
+        return cls(int.from_bytes(bytes(data), 'little'), index_key)
+
+    @classmethod
+    def from_bytes(cls, data, index_key=None):
+        return cls(int.from_bytes(zlib.decompress(data), 'little'), index_key)
+
+    def to_bytes(self):
+        return zlib.compress(self.bits.to_bytes((self.bits.bit_length() + 7) // 8, 'little'))
+
+    def _check_index(self, other):
+        if self.index_key != other.index_key:
+            raise ValueError("Can't combine UID bitmaps from different indexes ({} and {})!".format(
+                self.index_key, other.index_key
+            ))
+
+    def __or__(self, other):
+        self._check_index(other)
+        return UIDBitmap(self.bits | other.bits, self.index_key)
+
+    def __and__(self, other):
+        self._check_index(other)
+        return UIDBitmap(self.bits & other.bits, self.index_key)
+
+    def __sub__(self, other):
+        self._check_index(other)
+        return UIDBitmap(self.bits & ~other.bits, self.index_key)
+
+    def __xor__(self, other):
+        self._check_index(other)
+        return UIDBitmap(self.bits ^ other.bits, self.index_key)
+
+    def __eq__(self, other):
+        return isinstance(other, UIDBitmap) and self.bits == other.bits and self.index_key == other.index_key
+
+    def __len__(self):
+        return bin(self.bits).count("1")
+
+    def __contains__(self, i):
+        return bool((self.bits >> i) & 1)
+
+    # Member IDs in ascending order
+    def __iter__(self):
+        data = self.bits.to_bytes((self.bits.bit_length() + 7) // 8, 'little')
+        for pos, byte in enumerate(data):
+            while byte:
+                low = byte & -byte
+                yield (pos << 3) + low.bit_length() - 1
+                byte ^= low
+
+
+class UIDIndex(object):
+    def __init__(self, key, level, uids):
+        self.key = key
+        self.level = level
+        self.uids = uids
+        self.ids = {uid: i for i, uid in enumerate(uids)}
+
+    def __len__(self):
+        return len(self.uids)
+
+    def to_bitmap(self, uids):
+        ids = []
+        missing = 0
+        for uid in uids:
+            i = self.ids.get(uid, None)
+            if i is None:
+                missing += 1
+            else:
+                ids.append(i)
+        if missing:
+            logger.warning("[WARNING] {} UIDs weren't found in the {} index and were left out of the bitmap.".format(
+                missing, self.key
+            ))
+        return UIDBitmap.from_ids(ids, len(self.uids), self.key)
+
+    # UIDs of a bitmap's members, in UID order
+    def to_uids(self, bitmap):
+        if bitmap.index_key != self.key:
+            raise ValueError("Bitmap for index {} can't be read with index {}!".format(bitmap.index_key, self.key))
+        return (self.uids[i] for i in bitmap)
+
+
+# Fetch the UID index for a set of IDC versions (default: the active version) at the given level, building it from
+# Solr if this process hasn't yet
+def get_uid_index(versions=None, level="SeriesInstanceUID"):
+    versions = versions or ImagingDataCommonsVersion.objects.filter(active=True)
+    if len(versions.filter(active=False)):
+        raise Exception("UID indexes can only be built for active versions, as archived data isn't in Solr.")
+    key = "{}:{}".format(";".join(sorted(versions.values_list('version_number', flat=True))), level)
+
+    with UID_INDEX_LOCK:
+        index = UID_INDEXES.get(key, None)
+        if index is not None:
+            UID_INDEXES.move_to_end(key)
+    if index is None:
+        logger.info("[STATUS] UID index {} not found, building.".format(key))
+        source = DataSetType.objects.get(data_type=DataSetType.IMAGE_DATA).datasource_set.filter(
+            id__in=versions.get_data_sources(source_type=DataSource.SOLR, aggregate_level=level)
+        ).first()
+        if not source:
+            raise Exception("No Solr data source found for {}.".format(key))
+        sort = "{} asc".format(level)
+        if not can_export(source.name, [level], sort):
+            raise Exception("{} can't be exported from {}; UID index {} can't be built.".format(level, source.name, key))
+        start = time.time()
+        uids = []
+        for doc in export_solr(collection=source.name, fields=[level], sort=sort):
+            # The export is sorted, so any repeats (eg. of a study UID in a series-level source) are adjacent
+            if not len(uids) or uids[-1] != doc[level]:
+                uids.append(doc[level])
+        index = UIDIndex(key, level, uids)
+        stop = time.time()
+        logger.info("[STATUS] Built UID index {} ({} UIDs).".format(key, len(uids)))
+        UID_INDEX_BUILD_SECONDS.observe(stop - start, level=level, version=key.split(":")[0])
+
+        active = set(ImagingDataCommonsVersion.objects.filter(active=True).values_list('version_number', flat=True))
+        with UID_INDEX_LOCK:
+            for stale in [x for x in UID_INDEXES if not set(x.split(":")[0].split(";")) <= active]:
+                UID_INDEXES.pop(stale)
+            UID_INDEXES[key] = index
+            while len(UID_INDEXES) > MAX_UID_INDEXES:
+                UID_INDEXES.popitem(last=False)
+
+    return index
+
+
+# Bitmap of the UIDs matching a set of filters, the same records a manifest of these filters would list
+def filters_bitmap(filters, sources, versions, level="SeriesInstanceUID"):
+    index = get_uid_index(versions, level)
+    records = filter_manifest(filters, sources, versions, [level], len(index), level=level, stream=True)
+    if records is None or records.get('docs', None) is None:
+        raise Exception("Failed to retrieve the {} records for filters {}.".format(level, filters))
+    return index.to_bitmap(x[level] for x in records['docs'])
+
+
+# Bitmap of the series in a cart, against the active version
+def cart_bitmap(filtergrp_list, partitions):
+    index = get_uid_index(level="SeriesInstanceUID")
+    result = get_cart_data_serieslvl(filtergrp_list, partitions, ["SeriesInstanceUID"], len(index), 0, dois_only=True,
+                                     stream_records=True)
+    return index.to_bitmap(x['SeriesInstanceUID'] for x in result['docs'])
@@ -37,8 +37,10 @@ from idc_collections.models import User_Feature_Definitions, User_Feature_Counts
 from solr_helpers import *
 from sharing.service import create_share
 from googleapiclient.errors import HttpError
+from metrics_helpers import render_metrics
 
 import json
+import hmac
 import requests
 import logging
 
@@ -46,6 +48,20 @@ logger = logging.getLogger(__name__)
 
 DENYLIST_RE = settings.DENYLIST_RE
 
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+# This process's metrics in the Prometheus text format. Scrapers authenticate with METRICS_TOKEN as a bearer token;
+# staff users can view the page directly.
+@never_cache
+def metrics_exposition(request):
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    auth = request.META.get('HTTP_AUTHORIZATION', '')
+    if not (request.user.is_authenticated and request.user.is_staff) and not (
+            token and hmac.compare_digest(auth, "Bearer {}".format(token))):
+        return HttpResponse("Not authorized.", status=403, content_type="text/plain")
+    return HttpResponse(render_metrics(), content_type=METRICS_CONTENT_TYPE)
+
 
 @cache_page(60 *15)
 def collection_list(request):
@@ -0,0 +1,230 @@
+#
+# Copyright 2015-2024, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Process-wide metrics (counters and histograms, with labels), exposed in the Prometheus text format. Metrics are
+# declared once at module level:
+#
+#   SOLR_REQUESTS = histogram('idc_solr_request_seconds', "Solr request time", ['core', 'handler', 'caller'])
+#
+# and observed at the call site:
+#
+#   with SOLR_REQUESTS.time(core=collection, handler='query', caller=get_caller()):
+#       ...
+#
+# Values are per process; a scrape of a multi-process server sees the process which served it, so scrape each worker
+# or aggregate by instance.
+#
+# Histograms which time calls to a backend (the database, Solr, BigQuery, GCS) are declared with backend=<name>; their
+# observations are also added to the profile of the request being handled on the same thread, if one has been started
+# (see metrics_helpers.middleware).
+
+import sys
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the default histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+METRICS = {}
+METRICS_LOCK = threading.Lock()
+
+REQUEST_PROFILE = threading.local()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + (list(extra) if extra else [])
+    if not len(pairs):
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, _escape(v)) for k, v in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric(object):
+    TYPE = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.series = {}
+
+    # Label values in declaration order; undeclared labels are an error, missing ones are left blank
+    def _key(self, labels):
+        unknown = [x for x in labels if x not in self.labels]
+        if len(unknown):
+            raise ValueError("Metric {} has no label(s) {}".format(self.name, ", ".join(unknown)))
+        return tuple(str(labels.get(x, "")) for x in self.labels)
+
+    def reset(self):
+        with self.lock:
+            self.series = {}
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, _escape(self.description)), "# TYPE {} {}".format(self.name, self.TYPE)]
+        with self.lock:
+            series = list(self.series.items())
+        for key, value in sorted(series):
+            lines.extend(self._render_series(key, value))
+        return lines
+
+
+class Counter(_Metric):
+    TYPE = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.series.get(self._key(labels), 0)
+
+    def _render_series(self, key, value):
+        return ["{}{} {}".format(self.name, _format_labels(self.labels, key), _format_value(value))]
+
+
+class Histogram(_Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS, backend=None):
+        super(Histogram, self).__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self.backend = backend
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            series = self.series.get(key, None)
+            if not series:
+                series = self.series[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['counts'][i] += 1
+                    break
+            series['sum'] += value
+            series['count'] += 1
+        if self.backend:
+            _profile_backend(self.backend, value)
+
+    # Time the enclosed block, observing its duration even if it raises
+    @contextmanager
+    def time(self, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def get(self, **labels):
+        series = self.series.get(self._key(labels), None)
+        return {'sum': series['sum'], 'count': series['count']} if series else {'sum': 0.0, 'count': 0}
+
+    def _render_series(self, key, value):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, value['counts']):
+            cumulative += count
+            lines.append("{}_bucket{} {}".format(
+                self.name, _format_labels(self.labels, key, [('le', _format_value(bound))]), cumulative))
+        lines.append("{}_sum{} {}".format(self.name, _format_labels(self.labels, key), _format_value(value['sum'])))
+        lines.append("{}_count{} {}".format(self.name, _format_labels(self.labels, key), value['count']))
+        return lines
+
+
+def _register(cls, name, description, labels, **kwargs):
+    with METRICS_LOCK:
+        metric = METRICS.get(name, None)
+        if metric:
+            if not isinstance(metric, cls) or metric.labels != tuple(labels):
+                raise ValueError("Metric {} is already registered as a different type or with different labels.".format(
+                    name))
+            return metric
+        metric = METRICS[name] = cls(name, description, labels, **kwargs)
+        return metric
+
+
+# Fetch or declare a counter
+def counter(name, description, labels=()):
+    return _register(Counter, name, description, labels)
+
+
+# Fetch or declare a histogram
+def histogram(name, description, labels=(), buckets=DEFAULT_BUCKETS, backend=None):
+    return _register(Histogram, name, description, labels, buckets=buckets, backend=backend)
+
+
+# Start accumulating backend time and call counts for the request handled on this thread
+def start_request_profile():
+    REQUEST_PROFILE.backends = {}
+
+
+# Stop accumulating, and return {backend: {'time': seconds, 'count': calls}} for the request
+def stop_request_profile():
+    backends = getattr(REQUEST_PROFILE, 'backends', None)
+    REQUEST_PROFILE.backends = None
+    return backends or {}
+
+
+def _profile_backend(backend, duration):
+    backends = getattr(REQUEST_PROFILE, 'backends', None)
+    if backends is None:
+        return
+    entry = backends.get(backend, None)
+    if not entry:
+        entry = backends[backend] = {'time': 0.0, 'count': 0}
+    entry['time'] += duration
+    entry['count'] += 1
+
+
+# Name of the function which called the instrumented function, for 'caller' labels. Frames in modules starting with
+# any of skip_modules (eg. the instrumented module's own helpers) are passed over.
+def get_caller(skip_modules=()):
+    skip_modules = tuple(skip_modules)
+    frame = sys._getframe(2)
+    while frame and frame.f_globals.get('__name__', '').startswith(skip_modules):
+        frame = frame.f_back
+    return frame.f_code.co_name if frame else "unknown"
+
+
+# All metrics in the Prometheus text exposition format (version 0.0.4)
+def render_metrics():
+    with METRICS_LOCK:
+        metrics = [METRICS[x] for x in sorted(METRICS.keys())]
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def reset_metrics():
+    with METRICS_LOCK:
+        metrics = list(METRICS.values())
+    for metric in metrics:
+        metric.reset()
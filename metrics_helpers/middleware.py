@@ -0,0 +1,122 @@
+#
+# Copyright 2015-2024, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import io
+import os
+import json
+import time
+import random
+import logging
+import cProfile
+import pstats
+from django.conf import settings
+from metrics_helpers import start_request_profile, stop_request_profile
+
+logger = logging.getLogger(__name__)
+
+# Backends reported in the Server-Timing header, in order; time not spent in any of them is reported as 'app'
+PROFILE_BACKENDS = ['db', 'solr', 'bigquery', 'gcs']
+
+# Number of functions listed in a sampled profile's log record
+PROFILE_STATS_LIMIT = 40
+
+
+# Per-request performance profile: the time and number of calls spent in each backend, reported in a [PROFILE] log
+# record and, if REQUEST_PROFILE_SERVER_TIMING is set, a Server-Timing header. The header shows how a request was
+# served, so it's off by default; set it to 'staff' to send it to staff users only, or True to send it to everyone.
+# A fraction of requests (REQUEST_PROFILE_SAMPLE_RATE, default none) are also run
+# under cProfile, with the top functions logged and, if REQUEST_PROFILE_DIR is set, the full profile saved there.
+#
+# Add 'metrics_helpers.middleware.RequestProfileMiddleware' near the top of MIDDLEWARE. Backend calls made on other
+# threads, or while a streaming response is being consumed, aren't included.
+class RequestProfileMiddleware(object):
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.sample_rate = getattr(settings, 'REQUEST_PROFILE_SAMPLE_RATE', 0)
+        self.profile_dir = getattr(settings, 'REQUEST_PROFILE_DIR', None)
+        self.server_timing = getattr(settings, 'REQUEST_PROFILE_SERVER_TIMING', False)
+
+    def __call__(self, request):
+        profiler = None
+        if self.sample_rate and random.random() < self.sample_rate:
+            profiler = cProfile.Profile()
+        start_request_profile()
+        start = time.time()
+        try:
+            if profiler:
+                try:
+                    profiler.enable()
+                except ValueError:
+                    # Another profiler is already active on this thread
+                    profiler = None
+            response = self.get_response(request)
+        finally:
+            if profiler:
+                profiler.disable()
+            stop = time.time()
+            backends = stop_request_profile()
+
+        total = stop - start
+        if self._send_server_timing(request):
+            response['Server-Timing'] = server_timing_header(total, backends)
+        record = {
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'duration_ms': round(total * 1000, 1),
+            'backends': {k: {'duration_ms': round(v['time'] * 1000, 1), 'calls': v['count']} for k, v in backends.items()}
+        }
+        if profiler:
+            record['profile'] = self._profile_stats(profiler, request)
+        logger.info("[PROFILE] {}".format(json.dumps(record)))
+        return response
+
+    def _send_server_timing(self, request):
+        if self.server_timing == 'staff':
+            user = getattr(request, 'user', None)
+            return bool(user and user.is_staff)
+        return bool(self.server_timing)
+
+    def _profile_stats(self, profiler, request):
+        try:
+            if self.profile_dir:
+                os.makedirs(self.profile_dir, exist_ok=True)
+                profiler.dump_stats(os.path.join(self.profile_dir, "{}_{}.prof".format(
+                    time.strftime('%Y%m%d_%H%M%S'), request.path.strip("/").replace("/", "_") or "root")))
+            output = io.StringIO()
+            pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(PROFILE_STATS_LIMIT)
+            return output.getvalue()
+        except Exception as e:
+            logger.error("[ERROR] While saving the profile of {}:".format(request.path))
+            logger.exception(e)
+            return None
+
+
+# Server-Timing header value for a request which took total seconds, given its backend times
+def server_timing_header(total, backends):
+    metrics = []
+    backend_time = 0.0
+    for backend in PROFILE_BACKENDS + sorted(x for x in backends if x not in PROFILE_BACKENDS):
+        if backend not in backends:
+            continue
+        backend_time += backends[backend]['time']
+        metrics.append('{};dur={:.1f};desc="{} call{}"'.format(
+            backend, backends[backend]['time'] * 1000, backends[backend]['count'],
+            "" if backends[backend]['count'] == 1 else "s"))
+    # Backend calls made in parallel can add up to more than the request's own time
+    metrics.append("app;dur={:.1f}".format(max(total - backend_time, 0) * 1000))
+    metrics.append("total;dur={:.1f}".format(total * 1000))
+    return ", ".join(metrics)
@@ -0,0 +1,57 @@
+#
+# Copyright 2015-2024, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import time
+from metrics_helpers import histogram, counter, get_caller
+
+DB_QUERY_SECONDS = histogram(
+    'idc_db_query_seconds', "Time taken by database queries, by connection, statement type and calling function",
+    ['alias', 'vendor', 'statement', 'caller'], backend='db')
+DB_ERRORS = counter(
+    'idc_db_errors_total', "Failed database queries, by connection, statement type and calling function",
+    ['alias', 'vendor', 'statement', 'caller'])
+
+STATEMENTS = ['SELECT', 'INSERT', 'UPDATE', 'DELETE']
+
+# Frames skipped when looking for the code which ran a query: the ORM's own, and this module's
+SKIP_MODULES = ('django.', 'metrics_helpers', 'contextlib')
+
+
+def _statement(sql):
+    verb = sql.lstrip()[:6].upper()
+    return verb if verb in STATEMENTS else 'OTHER'
+
+
+def _execute_wrapper(execute, sql, params, many, context):
+    connection = context['connection']
+    labels = {
+        'alias': connection.alias, 'vendor': connection.vendor, 'statement': _statement(sql),
+        'caller': get_caller(SKIP_MODULES)
+    }
+    start = time.time()
+    try:
+        return execute(sql, params, many, context)
+    except Exception:
+        DB_ERRORS.inc(**labels)
+        raise
+    finally:
+        DB_QUERY_SECONDS.observe(time.time() - start, **labels)
+
+
+# connection_created receiver which times every query run on the new connection
+def instrument_connection(sender, connection, **kwargs):
+    if _execute_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_execute_wrapper)
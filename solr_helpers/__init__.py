@@ -6,13 +6,25 @@ import json
 import re
 import hashlib
 import time
+import threading
+from collections import OrderedDict
 
-from idc_collections.models import Attribute, DataSource, Attribute_Ranges, DataSetType
+from django.db.models.signals import post_save
+from idc_collections.models import Attribute, DataSource, Attribute_Ranges, DataSetType, ImagingDataCommonsVersion
 
 from google_helpers.bigquery.utils import MOLECULAR_CATEGORIES
+from metrics_helpers import histogram, counter, get_caller
 
 logger = logging.getLogger(__name__)
 
+SOLR_REQUEST_SECONDS = histogram(
+    'idc_solr_request_seconds', "Time to call Solr, by core, handler and calling function", ['core', 'handler', 'caller'],
+    backend='solr')
+SOLR_ERRORS = counter(
+    'idc_solr_errors_total', "Failed Solr requests, by core, handler and calling function", ['core', 'handler', 'caller'])
+SOLR_EXPORTED_DOCUMENTS = counter(
+    'idc_solr_exported_documents_total', "Documents streamed from Solr's /export handler, by core", ['core'])
+
 SOLR_URI = settings.SOLR_URI
 SOLR_LOGIN = settings.SOLR_LOGIN
 SOLR_PASSWORD = settings.SOLR_PASSWORD
@@ -177,22 +189,13 @@ def query_solr(collection=None, fields=None, query_string=None, fqs=None, facets
 
     query_result = {}
 
+    caller = get_caller((__name__,))
     try:
-        start = time.time()
-        post_vars = {
-            'data': json.dumps(payload),
-            'headers': {'Content-type': 'application/json'},
-            'auth': (SOLR_LOGIN, SOLR_PASSWORD)
-        }
-        if SOLR_CERT:
-            post_vars.update({'verify': SOLR_CERT})
-        if WEBAPP_KEY:
-            post_vars['headers'].update({'X-WEBAPP-KEY': WEBAPP_KEY})
-
-        query_response = requests.post(query_uri, **post_vars)
-        stop = time.time()
+        post_vars = _solr_request_vars({'Content-type': 'application/json'})
+        post_vars['data'] = json.dumps(payload)
 
-        logger.info("[BENCHMARKING] Time to call Solr at {} via POST to core {}: {}s".format(SOLR_URI, collection,str(stop-start)))
+        with SOLR_REQUEST_SECONDS.time(core=collection, handler='query', caller=caller):
+            query_response = requests.post(query_uri, **post_vars)
 
         if query_response.status_code != 200:
             msg = "Saw response code {} when querying solr collection {} with string {}\npayload: {}\nresponse text: {}".format(
@@ -202,12 +205,156 @@ def query_solr(collection=None, fields=None, query_string=None, fqs=None, facets
             raise Exception(msg)
         query_result = query_response.json()
     except Exception as e:
+        SOLR_ERRORS.inc(core=collection, handler='query', caller=caller)
         logger.error("[ERROR] While querying solr collection {}:".format(collection, payload['query']))
         logger.exception(e)
 
     return query_result
 
 
+# Fields per collection which are docValues-backed, and so eligible for retrieval via the /export handler:
+#
+# {
+#   <collection name>: set(<field name>, ...)
+# }
+SOLR_EXPORTABLE_FIELDS = {}
+
+
+def _solr_request_vars(headers=None):
+    req_vars = {
+        'headers': headers or {},
+        'auth': (SOLR_LOGIN, SOLR_PASSWORD)
+    }
+    if SOLR_CERT:
+        req_vars.update({'verify': SOLR_CERT})
+    if WEBAPP_KEY:
+        req_vars['headers'].update({'X-WEBAPP-KEY': WEBAPP_KEY})
+    return req_vars
+
+
+# Fetch (and cache) the set of fields in a collection's schema which have docValues enabled
+def get_exportable_fields(collection):
+    if collection not in SOLR_EXPORTABLE_FIELDS:
+        exportable = set()
+        try:
+            schema_response = requests.get(
+                "{}{}/schema/fields".format(SOLR_URI, collection),
+                params={'showDefaults': 'true'}, **_solr_request_vars()
+            )
+            if schema_response.status_code != 200:
+                raise Exception("Saw response code {} when fetching the schema of collection {}: {}".format(
+                    str(schema_response.status_code), collection, schema_response.text
+                ))
+            exportable = set(
+                field['name'] for field in schema_response.json().get('fields', []) if field.get('docValues', False)
+            )
+        except Exception as e:
+            logger.error("[ERROR] While fetching the schema fields of solr collection {}:".format(collection))
+            logger.exception(e)
+            # Don't cache a failed lookup; callers will fall back to standard paging
+            return exportable
+        SOLR_EXPORTABLE_FIELDS[collection] = exportable
+
+    return SOLR_EXPORTABLE_FIELDS[collection]
+
+
+# Determine if a record request can be served by the /export handler: every requested field and sort field must be
+# docValues-backed. Note that /export requires a sort.
+def can_export(collection, fields, sort):
+    if not fields or not sort:
+        return False
+    sort_fields = [x.strip().split(" ")[0] for x in sort.split(",") if len(x.strip())]
+    exportable = get_exportable_fields(collection)
+    return bool(len(exportable)) and all(x in exportable for x in list(fields) + sort_fields)
+
+
+# Incrementally parse the documents out of an /export response body, without holding the full response in memory:
+#
+# {"responseHeader":{...}, "response":{"numFound":<int>, "docs":[{...},{...}, ...]}}
+def _iter_export_docs(chunks):
+    decoder = json.JSONDecoder()
+    separators = re.compile(r'[\s,]*')
+    buffer = ""
+    in_docs = False
+    for chunk in chunks:
+        buffer += chunk
+        if not in_docs:
+            docs_start = re.search(r'"docs"\s*:\s*\[', buffer)
+            if not docs_start:
+                continue
+            buffer = buffer[docs_start.end():]
+            in_docs = True
+        pos = 0
+        while True:
+            pos = separators.match(buffer, pos).end()
+            if pos >= len(buffer):
+                break
+            if buffer[pos] == "]":
+                return
+            try:
+                doc, pos = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                # Incomplete document; wait for the next chunk
+                break
+            if 'EXCEPTION' in doc:
+                # Errors encountered mid-stream are written into the docs array
+                raise Exception("Solr /export failed mid-stream: {}".format(doc['EXCEPTION']))
+            yield doc
+        buffer = buffer[pos:]
+    if not in_docs and len(buffer):
+        # No docs array was found, which means this was an error response
+        raise Exception("Solr /export response did not contain any documents: {}".format(buffer[:1024]))
+
+
+# Stream all documents matching the query from Solr's /export handler. Unlike query_solr, this does not score or page,
+# so it remains fast for very deep result sets, but it is restricted to docValues fields (see can_export) and does not
+# support collapsing, faceting, or offsets.
+#
+# Returns a generator of each document as a dict, in the order requested by sort.
+def export_solr(collection=None, fields=None, query_string=None, fqs=None, sort=None, op=None):
+    export_uri = "{}{}/export".format(SOLR_URI, collection)
+    params = [
+        ('q', query_string or "*:*"),
+        ('fl', ",".join(fields)),
+        ('sort', sort)
+    ]
+    if op:
+        params.append(('q.op', op))
+    if fqs:
+        params.extend([('fq', x) for x in (fqs if type(fqs) is list else [fqs])])
+
+    # Taken here rather than in the generator, which runs under whatever is consuming it
+    return _export_docs(collection, export_uri, params, get_caller((__name__,)))
+
+
+# Only the time spent reading from Solr is observed, not the time the consumer spends between documents
+def _export_docs(collection, export_uri, params, caller):
+    elapsed = 0.0
+    reading_since = time.time()
+    count = 0
+    try:
+        with requests.post(export_uri, data=params, stream=True, **_solr_request_vars()) as export_response:
+            if export_response.status_code != 200:
+                raise Exception("Saw response code {} when exporting from solr collection {}\nparams: {}\nresponse text: {}".format(
+                    str(export_response.status_code), collection, params, export_response.text
+                ))
+            export_response.encoding = export_response.encoding or 'utf-8'
+            for doc in _iter_export_docs(export_response.iter_content(chunk_size=65536, decode_unicode=True)):
+                elapsed += time.time() - reading_since
+                reading_since = None
+                count += 1
+                yield doc
+                reading_since = time.time()
+    except Exception:
+        SOLR_ERRORS.inc(core=collection, handler='export', caller=caller)
+        raise
+    finally:
+        if reading_since is not None:
+            elapsed += time.time() - reading_since
+        SOLR_EXPORTED_DOCUMENTS.inc(count, core=collection)
+        SOLR_REQUEST_SECONDS.observe(elapsed, core=collection, handler='export', caller=caller)
+
+
 # Generates the Solr stats block of a JSON API request
 def build_solr_stats(attrs,filter_tags=None):
     stats = []
@@ -220,26 +367,74 @@ def build_solr_stats(attrs,filter_tags=None):
             stats.append(stat)
     return stats
 
-# Solr facets are the bucket counting; optionally provide a set of filters to *not* be counted for purposes of
-# providing counts on the query filters
-def build_solr_facets(attrs, filter_tags=None, include_nulls=True, unique=None, with_stats=False):
-    facets = {}
+# Compiled facet plans, keyed on the active IDC version, the attribute IDs being faceted, and the request options
+# which alter the facet bodies (include_nulls, unique). Facet definitions only change with a data release, so a
+# plan is built once per version and build_solr_facets is reduced to a lookup plus a merge of any filter tags.
+#
+# {
+#   (<active version IDs>, (<attr IDs asc>,), <include_nulls>, <unique>): [
+#       (<facet name>, <facet body>, <attribute name for excludeTags, or None>), ...
+#   ]
+# }
+#
+# At most MAX_SOLR_FACET_PLANS plans are held, least recently used dropped first, so plans for a superseded version
+# age out.
+SOLR_FACET_PLANS = OrderedDict()
+MAX_SOLR_FACET_PLANS = 256
+FACET_PLAN_LOCK = threading.Lock()
+
+# The active version IDs are looked up at most once every FACET_PLAN_VERSION_TTL seconds (overridable with the setting
+# of the same name), and immediately after a version is saved in this process. The value is held as (<IDs>, <expiry>)
+# so both are replaced together.
+FACET_PLAN_VERSION_TTL = 300
+ACTIVE_VERSION_KEY = {'value': None}
+
+
+# Sorted IDs of the active IDC versions, for keying caches of anything which only changes with a data release
+def get_active_version_key():
+    cached = ACTIVE_VERSION_KEY['value']
+    if cached and cached[1] > time.time():
+        return cached[0]
+    key = tuple(sorted(ImagingDataCommonsVersion.objects.filter(active=True).values_list('id', flat=True)))
+    ACTIVE_VERSION_KEY['value'] = (
+        key, time.time() + getattr(settings, 'FACET_PLAN_VERSION_TTL', FACET_PLAN_VERSION_TTL))
+    return key
+
+
+def _reset_facet_plan_version(sender, **kwargs):
+    ACTIVE_VERSION_KEY['value'] = None
+
+
+post_save.connect(_reset_facet_plan_version, sender=ImagingDataCommonsVersion)
+
+
+# Build the version-static portion of a facet set: bucket boundaries, uniqueness subfacets, and derived-data domain
+# filters. Request-specific filter exclusions are applied separately in build_solr_facets.
+def _compile_solr_facet_plan(attrs, include_nulls=True, unique=None):
+    plan = []
 
     attr_sets = attrs.get_attr_sets()
     attr_cats = attrs.get_attr_cats()
     attr_facets = attrs.get_facet_types()
     attr_ranges = attrs.get_attr_ranges(True)
-    cat_attrs = {}
-    for attr in attr_cats:
-        cat = attr_cats[attr]
-        if cat['cat_name'] not in cat_attrs:
-            cat_attrs[cat['cat_name']] = []
-        if attr not in cat_attrs[cat['cat_name']]:
-            cat_attrs[cat['cat_name']].append(attr)
+
+    unique_facet = {"unique_count": "unique({})".format(unique)} if unique else None
+
+    def _make_query_facet(attr, facet_type, q):
+        facet = {
+            'type': facet_type,
+            'field': attr.name,
+            'limit': -1,
+            'q': q
+        }
+        if unique_facet:
+            facet['facet'] = dict(unique_facet)
+        if DataSetType.DERIVED_DATA in attr_sets.get(attr.name, []) and attr.name in attr_cats:
+            facet['domain'] = {'filter': "has_{}:True".format(attr_cats[attr.name]['cat_name'].lower())}
+        return facet
 
     for attr in attrs:
         facet_type = attr_facets[attr.id]
-        facet_name = attr.name
         if facet_type == "query":
             # We need to make a series of query buckets
             for attr_range in attr_ranges[attr.id]:
@@ -250,25 +445,9 @@ def build_solr_facets(attrs, filter_tags=None, include_nulls=True, unique=None,
                     lower = attr_range.first
                     upper = attr_range.last
                     facet_name = "{}:{}".format(attr.name, attr_range.label) if attr_range.label else "{}:{} to {}".format(attr.name, str(lower), str(upper))
-                    facets[facet_name] = {
-                        'type': facet_type,
-                        'field': attr.name,
-                        'limit': -1,
-                        'q': "{}:{}{} TO {}{}".format(attr.name, l_boundary, str(lower), str(upper), u_boundary)
-                    }
-                    if unique:
-                        facets[facet_name]['facet'] = {"unique_count": "unique({})".format(unique)}
-
-                    if DataSetType.DERIVED_DATA in attr_sets.get(attr.name, []) and attr.name in attr_cats:
-                        if not 'domain' in facets[facet_name]:
-                            facets[facet_name]['domain'] = {}
-                        facets[facet_name]['domain']['filter'] = "has_{}:True".format(
-                            attr_cats[attr.name]['cat_name'].lower())
-
-                    if filter_tags and attr.name in filter_tags:
-                        if not 'domain' in facets[facet_name]:
-                            facets[facet_name]['domain'] = {}
-                        facets[facet_name]['domain']["excludeTags"] = filter_tags[attr.name]
+                    plan.append((facet_name, _make_query_facet(
+                        attr, facet_type, "{}:{}{} TO {}{}".format(attr.name, l_boundary, str(lower), str(upper), u_boundary)
+                    ), attr.name))
                 else:
                     # Iterated range
                     cast = int if attr_range.type == Attribute_Ranges.INT else float
@@ -283,103 +462,93 @@ def build_solr_facets(attrs, filter_tags=None, include_nulls=True, unique=None,
 
                     while lower == "*" or lower < last:
                         facet_name = "{}:{}".format(attr.name, attr_range.label) if attr_range.label else "{}:{} to {}".format(attr.name, str(lower), str(upper))
-                        facets[facet_name] = {
-                            'type': facet_type,
-                            'field': attr.name,
-                            'limit': -1,
-                            'q': "{}:{}{} TO {}{}".format(attr.name, l_boundary, str(lower), str(upper), u_boundary)
-                        }
-                        if filter_tags and attr.name in filter_tags:
-                            facets[facet_name]['domain'] = {
-                                "excludeTags": filter_tags[attr.name]
-                            }
+                        plan.append((facet_name, _make_query_facet(
+                            attr, facet_type, "{}:{}{} TO {}{}".format(attr.name, l_boundary, str(lower), str(upper), u_boundary)
+                        ), attr.name))
                         lower = upper
                         upper = lower+gap
 
-                        if unique:
-                            facets[facet_name]['facet'] = {"unique_count": "unique({})".format(unique)}
-
-                        if DataSetType.DERIVED_DATA in attr_sets.get(attr.name, []) and attr.name in attr_cats:
-                            if not 'domain' in facets[facet_name]:
-                                facets[facet_name]['domain'] = {}
-                            facets[facet_name]['domain']['filter'] = "has_{}:True".format(
-                                attr_cats[attr.name]['cat_name'].lower())
-
-                        if filter_tags and attr.name in filter_tags:
-                            if not 'domain' in facets[facet_name]:
-                                facets[facet_name]['domain'] = {}
-                            facets[facet_name]['domain']["excludeTags"] = filter_tags[attr.name]
-
                     # If we stopped *at* the end, we need to add one last bucket.
                     if attr_range.unbounded:
                         facet_name = "{}:{}".format(attr.name, attr_range.label) if attr_range.label else "{}:{} to {}".format(attr.name, str(attr_range.last), "*")
-                        facets[facet_name] = {
-                            'type': facet_type,
-                            'field': attr.name,
-                            'limit': -1,
-                            'q': "{}:{}{} TO {}]".format(attr.name, l_boundary, str(attr_range.last), "*")
-                        }
-                        if unique:
-                            facets[facet_name]['facet'] = {"unique_count": "unique({})".format(unique)}
-
-                        if DataSetType.DERIVED_DATA in attr_sets.get(attr.name, []) and attr.name in attr_cats:
-                            if not 'domain' in facets[facet_name]:
-                                facets[facet_name]['domain'] = {}
-                            facets[facet_name]['domain']['filter'] = "has_{}:True".format(
-                                attr_cats[attr.name]['cat_name'].lower())
-
-                        if filter_tags and attr.name in filter_tags:
-                            if not 'domain' in facets[facet_name]:
-                                facets[facet_name]['domain'] = {}
-                            facets[facet_name]['domain']["excludeTags"] = filter_tags[attr.name]
+                        plan.append((facet_name, _make_query_facet(
+                            attr, facet_type, "{}:{}{} TO {}]".format(attr.name, l_boundary, str(attr_range.last), "*")
+                        ), attr.name))
 
             if include_nulls:
-                none_facet_name = "{}:None".format(attr.name)
-                facets[none_facet_name] = {
-                    'type': facet_type,
-                    'field': attr.name,
-                    'limit': -1,
-                    'q': '-{}:[* TO *]'.format(attr.name)
-                }
-
-                if unique:
-                    facets[none_facet_name]['facet'] = {"unique_count": "unique({})".format(unique)}
-
-                # We need to make domain filters to exclude anything from outside this category or we'll get a bunch of NULLs from
-                # other categories' records
-                if DataSetType.DERIVED_DATA in attr_sets.get(attr.name, []) and attr.name in attr_cats:
-                    if not 'domain' in facets[none_facet_name]:
-                        facets[none_facet_name]['domain'] = {}
-                    if 'filter' not in facets[none_facet_name]['domain']:
-                        facets[none_facet_name]['domain']['filter'] = ""
-                    facets[none_facet_name]['domain']['filter'] += "has_{}:True".format(attr_cats[attr.name]['cat_name'].lower())
+                # Null buckets are never subject to filter exclusion. We also need domain filters to exclude anything
+                # from outside this category or we'll get a bunch of NULLs from other categories' records
+                plan.append(("{}:None".format(attr.name), _make_query_facet(
+                    attr, facet_type, '-{}:[* TO *]'.format(attr.name)
+                ), None))
 
         else:
-            facets[attr.name] = {
+            facet = {
                 'type': facet_type,
                 'field': attr.name,
                 'limit': -1
             }
 
-            if filter_tags and attr.name in filter_tags:
-                if not 'domain' in facets[attr.name]:
-                    facets[attr.name]['domain'] = {}
-                facets[attr.name]['domain']["excludeTags"] =  filter_tags[attr.name]
-
             if include_nulls:
-                facets[attr.name]['missing'] = True
+                facet['missing'] = True
 
-            if unique:
-                facets[attr.name]['facet'] = {"unique_count": "unique({})".format(unique)}
+            if unique_facet:
+                facet['facet'] = dict(unique_facet)
 
             if DataSetType.DERIVED_DATA in attr_sets.get(attr.name, []) and attr.name in attr_cats:
-                if not 'domain' in facets[facet_name]:
-                    facets[facet_name]['domain'] = {}
-                facets[facet_name]['domain']['filter'] = "has_{}:True".format(attr_cats[attr.name]['cat_name'].lower())
+                facet['domain'] = {'filter': "has_{}:True".format(attr_cats[attr.name]['cat_name'].lower())}
+
+            plan.append((attr.name, facet, attr.name))
+
+    return plan
+
+
+# Solr facets are the bucket counting; optionally provide a set of filters to *not* be counted for purposes of
+# providing counts on the query filters
+def build_solr_facets(attrs, filter_tags=None, include_nulls=True, unique=None, with_stats=False):
+    facets = {}
+
+    plan_key = (
+        get_active_version_key(), tuple(sorted(attr.id for attr in attrs)), bool(include_nulls), unique
+    )
+    with FACET_PLAN_LOCK:
+        plan = SOLR_FACET_PLANS.get(plan_key, None)
+        if plan is not None:
+            SOLR_FACET_PLANS.move_to_end(plan_key)
+    if plan is None:
+        logger.debug("[STATUS] Facet plan for {} not found, compiling.".format(plan_key))
+        plan = _compile_solr_facet_plan(attrs, include_nulls, unique)
+        with FACET_PLAN_LOCK:
+            SOLR_FACET_PLANS[plan_key] = plan
+            while len(SOLR_FACET_PLANS) > MAX_SOLR_FACET_PLANS:
+                SOLR_FACET_PLANS.popitem(last=False)
+
+    # Facet bodies are copied on the way out so that callers are free to alter what they're handed without touching
+    # the cached plan
+    for facet_name, plan_facet, exclude_for in plan:
+        facet = dict(plan_facet)
+        if 'domain' in plan_facet:
+            facet['domain'] = dict(plan_facet['domain'])
+        if exclude_for and filter_tags and exclude_for in filter_tags:
+            if 'domain' not in facet:
+                facet['domain'] = {}
+            facet['domain']["excludeTags"] = filter_tags[exclude_for]
+        facets[facet_name] = facet
 
     return facets
 
 
+# Filter name suffixes giving a range or comparison, as in the BigQuery filter builders, and the Solr clause for each
+# comparison against a single value
+RANGE_SUFFIX_RE = r'_[gl]te?$|_e?btwe?$|_eq$'
+OPEN_RANGES = {
+    'gt': "{}:{{{} TO *]",
+    'gte': "{}:[{} TO *]",
+    'lt': "{}:[* TO {}}}",
+    'lte': "{}:[* TO {}]",
+}
+
+
 # Build a query string for Solr
 #
 # filters: filter dict of one of these forms:
@@ -387,6 +556,9 @@ def build_solr_facets(attrs, filter_tags=None, include_nulls=True, unique=None,
 #    <attribute name>: [<value1>,[<value2>...]],
 # }
 #
+# where a numeric attribute's name may carry a range (_btw, _ebtw, _btwe, _ebtwe) or comparison (_gt, _gte, _lt, _lte,
+# _eq) suffix, or
+#
 # {
 #    <attribute name>: {'values': [<value1>,[<value2>...]], 'op': [<OR>|<AND>]},
 # }
@@ -491,8 +663,8 @@ def build_solr_query(filters, comb_with='AND', with_tags_for_ex=False, subq_join
         if type(values) is dict and 'values' in values:
             value_op = values['op'] or global_value_op
             values = values['values']
-        attr_name = attr[:attr.rfind('_')] if re.search('_[gl]t[e]|_e?btwe?',attr) else attr
-        attr_rng = attr[attr.rfind('_')+1:] if re.search('_[gl]t[e]|_e?btwe?', attr) else ''
+        attr_name = attr[:attr.rfind('_')] if re.search(RANGE_SUFFIX_RE, attr) else attr
+        attr_rng = attr[attr.rfind('_')+1:] if re.search(RANGE_SUFFIX_RE, attr) else ''
 
         query_str = ''
 
@@ -557,6 +729,8 @@ def build_solr_query(filters, comb_with='AND', with_tags_for_ex=False, subq_join
                 if len(values) >= 1 and type(values[0]) is list:
                     clause = " {} ".format(value_op).join(
                         [rngTemp.format(attr_name, str(x[0]), str(x[1])) for x in values])
+                elif attr_rng in OPEN_RANGES and len(values) == 1:
+                    clause = OPEN_RANGES[attr_rng].format(attr_name, values[0])
                 elif len(values) > 1 :
                     clause = rngTemp.format(attr_name, values[0], values[1])
                 else:
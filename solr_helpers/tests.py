@@ -15,7 +15,8 @@
 #
 
 from django.test import TestCase
-from solr_helpers.__init__ import build_solr_query, build_solr_stats, build_solr_facets
+from solr_helpers.__init__ import build_solr_query, build_solr_stats, build_solr_facets, SOLR_FACET_PLANS, \
+    _iter_export_docs
 from idc_collections.collex_metadata_utils import fetch_data_source_attr
 from idc_collections.models import DataSetType, DataSource, ImagingDataCommonsVersion
 
@@ -80,17 +81,53 @@ class InitTest(TestCase):
             solq = build_solr_facets(self.attrs_for_faceting['sources'][self.sourceList[i].id]['attrs'])
             pass
 
+    def test_build_solr_facets_plan_cache(self):
+        for i in range(len(self.sourceList)):
+            attrs = self.attrs_for_faceting['sources'][self.sourceList[i].id]['attrs']
+            untagged = build_solr_facets(attrs, unique="PatientID")
+            plan_count = len(SOLR_FACET_PLANS)
+            filter_tags = {attr.name: "f{}".format(attr.id) for attr in attrs}
+            # The active version is cached along with the plan, so a repeat build doesn't touch the database
+            with self.assertNumQueries(0):
+                tagged = build_solr_facets(attrs, filter_tags=filter_tags, unique="PatientID")
+            # Same plan, so nothing new should have been compiled
+            self.assertEqual(plan_count, len(SOLR_FACET_PLANS))
+            self.assertEqual(set(untagged.keys()), set(tagged.keys()))
+            # Request-specific exclusions must not leak back into the cached plan
+            self.assertEqual(untagged, build_solr_facets(attrs, unique="PatientID"))
+
     def test_build_solr_stats(self):
         for i in range(len(self.sourceList)):
             nstats = build_solr_stats(self.attrs_for_faceting['sources'][self.sourceList[i].id]['attrs'])
             pass
 
+    def test_iter_export_docs(self):
+        body = '{"responseHeader":{"status":0},\n"response":{"numFound":2,\n"docs":[\n' + \
+               '{"SeriesInstanceUID":"1.2.3","aws_bucket":["idc-open-data"]}\n,{"SeriesInstanceUID":"4]5"}]}}'
+        expected = [{"SeriesInstanceUID": "1.2.3", "aws_bucket": ["idc-open-data"]}, {"SeriesInstanceUID": "4]5"}]
+        # Documents must be parsed correctly regardless of where the chunk boundaries fall
+        for size in [1, 7, 64, len(body)]:
+            chunks = [body[i:i+size] for i in range(0, len(body), size)]
+            self.assertEqual(list(_iter_export_docs(chunks)), expected)
+        self.assertEqual(list(_iter_export_docs(['{"response":{"numFound":0,"docs":[]}}'])), [])
+        with self.assertRaises(Exception):
+            list(_iter_export_docs(['{"error":{"msg":"undefined field"}}']))
+
     def test_build_solr_query(self):
         for i in range(len(self.filters_data)):
             filters = self.filters_data[i]
             build_solr_query(filters)
             pass
 
+    def test_build_solr_query_comparisons(self):
+        # Comparison suffixes are open-ended ranges on the attribute itself
+        for suffix, clause in [('gt', '{50 TO *]'), ('gte', '[50 TO *]'), ('lt', '[* TO 50}'), ('lte', '[* TO 50]')]:
+            query = build_solr_query({'age_at_diagnosis_{}'.format(suffix): [50]})
+            self.assertIn('age_at_diagnosis', query['queries'])
+            self.assertIn('age_at_diagnosis:' + clause, query['queries']['age_at_diagnosis'])
+        query = build_solr_query({'age_at_diagnosis_eq': [50]})
+        self.assertIn('age_at_diagnosis:50', query['queries']['age_at_diagnosis'])
+
     #def test_query_solr(self):
         #qs=query_solr(collection=None, fields=None, query_string=None, fqs=None, facets=None, sort=None, counts_only=True,
         #           collapse_on=None, offset=0, limit=1000, uniques=None, with_cursor=None, stats=None, totals=None)